@@ -6,7 +6,9 @@
 import os
 import re
 import logging
+import threading
 import time
+import collections
 
 import xml.etree.ElementTree as ET
 
@@ -608,6 +610,15 @@ class Processing(object):
     order = 1
     enabled = True
 
+    # Names of the processing modules whose results this module uses. If
+    # not set, it depends on all modules that have a lower order.
+    dependencies = None
+
+    # Whether this module forks worker processes. Such modules are run while
+    # no other processing module is running, as the forked processes would
+    # inherit locks held by the other threads, e.g., the logging locks.
+    forks = False
+
     def __init__(self):
         self.analysis_path = ""
         self.baseline_path = ""
@@ -663,6 +674,288 @@ class Processing(object):
         """
         raise NotImplementedError
 
+class PatternCache(object):
+    """LRU cache of compiled case-insensitive regular expressions, shared by
+    all signatures. Unlike the cache of the re module it is not flushed as
+    a whole once it is full."""
+
+    def __init__(self, size=1024):
+        self.size = size
+        self.patterns = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def compile(self, pattern):
+        with self.lock:
+            exp = self.patterns.pop(pattern, None)
+            if exp is None:
+                exp = re.compile(pattern, re.IGNORECASE)
+                if len(self.patterns) >= self.size:
+                    self.patterns.popitem(last=False)
+            self.patterns[pattern] = exp
+            return exp
+
+class MultiPattern(object):
+    """Matches many case-insensitive regular expressions at once.
+
+    Patterns starting with a literal prefix, e.g., "C:\\\\Windows\\\\", are
+    indexed on that prefix, so that an item is only matched against the
+    patterns whose prefix it starts with.
+
+    The other patterns are combined into alternations, each pattern wrapped
+    in a capturing group. An item that none of them match is rejected by a
+    single match of the alternation. Otherwise the first matching pattern is
+    known from the capturing group and only the patterns following it have
+    to be matched separately.
+
+    Patterns that don't survive being combined, e.g., because of
+    backreferences or inline flags, are always matched separately.
+    """
+
+    # The re module supports at most 100 groups per expression.
+    MAX_GROUPS = 99
+
+    # Backreferences, named groups, conditionals, and inline flags.
+    UNCOMBINABLE = re.compile(r"\\[1-9]|\(\?(P|\(|[iLmsux]+\))")
+
+    # Characters that end the literal prefix of a pattern.
+    SPECIAL = ".^$*+?{}[]|()"
+
+    @classmethod
+    def literal_prefix(cls, pattern):
+        """Lowercased literal prefix of a regular expression.
+        @param pattern: regular expression without top-level alternation.
+        @return: prefix string, possibly empty.
+        """
+        prefix, idx = [], 0
+        while idx < len(pattern):
+            ch, step = pattern[idx], 1
+            if ch == "\\":
+                if idx + 1 == len(pattern) or pattern[idx+1].isalnum():
+                    break
+                ch, step = pattern[idx+1], 2
+            elif ch in cls.SPECIAL:
+                break
+
+            # Case-insensitive matching of non-ASCII characters depends on
+            # the flags, so stop there.
+            if ord(ch) > 127:
+                break
+
+            # Optional or repeated characters are not part of the prefix.
+            quantifier = pattern[idx+step:idx+step+1]
+            if quantifier and quantifier in "*?{":
+                break
+
+            prefix.append(ch.lower())
+            if quantifier == "+":
+                break
+            idx += step
+        return "".join(prefix)
+
+    def __init__(self, patterns, cache):
+        """@param patterns: regular expressions.
+        @param cache: PatternCache for compiling them."""
+        self.prefixed = {}
+        self.chunks = []
+        self.separate = []
+        self.patterns = []
+
+        chunk = []
+        for pattern in patterns:
+            try:
+                exp = cache.compile(pattern)
+            except re.error:
+                continue
+
+            self.patterns.append(pattern)
+            if self.UNCOMBINABLE.search(pattern):
+                self.separate.append((pattern, exp))
+                continue
+
+            prefix = "" if "|" in pattern else self.literal_prefix(pattern)
+            if prefix:
+                self.prefixed.setdefault(prefix, []).append((pattern, exp))
+                continue
+
+            if sum(e.groups + 1 for _, e in chunk) + exp.groups + 1 > \
+                    self.MAX_GROUPS:
+                self._add_chunk(chunk)
+                chunk = []
+
+            chunk.append((pattern, exp))
+
+        self._add_chunk(chunk)
+        self.lengths = sorted(set(len(prefix) for prefix in self.prefixed))
+
+    def _add_chunk(self, chunk):
+        if not chunk:
+            return
+
+        try:
+            combined = re.compile("|".join(
+                "(%s)" % pattern for pattern, _ in chunk
+            ), re.IGNORECASE)
+        except (re.error, AssertionError, OverflowError):
+            self.separate.extend(chunk)
+            return
+
+        # Map the group of each pattern to its position in the chunk.
+        groups, group = {}, 1
+        for idx, (_, exp) in enumerate(chunk):
+            groups[group] = idx
+            group += exp.groups + 1
+
+        self.chunks.append((combined, groups, chunk))
+
+    def match(self, item):
+        """Patterns matching the start of the item.
+        @param item: subject string.
+        @return: list of the matching patterns.
+        """
+        ret, lowered = [], item.lower()
+        for length in self.lengths:
+            if length > len(lowered):
+                break
+
+            for pattern, exp in self.prefixed.get(lowered[:length], ()):
+                if exp.match(item):
+                    ret.append(pattern)
+
+        for combined, groups, chunk in self.chunks:
+            m = combined.match(item)
+            if m is None:
+                continue
+
+            idx = groups[m.lastindex]
+            ret.append(chunk[idx][0])
+            for pattern, exp in chunk[idx+1:]:
+                if exp.match(item):
+                    ret.append(pattern)
+
+        for pattern, exp in self.separate:
+            if exp.match(item):
+                ret.append(pattern)
+        return ret
+
+class SummaryIndex(object):
+    """Indexed view on the generic behavior summary of an analysis.
+
+    The values of each action are indexed per process as well as for all
+    processes together, both as-is and lowercased, so that literal checks
+    are simple lookups and regular expressions are matched against each
+    unique value only once. Only string values are matched, i.e., not the
+    (source, destination) tuples of actions such as file_moved.
+    """
+
+    def __init__(self, generic):
+        self.generic = generic
+        self.values = {}
+        self.lowered = {}
+        self.uniques = {}
+
+        # Registered regular expressions and their signatures, and their
+        # matches per pid and action once match_patterns() has been called.
+        self.registered = collections.OrderedDict()
+        self.matches = {}
+
+    def get(self, pid, action):
+        """Values of an action, in summary order.
+        @param pid: process identifier or None for all processes.
+        @param action: action to get.
+        """
+        key = pid, action
+        if key not in self.values:
+            values = self.values[key] = []
+            for process in self.generic:
+                if pid is None or process["pid"] == pid:
+                    values.extend(process["summary"].get(action, []))
+        return self.values[key]
+
+    def strings(self, values):
+        """String values of an action."""
+        return (value for value in values if isinstance(value, basestring))
+
+    def get_lowered(self, pid, action):
+        """Values of an action, indexed by their lowercased value."""
+        key = pid, action
+        if key not in self.lowered:
+            lowered = self.lowered[key] = {}
+            for value in self.strings(self.get(pid, action)):
+                lowered.setdefault(value.lower(), set()).add(value)
+        return self.lowered[key]
+
+    def unique(self, pid, actions):
+        """Unique values of the given actions."""
+        key = pid, tuple(actions)
+        if key not in self.uniques:
+            ret = set()
+            for action in actions:
+                ret.update(self.strings(self.get(pid, action)))
+            self.uniques[key] = list(ret)
+        return self.uniques[key]
+
+    def find(self, pid, actions, pattern):
+        """Set of values of the given actions that equal the pattern,
+        case-insensitively."""
+        pattern, ret = pattern.lower(), set()
+        for action in actions:
+            ret.update(self.get_lowered(pid, action).get(pattern, ()))
+        return ret
+
+    def register(self, signature, pattern):
+        """Register a regular expression to be matched by match_patterns().
+        @param signature: signature registering the pattern.
+        @param pattern: regular expression.
+        """
+        self.registered.setdefault(pattern, []).append(signature)
+
+    def match_patterns(self, cache):
+        """Match all registered patterns against every unique value in the
+        summary, at once.
+        @param cache: PatternCache for compiling the patterns.
+        @return: list of (signature, pattern, match) hits.
+        """
+        patterns = [pattern for pattern in self.registered
+                    if pattern not in self.matches]
+        if not patterns:
+            return []
+
+        # Invalid patterns are left for the checks themselves to report.
+        engine = MultiPattern(patterns, cache)
+        for pattern in engine.patterns:
+            self.matches[pattern] = {}
+
+        hits, matched = [], {}
+        for process in self.generic:
+            for action, values in process["summary"].items():
+                for value in set(self.strings(values)):
+                    if value not in matched:
+                        matched[value] = engine.match(value)
+                        for pattern in matched[value]:
+                            for signature in self.registered[pattern]:
+                                hits.append((signature, pattern, value))
+
+                    for pattern in matched[value]:
+                        self.matches[pattern].setdefault(
+                            (process["pid"], action), set()
+                        ).add(value)
+        return hits
+
+    def search(self, pid, actions, pattern):
+        """Set of values of the given actions that match a pattern, if it
+        has been matched by match_patterns().
+        @return: set of values, or None if the pattern hasn't been matched.
+        """
+        matches = self.matches.get(pattern)
+        if matches is None:
+            return
+
+        ret, actions = set(), set(actions)
+        for (value_pid, action), values in matches.items():
+            if (pid is None or value_pid == pid) and action in actions:
+                ret.update(values)
+        return ret
+
 class Signature(object):
     """Base class for Detector signatures."""
     name = ""
@@ -683,6 +976,13 @@ class Signature(object):
     filter_apinames = []
     filter_categories = []
 
+    # Names of the signatures whose matches are sent to on_signature(). All
+    # matches are sent if not set.
+    filter_signatures = []
+
+    # Compiled regular expressions shared by all signatures.
+    patterns = PatternCache()
+
     def __init__(self, caller):
         """
         @param caller: calling object. Stores results in caller.results
@@ -707,7 +1007,7 @@ class Signature(object):
         """
         ret = set()
         if regex:
-            exp = re.compile(pattern, re.IGNORECASE)
+            exp = self.patterns.compile(pattern)
             if isinstance(subject, list):
                 for item in subject:
                     if exp.match(item):
@@ -717,13 +1017,40 @@ class Signature(object):
                     ret.add(subject)
         else:
             if isinstance(subject, list):
+                pattern = pattern.lower()
                 for item in subject:
-                    if item.lower() == pattern.lower():
+                    if item.lower() == pattern:
                         ret.add(item)
             else:
                 if subject == pattern:
                     ret.add(subject)
 
+        return self._check_result(ret, all)
+
+    def _check_summary(self, pattern, pid, actions, regex=False, all=False):
+        """Checks a pattern against the values of generic summary actions.
+        Equivalent to _check_value() against get_summary_generic(), but uses
+        the SummaryIndex of this analysis.
+        @param pattern: string or expression to check for.
+        @param pid: pid of the process. None for all.
+        @param actions: a list of actions to check.
+        @param regex: boolean representing if the pattern is a regular
+                      expression or not and therefore should be compiled.
+        @return: boolean with the result of the check.
+        """
+        index = self.get_summary_index()
+        if regex:
+            ret = index.search(pid, actions, pattern)
+            if ret is None:
+                exp = self.patterns.compile(pattern)
+                ret = set(filter(exp.match, index.unique(pid, actions)))
+        else:
+            ret = index.find(pid, actions, pattern)
+
+        return self._check_result(ret, all)
+
+    def _check_result(self, ret, all):
+        """Returns the result of a check in the way requested."""
         # Return all elements.
         if all:
             return list(ret)
@@ -762,6 +1089,29 @@ class Signature(object):
         summary = self.get_results("behavior", {}).get("summary", {})
         return summary.get(key, default) if key else summary
 
+    def get_summary_index(self):
+        """Get the SummaryIndex of this analysis. It is shared by all
+        signatures through the caller."""
+        index = getattr(self._caller, "summary_index", None)
+        if index is None:
+            index = SummaryIndex(
+                self.get_results("behavior", {}).get("generic", [])
+            )
+            self._caller.summary_index = index
+        return index
+
+    def register_patterns(self, *patterns):
+        """Register regular expressions that this signature is going to
+        check with the regex=True check_*() helpers. Registered patterns of
+        all signatures are matched against the behavior summary together,
+        after which those checks are simple lookups. Should be called from
+        init().
+        @param patterns: regular expressions.
+        """
+        index = self.get_summary_index()
+        for pattern in patterns:
+            index.register(self, pattern)
+
     def get_summary_generic(self, pid, actions):
         """Get generic info from summary.
 
@@ -839,10 +1189,11 @@ class Signature(object):
                 "file_exists",
             ]
 
-        return self._check_value(pattern=pattern,
-                                 subject=self.get_files(pid, actions),
-                                 regex=regex,
-                                 all=all)
+        return self._check_summary(pattern=pattern,
+                                   pid=pid,
+                                   actions=actions,
+                                   regex=regex,
+                                   all=all)
 
     def check_dll_loaded(self, pattern, regex=False, actions=None, pid=None,
                          all=False):
@@ -854,10 +1205,11 @@ class Signature(object):
                     processes will be checked.
         @return: boolean with the result of the check.
         """
-        return self._check_value(pattern=pattern,
-                                 subject=self.get_dll_loaded(pid),
-                                 regex=regex,
-                                 all=all)
+        return self._check_summary(pattern=pattern,
+                                   pid=pid,
+                                   actions=["dll_loaded"],
+                                   regex=regex,
+                                   all=all)
 
     def check_key(self, pattern, regex=False, actions=None, pid=None,
                   all=False):
@@ -876,10 +1228,11 @@ class Signature(object):
                 "regkey_read", "regkey_deleted",
             ]
 
-        return self._check_value(pattern=pattern,
-                                 subject=self.get_keys(pid, actions),
-                                 regex=regex,
-                                 all=all)
+        return self._check_summary(pattern=pattern,
+                                   pid=pid,
+                                   actions=actions,
+                                   regex=regex,
+                                   all=all)
 
     def get_mutexes(self, pid=None):
         """
@@ -895,10 +1248,11 @@ class Signature(object):
                       expression or not and therefore should be compiled.
         @return: boolean with the result of the check.
         """
-        return self._check_value(pattern=pattern,
-                                 subject=self.get_mutexes(),
-                                 regex=regex,
-                                 all=all)
+        return self._check_summary(pattern=pattern,
+                                   pid=None,
+                                   actions=["mutex"],
+                                   regex=regex,
+                                   all=all)
 
     def get_command_lines(self):
         """Retrieves all command lines used."""
@@ -1162,6 +1516,9 @@ class BehaviorHandler(object):
         process."""
         return False
 
+    def prepare(self, logpaths):
+        """Called with all log files before any of them is parsed."""
+
     def parse(self, logpath):
         """Called after handles_path succeeded, should generate behavior
         events."""
@@ -0,0 +1,130 @@
+# Copyright (C) 2010-2013 Claudio Guarnieri.
+# Copyright (C) 2014-2015 Detector Foundation.
+# This file is part of Detector Sandbox - http://www.detectorsandbox.org
+# See the file 'docs/LICENSE' for copying permission.
+
+import bisect
+import socket
+import struct
+
+from lib.detector.common.exceptions import DetectorOperationalError
+
+# Networks that are not publicly routable, including multicast and broadcast.
+PRIVATE_NETWORKS = [
+    "0.0.0.0/8",
+    "10.0.0.0/8",
+    "100.64.0.0/10",
+    "127.0.0.0/8",
+    "169.254.0.0/16",
+    "172.16.0.0/12",
+    "192.0.0.0/24",
+    "192.0.2.0/24",
+    "192.88.99.0/24",
+    "192.168.0.0/16",
+    "198.18.0.0/15",
+    "198.51.100.0/24",
+    "203.0.113.0/24",
+    "240.0.0.0/4",
+    "255.255.255.255/32",
+    "224.0.0.0/4",
+    "::/128",
+    "::1/128",
+    "100::/64",
+    "2001:db8::/32",
+    "fc00::/7",
+    "fe80::/10",
+    "ff00::/8",
+]
+
+# Prefix of IPv4-mapped IPv6 addresses (::ffff:0:0/96), which are classified
+# by their IPv4 address.
+IPV4_MAPPED = 0xffff
+
+def parse_ip(ip):
+    """Parse an IPv4 or IPv6 address.
+    @param ip: IP address.
+    @return: tuple of the address family and the address as integer.
+    """
+    if ":" not in ip:
+        return socket.AF_INET, struct.unpack(">I", socket.inet_aton(ip))[0]
+
+    hi, lo = struct.unpack(">QQ", socket.inet_pton(socket.AF_INET6, ip))
+    return socket.AF_INET6, hi << 64 | lo
+
+class AddressRanges(object):
+    """Set of IPv4 and IPv6 networks. The networks are merged into sorted,
+    non-overlapping integer ranges per address family, so that looking up an
+    address is a binary search rather than a walk over all networks, and the
+    results are memoized as the same addresses are looked up over and over
+    again while processing a PCAP file."""
+
+    # Maximum amount of memoized lookups.
+    CACHE_SIZE = 65536
+
+    def __init__(self, networks=()):
+        """@param networks: networks in CIDR notation."""
+        self.ranges = {
+            socket.AF_INET: [],
+            socket.AF_INET6: [],
+        }
+        self.starts = {}
+        self.cache = {}
+
+        for network in networks:
+            self.add(network)
+
+    def add(self, network):
+        """Add a network.
+        @param network: network in CIDR notation, e.g., "10.0.0.0/8".
+        @raise DetectorOperationalError: if the network is invalid.
+        """
+        try:
+            addr, bits = network.strip().split("/", 1)
+            family, low = parse_ip(addr)
+            bits = int(bits)
+        except (TypeError, ValueError, socket.error):
+            raise DetectorOperationalError("Invalid network: %r" % network)
+
+        width = 32 if family == socket.AF_INET else 128
+        if not 0 <= bits <= width:
+            raise DetectorOperationalError("Invalid network: %r" % network)
+
+        mask = (1 << (width - bits)) - 1
+        self.ranges[family].append((low & ~mask, low | mask))
+        self._merge(family)
+
+    def _merge(self, family):
+        merged = []
+        for low, high in sorted(self.ranges[family]):
+            if merged and low <= merged[-1][1] + 1:
+                merged[-1] = merged[-1][0], max(merged[-1][1], high)
+            else:
+                merged.append((low, high))
+
+        self.ranges[family] = merged
+        self.starts[family] = [low for low, high in merged]
+        self.cache.clear()
+
+    def _lookup(self, ip):
+        try:
+            family, value = parse_ip(ip)
+        except (TypeError, ValueError, socket.error):
+            return False
+
+        if family == socket.AF_INET6 and value >> 32 == IPV4_MAPPED:
+            family, value = socket.AF_INET, value & 0xffffffff
+
+        idx = bisect.bisect_right(self.starts.get(family, []), value) - 1
+        return idx >= 0 and value <= self.ranges[family][idx][1]
+
+    def __contains__(self, ip):
+        """Check if an IP address belongs to one of the networks.
+        @param ip: IPv4 or IPv6 address.
+        @return: boolean, False for invalid addresses.
+        """
+        ret = self.cache.get(ip)
+        if ret is None:
+            if len(self.cache) >= self.CACHE_SIZE:
+                self.cache.clear()
+            ret = self.cache[ip] = self._lookup(ip)
+        return ret
@@ -0,0 +1,126 @@
+# Copyright (C) 2010-2013 Claudio Guarnieri.
+# Copyright (C) 2014-2015 Detector Foundation.
+# This file is part of Detector Sandbox - http://www.detectorsandbox.org
+# See the file 'docs/LICENSE' for copying permission.
+
+import cPickle
+import io
+import os
+import struct
+
+class CallStore(object):
+    """Indexed on-disk storage of the API calls of a single process.
+
+    The store consists of three files. The data file holds every call as a
+    separately pickled record. The index file holds a fixed-size entry per
+    call with the offset and length of its record, the API and the status,
+    so that the amount of calls, random access, and per-API filtering never
+    require decoding unrelated calls. The meta file holds the API/category
+    table and marks the store as complete.
+    """
+
+    # Data offset, data length, API index, status.
+    INDEX = struct.Struct("<QIIB")
+
+    # Amount of index entries read at once.
+    CHUNK_SIZE = 4096
+
+    def __init__(self, path):
+        """@param path: path of the store files, without extension."""
+        self.index_path = path + ".idx"
+        self.data_path = path + ".dat"
+        self.meta_path = path + ".meta"
+        self.apis = []
+        self.count = 0
+
+    def build(self, calls):
+        """Write the store from an iterable of API call events.
+        @param calls: API call events.
+        @return: amount of calls stored.
+        """
+        apis, self.apis, self.count = {}, [], 0
+
+        with open(self.index_path, "wb") as index, \
+                open(self.data_path, "wb") as data:
+            offset = 0
+            for call in calls:
+                key = call["api"], call.get("category")
+                if key not in apis:
+                    apis[key] = len(self.apis)
+                    self.apis.append(key)
+
+                record = cPickle.dumps(call, cPickle.HIGHEST_PROTOCOL)
+                data.write(record)
+                index.write(self.INDEX.pack(
+                    offset, len(record), apis[key], bool(call.get("status"))
+                ))
+                offset += len(record)
+                self.count += 1
+
+        # The meta file marks the store as complete, so write it atomically.
+        with open(self.meta_path + ".tmp", "wb") as f:
+            cPickle.dump({
+                "apis": self.apis,
+                "count": self.count,
+            }, f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(self.meta_path + ".tmp", self.meta_path)
+        return self.count
+
+    def _entries(self, start, stop):
+        """Yield the index entries in the given range."""
+        with open(self.index_path, "rb") as f:
+            f.seek(start * self.INDEX.size)
+            while start < stop:
+                count = min(stop - start, self.CHUNK_SIZE)
+                buf = f.read(count * self.INDEX.size)
+                for idx in xrange(0, len(buf), self.INDEX.size):
+                    yield self.INDEX.unpack_from(buf, idx)
+                start += count
+
+    def _records(self, entries):
+        """Yield the calls belonging to the given index entries."""
+        with io.open(self.data_path, "rb") as f:
+            for offset, length, _, _ in entries:
+                f.seek(offset)
+                yield cPickle.loads(f.read(length))
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return self._records(self._entries(0, self.count))
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self.count)
+            entries = self._entries(start, stop) if step > 0 else \
+                self._entries(stop + 1, start + 1)
+            entries = list(entries)[::step]
+            return list(self._records(entries))
+
+        if index < 0:
+            index += self.count
+        if index < 0 or index >= self.count:
+            raise IndexError("call index out of range")
+
+        return next(self._records(self._entries(index, index + 1)))
+
+    def filter(self, apis=None, categories=None):
+        """Yield only the calls to the given APIs and/or categories.
+        @param apis: API names.
+        @param categories: API categories.
+        """
+        wanted = set()
+        for idx, (api, category) in enumerate(self.apis):
+            if apis is not None and api not in apis:
+                continue
+            if categories is not None and category not in categories:
+                continue
+            wanted.add(idx)
+
+        if not wanted:
+            return iter([])
+
+        entries = (entry for entry in self._entries(0, self.count)
+                   if entry[2] in wanted)
+        return self._records(entries)
@@ -1,6 +1,12 @@
+import collections
+import random
 import select
 import socket
+import struct
 import threading
+import time
+
+from multiprocessing.pool import ThreadPool
 
 try:
     import pycares
@@ -27,10 +33,15 @@ def set_timeout_value(value):
     global DNS_TIMEOUT_VALUE
     DNS_TIMEOUT_VALUE = value
 
+def _timeout_value(value):
+    """Value to return for lookups that time out, which is DNS_TIMEOUT_VALUE
+    unless the caller has to tell timeouts apart from failed lookups."""
+    return DNS_TIMEOUT_VALUE if value is None else value
+
 
 # standard gethostbyname in thread
 # http://code.activestate.com/recipes/473878/
-def with_timeout(func, args=(), kwargs={}):
+def with_timeout(func, args=(), kwargs={}, timeout_value=None):
     """This function will spawn a thread and run the given function
     using the args, kwargs and return the given default value if the
     timeout_duration is exceeded.
@@ -50,14 +61,14 @@ def with_timeout(func, args=(), kwargs={}):
     it.start()
     it.join(DNS_TIMEOUT)
     if it.isAlive():
-        return DNS_TIMEOUT_VALUE
+        return _timeout_value(timeout_value)
     else:
         if it.error:
             raise it.error
         return it.result
 
-def resolve_thread(name):
-    return with_timeout(gethostbyname, (name,))
+def resolve_thread(name, timeout_value=None):
+    return with_timeout(gethostbyname, (name,), timeout_value=timeout_value)
 
 def gethostbyname(name):
     try:
@@ -68,18 +79,21 @@ def gethostbyname(name):
 
 
 # C-ARES (http://c-ares.haxx.se/)
-def resolve_cares(name):
+def resolve_cares(name, timeout_value=None):
     # create new c-ares channel
     careschan = pycares.Channel(timeout=DNS_TIMEOUT, tries=1)
 
     # if we don't get a response we return the default value
     result = Resultholder()
-    result.value = DNS_TIMEOUT_VALUE
+    result.value = _timeout_value(timeout_value)
 
     def setresult_cb(res, error):
-        # ignore error and just take first result ip (randomized anyway)
+        # take first result ip (randomized anyway), errors other than a
+        # timeout mean the name doesn't resolve
         if res and res.addresses:
             result.value = res.addresses[0]
+        elif error and error != pycares.errno.ARES_ETIMEOUT:
+            result.value = ""
 
     # resolve with cb
     careschan.gethostbyname(name, socket.AF_INET, setresult_cb)
@@ -102,34 +116,261 @@ class Resultholder:
 
 
 # gevent based resolver with timeout
-def resolve_gevent(name):
-    result = resolve_gevent_real(name)
+def resolve_gevent(name, timeout_value=None):
+    result = resolve_gevent_real(name, timeout_value)
     # if it failed, do this a second time because of strange libevent behavior
     # basically sometimes the Timeout fires immediately instead of after
     # DNS_TIMEOUT
-    if result == DNS_TIMEOUT_VALUE:
-        result = resolve_gevent_real(name)
+    if result == _timeout_value(timeout_value):
+        result = resolve_gevent_real(name, timeout_value)
     return result
 
-def resolve_gevent_real(name):
-    result = DNS_TIMEOUT_VALUE
+def resolve_gevent_real(name, timeout_value=None):
+    result = _timeout_value(timeout_value)
     with gevent.Timeout(DNS_TIMEOUT, False):
         try:
             result = gevent.socket.gethostbyname(name)
         except socket.gaierror:
-            pass
+            result = ""
 
     return result
 
 
 # choose resolver automatically
-def resolve(name):
+def resolve(name, timeout_value=None):
     if HAVE_CARES:
-        return resolve_cares(name)
+        return resolve_cares(name, timeout_value)
     elif HAVE_GEVENT:
-        return resolve_gevent(name)
+        return resolve_gevent(name, timeout_value)
     else:
-        return resolve_thread(name)
+        return resolve_thread(name, timeout_value)
 
 # another alias
 resolve_best = resolve
+
+
+# Seconds to cache answers and failed lookups for if their TTL is unknown, and
+# to cache lookups that timed out for.
+DNS_DEFAULT_TTL = 300
+DNS_NEGATIVE_TTL = 300
+DNS_TIMEOUT_TTL = 60
+
+DNS_TYPE_A, DNS_TYPE_SOA = 1, 6
+DNS_RCODE_NOERROR, DNS_RCODE_NXDOMAIN = 0, 3
+
+# Returned by the resolvers of the host for lookups that time out, as
+# opposed to names that don't resolve.
+_TIMED_OUT = object()
+
+class DnsCache(object):
+    """Cache of DNS lookups, which keeps answers as well as failed lookups
+    for their time to live, shared by all tasks processed by a process."""
+
+    def __init__(self, size=65536):
+        """@param size: maximum amount of cached names."""
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, name):
+        """Get the cached IP address of a name.
+        @param name: domain name.
+        @return: IP address, an empty string for failed lookups, or None if
+                 the name is not cached.
+        """
+        with self.lock:
+            entry = self.entries.get(name.lower())
+            if not entry:
+                return None
+
+            ip, expires = entry
+            if expires <= time.time():
+                del self.entries[name.lower()]
+                return None
+            return ip
+
+    def put(self, name, ip, ttl):
+        """Cache the result of a lookup.
+        @param name: domain name.
+        @param ip: IP address, or an empty string for a failed lookup.
+        @param ttl: seconds to cache the result for.
+        """
+        if ttl <= 0:
+            return
+
+        with self.lock:
+            self.entries.pop(name.lower(), None)
+            self.entries[name.lower()] = ip, time.time() + ttl
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+cache = DnsCache()
+
+def _skip_name(buf, offset):
+    """Skip a possibly compressed name in a DNS message."""
+    while True:
+        length = ord(buf[offset])
+        if length & 0xc0 == 0xc0:
+            return offset + 2
+
+        offset += 1
+        if not length:
+            return offset
+        offset += length
+
+def query(name, server, port=53):
+    """Look up the A record of a name at a name server, e.g., for resolving
+    through a dedicated name server rather than the resolver of the host.
+    Unlike the other resolvers this provides the TTL of the answer, or for
+    failed lookups the negative caching TTL of the zone (RFC 2308).
+    @param name: domain name.
+    @param server: IPv4 or IPv6 address of the name server, as returned by
+                   parse_server().
+    @param port: port of the name server.
+    @return: tuple of IP address, or empty string, and TTL.
+    """
+    labels = name.rstrip(".").split(".")
+    if not all(0 < len(label) < 64 for label in labels):
+        return "", DNS_NEGATIVE_TTL
+
+    try:
+        qname = str("".join(chr(len(label)) + label for label in labels))
+    except UnicodeError:
+        return "", DNS_NEGATIVE_TTL
+
+    qid = random.randint(0, 0xffff)
+    request = struct.pack(">HHHHHH", qid, 0x0100, 1, 0, 0, 0) + qname + \
+        struct.pack(">BHH", 0, DNS_TYPE_A, 1)
+
+    family = socket.AF_INET6 if ":" in server else socket.AF_INET
+    s = socket.socket(family, socket.SOCK_DGRAM)
+    s.settimeout(DNS_TIMEOUT)
+    try:
+        s.sendto(request, (server, port))
+        while True:
+            # Only the name server may answer the query.
+            buf, addr = s.recvfrom(4096)
+            if addr[:2] == (server, port) and buf[:2] == request[:2]:
+                break
+    except socket.timeout:
+        return DNS_TIMEOUT_VALUE, DNS_TIMEOUT_TTL
+    except socket.error:
+        return "", DNS_TIMEOUT_TTL
+    finally:
+        s.close()
+
+    try:
+        _, flags, qdcount, ancount, nscount, _ = \
+            struct.unpack_from(">HHHHHH", buf)
+
+        # Only an answer, or the lack of one, may be cached for long.
+        if flags & 0xf not in (DNS_RCODE_NOERROR, DNS_RCODE_NXDOMAIN):
+            return "", DNS_TIMEOUT_TTL
+
+        offset = 12
+        for _ in xrange(qdcount):
+            offset = _skip_name(buf, offset) + 4
+
+        # The answer may be preceded by CNAME records, which also limit the
+        # time the answer may be cached for.
+        ttls, negative_ttl = [], DNS_NEGATIVE_TTL
+        for idx in xrange(ancount + nscount):
+            offset = _skip_name(buf, offset)
+            rtype, _, ttl, length = struct.unpack_from(">HHIH", buf, offset)
+            offset += 10
+
+            if idx < ancount:
+                ttls.append(ttl)
+                if rtype == DNS_TYPE_A and length == 4:
+                    return (socket.inet_ntoa(buf[offset:offset+4]),
+                            min(ttls))
+            elif rtype == DNS_TYPE_SOA:
+                minimum = struct.unpack(">I", buf[offset+length-4:
+                                                  offset+length])[0]
+                negative_ttl = min(ttl, minimum)
+
+            offset += length
+    except (IndexError, struct.error):
+        return "", DNS_TIMEOUT_TTL
+
+    return "", negative_ttl
+
+def lookup(name, server=None):
+    """Resolve a name with the best available resolver.
+    @param name: domain name.
+    @param server: (IP address, port) of the name server to query, or None
+                   for the resolver of the host.
+    @return: tuple of IP address, or empty string, and TTL.
+    """
+    try:
+        if server:
+            return query(name, *server)
+
+        ip = resolve(name, _TIMED_OUT)
+    except Exception:
+        return "", DNS_TIMEOUT_TTL
+
+    if ip is _TIMED_OUT:
+        return DNS_TIMEOUT_VALUE, DNS_TIMEOUT_TTL
+    return ip, DNS_DEFAULT_TTL if ip else DNS_NEGATIVE_TTL
+
+def parse_server(server):
+    """Parse a name server address, e.g., "8.8.8.8", "127.0.0.1:5353",
+    "::1", or "[::1]:5353".
+    @return: tuple of the normalized IP address and port, or None.
+    @raise ValueError: if the address is not an IP address.
+    """
+    if not server:
+        return None
+
+    address, port = server, "53"
+    if server.startswith("[") and "]" in server:
+        address, port = server[1:].split("]", 1)
+        port = port[1:] if port.startswith(":") else port or "53"
+    elif server.count(":") == 1:
+        address, port = server.split(":")
+
+    for family in socket.AF_INET, socket.AF_INET6:
+        try:
+            address = socket.inet_ntop(family,
+                                       socket.inet_pton(family, address))
+            return address, int(port)
+        except (socket.error, ValueError):
+            pass
+
+    raise ValueError("Invalid name server %r, expected an IP address and "
+                     "optionally a port, e.g., 8.8.8.8, 127.0.0.1:5353 or "
+                     "[::1]:5353" % server)
+
+def resolve_many(names, workers=16, server=None):
+    """Resolve a batch of names concurrently, with a bounded amount of
+    lookups in flight. Names are served from the cache where possible and
+    the results, including failed lookups, are cached for their TTL.
+    @param names: domain names.
+    @param workers: maximum amount of concurrent lookups.
+    @param server: (IP address, port) of the name server to query, or None
+                   for the resolver of the host.
+    @return: dict mapping each name to its IP address, or an empty string.
+    """
+    results, todo = {}, []
+    for name in set(names):
+        ip = cache.get(name)
+        if ip is None:
+            todo.append(name)
+        else:
+            results[name] = ip
+
+    if not todo:
+        return results
+
+    pool = ThreadPool(max(1, min(workers, len(todo))))
+    try:
+        answers = pool.map(lambda name: lookup(name, server), todo)
+    finally:
+        pool.close()
+        pool.join()
+
+    for name, (ip, ttl) in zip(todo, answers):
+        cache.put(name, ip, ttl)
+        results[name] = ip
+    return results
@@ -0,0 +1,193 @@
+# Copyright (C) 2010-2013 Claudio Guarnieri.
+# Copyright (C) 2014-2015 Detector Foundation.
+# This file is part of Detector Sandbox - http://www.detectorsandbox.org
+# See the file 'docs/LICENSE' for copying permission.
+
+import hashlib
+import mmap
+import os
+import struct
+
+PAGE_READONLY = 0x00000002
+PAGE_READWRITE = 0x00000004
+PAGE_WRITECOPY = 0x00000008
+PAGE_EXECUTE = 0x00000010
+PAGE_EXECUTE_READ = 0x00000020
+PAGE_EXECUTE_READWRITE = 0x00000040
+PAGE_EXECUTE_WRITECOPY = 0x00000080
+
+MEM_IMAGE = 0x01000000
+
+page_access = {
+    PAGE_READONLY: "r",
+    PAGE_READWRITE: "rw",
+    PAGE_WRITECOPY: "rwc",
+    PAGE_EXECUTE: "rx",
+    PAGE_EXECUTE_READ: "rx",
+    PAGE_EXECUTE_READWRITE: "rwx",
+    PAGE_EXECUTE_WRITECOPY: "rwxc",
+}
+
+class MemoryRegion(object):
+    """A memory region of a process memory dump."""
+
+    def __init__(self, addr, size, state, typ, protect, offset, sha256):
+        self.addr = addr
+        self.size = size
+        self.state = state
+        self.type = typ
+        self.protect = protect
+        self.offset = offset
+        self.sha256 = sha256
+
+    @property
+    def access(self):
+        """Access rights, e.g., "rwx"."""
+        return page_access.get(self.protect)
+
+    def to_dict(self):
+        return {
+            "addr": "0x%08x" % self.addr,
+            "end": "0x%08x" % (self.addr + self.size),
+            "size": self.size,
+            "type": self.type,
+            "protect": self.access,
+            "offset": self.offset,
+        }
+
+class MemoryDump(object):
+    """Process memory dump with a region index.
+
+    The dump consists of a header followed by the contents of each memory
+    region. The index is written once next to the dump and holds the header,
+    the data offset, and the SHA256 hash of each region, so that regions can
+    be selected, deduplicated, and read through a memory map without walking
+    the dump again.
+    """
+
+    # Address, size, state, type, protection, as written by the analyzer.
+    HEADER = struct.Struct("QIIII")
+
+    # Dump size and amount of regions.
+    INDEX_HEADER = struct.Struct("<QI")
+
+    # Address, size, state, type, protection, data offset, SHA256 hash.
+    INDEX = struct.Struct("<QIIIIQ32s")
+
+    def __init__(self, path):
+        """@param path: path of the memory dump."""
+        self.path = path
+        self.index_path = path + ".idx"
+        self.regions = []
+        self._file = None
+        self._map = None
+
+    def build(self):
+        """Walk the dump, hashing each region, and write its index.
+        @return: list of regions.
+        """
+        self.regions = []
+
+        with open(self.path, "rb") as f:
+            while True:
+                buf = f.read(self.HEADER.size)
+                if len(buf) < self.HEADER.size:
+                    break
+
+                addr, size, state, typ, protect = self.HEADER.unpack(buf)
+                offset, h = f.tell(), hashlib.sha256()
+
+                remaining = size
+                while remaining:
+                    chunk = f.read(min(remaining, 1024*1024))
+                    if not chunk:
+                        break
+                    h.update(chunk)
+                    remaining -= len(chunk)
+
+                self.regions.append(MemoryRegion(
+                    addr, size, state, typ, protect, offset, h.digest()
+                ))
+
+        # The index is only used if complete, so write it atomically.
+        with open(self.index_path + ".tmp", "wb") as f:
+            f.write(self.INDEX_HEADER.pack(
+                os.path.getsize(self.path), len(self.regions)
+            ))
+            for r in self.regions:
+                f.write(self.INDEX.pack(
+                    r.addr, r.size, r.state, r.type, r.protect, r.offset,
+                    r.sha256
+                ))
+        os.rename(self.index_path + ".tmp", self.index_path)
+        return self.regions
+
+    def load(self):
+        """Load the index of the dump, if it's up-to-date.
+        @return: whether the index could be loaded.
+        """
+        if not os.path.isfile(self.index_path):
+            return False
+
+        with open(self.index_path, "rb") as f:
+            buf = f.read()
+
+        if len(buf) < self.INDEX_HEADER.size:
+            return False
+
+        size, count = self.INDEX_HEADER.unpack_from(buf)
+        if size != os.path.getsize(self.path) or \
+                len(buf) != self.INDEX_HEADER.size + count * self.INDEX.size:
+            return False
+
+        self.regions = []
+        for idx in xrange(count):
+            self.regions.append(MemoryRegion(*self.INDEX.unpack_from(
+                buf, self.INDEX_HEADER.size + idx * self.INDEX.size
+            )))
+        return True
+
+    def open(self):
+        """Load or build the index and map the dump into memory."""
+        if not self.load():
+            self.build()
+
+        if os.path.getsize(self.path):
+            self._file = open(self.path, "rb")
+            self._map = mmap.mmap(self._file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        return self
+
+    def close(self):
+        if self._map:
+            self._map.close()
+            self._file.close()
+        self._map = self._file = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def read(self, region):
+        """Read the contents of a region.
+        @param region: MemoryRegion.
+        @return: region data.
+        """
+        if not self._map:
+            return ""
+        return self._map[region.offset:region.offset+region.size]
+
+    def select(self, access=None):
+        """Select regions by their access rights.
+        @param access: required access rights, e.g., "x" for executable
+                       or "rwx", None for all regions.
+        @return: list of regions.
+        """
+        if not access:
+            return list(self.regions)
+
+        return [region for region in self.regions
+                if region.access and
+                all(c in region.access for c in access)]
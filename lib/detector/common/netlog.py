@@ -3,6 +3,7 @@
 # This file is part of Detector Sandbox - http://www.detectorsandbox.org
 # See the file 'docs/LICENSE' for copying permission.
 
+import cPickle
 import datetime
 import hashlib
 import logging
@@ -14,6 +15,7 @@ try:
     HAVE_BSON = True
 except ImportError:
     HAVE_BSON = False
+    HAVE_CBSON = False
 else:
     # The BSON module provided by pymongo works through its "BSON" class.
     if hasattr(bson, "BSON"):
@@ -23,6 +25,11 @@ else:
     elif hasattr(bson, "loads"):
         bson_decode = lambda d: bson.loads(d)
 
+    # Whether pymongo's C extension is available, which outperforms our own
+    # pure Python decoder for monitor messages.
+    HAVE_CBSON = hasattr(bson, "has_c") and bson.has_c()
+
+from lib.detector.common.behavior import MonitorSummary
 from lib.detector.common.utils import get_filename_from_path
 from lib.detector.common.exceptions import DetectorResultError
 
@@ -38,6 +45,13 @@ def pointer_converter_64bit(v):
     return "0x%016x" % (v % 2**64)
 
 def default_converter_32bit(v):
+    # Fast path for the most common argument types.
+    t = type(v)
+    if t is int or t is long:
+        return v % 2**32 if v < 0 else v
+    if t is unicode:
+        return v
+
     if isinstance(v, (int, long)) and v < 0:
         return v % 2**32
 
@@ -53,11 +67,83 @@ def default_converter_64bit(v):
     # if isinstance(v, (int, long)) and v < 0:
         # return v % 2**64
 
+    # Fast path for the most common argument types.
+    t = type(v)
+    if t is int or t is long or t is unicode:
+        return v
+
     # Try to avoid various unicode issues through usage of latin-1 encoding.
     if isinstance(v, str):
         return v.decode("latin-1")
     return v
 
+_unpack_int32 = struct.Struct("<i").unpack_from
+_unpack_int64 = struct.Struct("<q").unpack_from
+_unpack_double = struct.Struct("<d").unpack_from
+
+def _decode_document(data, offset, end, is_array):
+    """Decode the elements of a BSON document or array located at
+    data[offset:end], excluding the length prefix."""
+    ret = [] if is_array else {}
+
+    # The last byte is the terminating null byte of the document.
+    end -= 1
+    while offset < end:
+        etype = data[offset]
+        keyend = data.index("\x00", offset + 1)
+        key = data[offset+1:keyend]
+        offset = keyend + 1
+
+        if etype == "\x02":
+            length = _unpack_int32(data, offset)[0]
+            value = data[offset+4:offset+3+length].decode("utf8")
+            offset += 4 + length
+        elif etype == "\x10":
+            value = _unpack_int32(data, offset)[0]
+            offset += 4
+        elif etype == "\x03" or etype == "\x04":
+            length = _unpack_int32(data, offset)[0]
+            value = _decode_document(data, offset + 4, offset + length,
+                                     etype == "\x04")
+            offset += length
+        elif etype == "\x12":
+            value = _unpack_int64(data, offset)[0]
+            offset += 8
+        elif etype == "\x05" and data[offset+4] == "\x00":
+            length = _unpack_int32(data, offset)[0]
+            value = data[offset+5:offset+5+length]
+            offset += 5 + length
+        elif etype == "\x08":
+            value = data[offset] != "\x00"
+            offset += 1
+        elif etype == "\x0a":
+            value = None
+        elif etype == "\x01":
+            value = _unpack_double(data, offset)[0]
+            offset += 8
+        else:
+            raise ValueError("Unsupported BSON element type: %r" % etype)
+
+        if is_array:
+            ret.append(value)
+        else:
+            ret[key] = value
+
+    return ret
+
+def decode_monitor_message(data):
+    """Decode a BSON message as emitted by the monitor.
+
+    Only the element types actually used by the monitor are supported, i.e.,
+    strings, integers, doubles, booleans, null values, generic binary data,
+    and nested documents and arrays. Anything else raises a ValueError, in
+    which case the generic decoder should be used instead.
+    """
+    if _unpack_int32(data, 0)[0] != len(data) or data[-1] != "\x00":
+        raise ValueError("Invalid BSON message length")
+
+    return _decode_document(data, 4, len(data), False)
+
 class BsonParser(object):
     """Handle .bson logs from monitor. Basically we would like to directly pass through
     the parsed data structures, but the .bson logs need a bit special handling to be more space efficient.
@@ -169,172 +255,298 @@ class BsonParser(object):
                 log.critical("BsonParser lacking data.")
                 return
 
-            try:
-                dec = bson_decode(data)
-            except Exception as e:
-                log.warning("BsonParser decoding problem {0} on "
-                            "data[:50] {1}".format(e, repr(data[:50])))
+            dec = self.decode(data)
+            if dec is None:
                 return
 
-            mtype = dec.get("type", "none")
-            index = dec.get("I", -1)
-
-            if mtype == "info":
-                # API call index info message, explaining the argument names, etc.
-                name = dec.get("name", "NONAME")
-                arginfo = dec.get("args", [])
-                category = dec.get("category")
+            parsed = self.handle_message(dec)
+            if parsed is not None:
+                yield parsed
 
-                argnames, converters = self.determine_unserializers(arginfo)
-                self.infomap[index] = name, arginfo, argnames, converters, category
+    def decode(self, data):
+        """Decode a single raw BSON message.
+        @param data: raw message including its length prefix.
+        @return: decoded message or None if it could not be decoded.
+        """
+        if not HAVE_CBSON:
+            try:
+                return decode_monitor_message(data)
+            except (ValueError, IndexError, struct.error, UnicodeDecodeError):
+                pass
+
+        try:
+            return bson_decode(data)
+        except Exception as e:
+            log.warning("BsonParser decoding problem {0} on "
+                        "data[:50] {1}".format(e, repr(data[:50])))
+
+    def handle_message(self, dec):
+        """Translate a decoded monitor message into an event.
+        @param dec: decoded BSON message.
+        @return: event dictionary or None if the message doesn't result in
+                 an event (e.g., info and buffer messages).
+        """
+        mtype = dec.get("type", "none")
+        index = dec.get("I", -1)
+
+        if mtype == "info":
+            # API call index info message, explaining the argument names, etc.
+            name = dec.get("name", "NONAME")
+            arginfo = dec.get("args", [])
+            category = dec.get("category")
+
+            argnames, converters = self.determine_unserializers(arginfo)
+            argspec = tuple(zip(argnames, converters))
+            self.infomap[index] = name, arginfo, argnames, argspec, category
+
+            if dec.get("flags_value"):
+                self.flags_value[name] = {}
+                for arg, values in dec["flags_value"].items():
+                    self.flags_value[name][arg] = dict(values)
+
+            if dec.get("flags_bitmask"):
+                self.flags_bitmask[name] = {}
+                for arg, values in dec["flags_bitmask"].items():
+                    self.flags_bitmask[name][arg] = values
+            return
+
+        # Handle dumped buffers.
+        if mtype == "buffer":
+            buf = dec.get("buffer")
+            sha1 = dec.get("checksum")
+            self.buffer_sha1 = hashlib.sha1(buf).hexdigest()
+
+            # Why do we pass along a sha1 checksum again?
+            if sha1 != self.buffer_sha1:
+                log.warning("Incorrect sha1 passed along for a buffer.")
+
+            # If the parent is netlogs ResultHandler (or one of the event
+            # loop's connections) then we actually dump it - this should only
+            # be the case during the analysis, any after processing will then
+            # be ignored.
+            from lib.detector.core.resultserver import ResultHandler
+            from lib.detector.core.resultserver import ResultConnection
+
+            if isinstance(self.fd, (ResultHandler, ResultConnection)):
+                filepath = os.path.join(self.fd.storagepath,
+                                        "buffer", self.buffer_sha1)
+                with open(filepath, "wb") as f:
+                    f.write(buf)
+
+            return
+
+        tid = dec.get("T", 0)
+        time = dec.get("t", 0)
+
+        parsed = {
+            "type": mtype,
+            "tid": tid,
+            "time": time,
+        }
+
+        if mtype == "debug":
+            log.info("Debug message from monitor: {0}".format(dec.get("msg", "")))
+            parsed["message"] = dec.get("msg", "")
+
+        else:
+            # Regular api call from monitor
+            if index not in self.infomap:
+                log.warning("Got API with unknown index - monitor needs "
+                            "to explain first: {0}".format(dec))
+                return
 
-                if dec.get("flags_value"):
-                    self.flags_value[name] = {}
-                    for arg, values in dec["flags_value"].items():
-                        self.flags_value[name][arg] = dict(values)
+            apiname, arginfo, argnames, argspec, category = self.infomap[index]
+            args = dec.get("args", [])
 
-                if dec.get("flags_bitmask"):
-                    self.flags_bitmask[name] = {}
-                    for arg, values in dec["flags_bitmask"].items():
-                        self.flags_bitmask[name][arg] = values
-                continue
+            if len(args) != len(argnames):
+                log.warning("Inconsistent arg count (compared to arg names) "
+                            "on {2}: {0} names {1}".format(dec, argnames,
+                                                           apiname))
+                return
 
-            # Handle dumped buffers.
-            if mtype == "buffer":
-                buf = dec.get("buffer")
-                sha1 = dec.get("checksum")
-                self.buffer_sha1 = hashlib.sha1(buf).hexdigest()
+            argdict = {}
+            for (name, converter), value in zip(argspec, args):
+                argdict[name] = converter(value)
 
-                # Why do we pass along a sha1 checksum again?
-                if sha1 != self.buffer_sha1:
-                    log.warning("Incorrect sha1 passed along for a buffer.")
+            # Special new process message from the monitor.
+            if apiname == "__process__":
+                parsed["type"] = "process"
 
-                # If the parent is netlogs ResultHandler then we actually dump
-                # it - this should only be the case during the analysis, any
-                # after processing will then be ignored.
-                from lib.detector.core.resultserver import ResultHandler
+                if "TimeLow" in argdict:
+                    timelow = argdict["TimeLow"]
+                    timehigh = argdict["TimeHigh"]
 
-                if isinstance(self.fd, ResultHandler):
-                    filepath = os.path.join(self.fd.storagepath,
-                                            "buffer", self.buffer_sha1)
-                    with open(filepath, "wb") as f:
-                        f.write(buf)
+                    parsed["pid"] = pid = argdict["ProcessIdentifier"]
+                    parsed["ppid"] = argdict["ParentProcessIdentifier"]
+                    modulepath = argdict["ModulePath"]
 
-                continue
+                elif "time_low" in argdict:
+                    timelow = argdict["time_low"]
+                    timehigh = argdict["time_high"]
 
-            tid = dec.get("T", 0)
-            time = dec.get("t", 0)
+                    if "pid" in argdict:
+                        parsed["pid"] = pid = argdict["pid"]
+                        parsed["ppid"] = argdict["ppid"]
+                    else:
+                        parsed["pid"] = pid = argdict["process_identifier"]
+                        parsed["ppid"] = argdict["parent_process_identifier"]
 
-            parsed = {
-                "type": mtype,
-                "tid": tid,
-                "time": time,
-            }
+                    modulepath = argdict["module_path"]
 
-            if mtype == "debug":
-                log.info("Debug message from monitor: {0}".format(dec.get("msg", "")))
-                parsed["message"] = dec.get("msg", "")
+                else:
+                    raise DetectorResultError("I don't recognise the bson log contents.")
 
-            else:
-                # Regular api call from monitor
-                if index not in self.infomap:
-                    log.warning("Got API with unknown index - monitor needs "
-                                "to explain first: {0}".format(dec))
-                    continue
-
-                apiname, arginfo, argnames, converters, category = self.infomap[index]
-                args = dec.get("args", [])
-
-                if len(args) != len(argnames):
-                    log.warning("Inconsistent arg count (compared to arg names) "
-                                "on {2}: {0} names {1}".format(dec, argnames,
-                                                               apiname))
-                    continue
-
-                argdict = {}
-                for idx, value in enumerate(args):
-                    argdict[argnames[idx]] = converters[idx](value)
-
-                # Special new process message from the monitor.
-                if apiname == "__process__":
-                    parsed["type"] = "process"
-
-                    if "TimeLow" in argdict:
-                        timelow = argdict["TimeLow"]
-                        timehigh = argdict["TimeHigh"]
-
-                        parsed["pid"] = pid = argdict["ProcessIdentifier"]
-                        parsed["ppid"] = argdict["ParentProcessIdentifier"]
-                        modulepath = argdict["ModulePath"]
-
-                    elif "time_low" in argdict:
-                        timelow = argdict["time_low"]
-                        timehigh = argdict["time_high"]
-
-                        if "pid" in argdict:
-                            parsed["pid"] = pid = argdict["pid"]
-                            parsed["ppid"] = argdict["ppid"]
-                        else:
-                            parsed["pid"] = pid = argdict["process_identifier"]
-                            parsed["ppid"] = argdict["parent_process_identifier"]
-
-                        modulepath = argdict["module_path"]
+                # FILETIME is 100-nanoseconds from 1601 :/
+                vmtimeunix = (timelow + (timehigh << 32))
+                vmtimeunix = vmtimeunix / 10000000.0 - 11644473600
+                vmtime = datetime.datetime.fromtimestamp(vmtimeunix)
+                parsed["first_seen"] = vmtime
 
-                    else:
-                        raise DetectorResultError("I don't recognise the bson log contents.")
+                procname = get_filename_from_path(modulepath)
+                parsed["process_path"] = modulepath
+                parsed["process_name"] = procname
+                parsed["command_line"] = argdict.get("command_line")
 
-                    # FILETIME is 100-nanoseconds from 1601 :/
-                    vmtimeunix = (timelow + (timehigh << 32))
-                    vmtimeunix = vmtimeunix / 10000000.0 - 11644473600
-                    vmtime = datetime.datetime.fromtimestamp(vmtimeunix)
-                    parsed["first_seen"] = vmtime
+                # Is this a 64-bit process?
+                if argdict.get("is_64bit"):
+                    self.is_64bit = True
 
-                    procname = get_filename_from_path(modulepath)
-                    parsed["process_path"] = modulepath
-                    parsed["process_name"] = procname
-                    parsed["command_line"] = argdict.get("command_line")
+                # Is this process being "tracked"?
+                parsed["track"] = bool(argdict.get("track", 1))
 
-                    # Is this a 64-bit process?
-                    if argdict.get("is_64bit"):
-                        self.is_64bit = True
+                self.pid = pid
 
-                    # Is this process being "tracked"?
-                    parsed["track"] = bool(argdict.get("track", 1))
+            elif apiname == "__thread__":
+                parsed["pid"] = pid = argdict["ProcessIdentifier"]
 
-                    self.pid = pid
+            # elif apiname == "__anomaly__":
+                # tid = argdict["ThreadIdentifier"]
+                # subcategory = argdict["Subcategory"]
+                # msg = argdict["Message"]
+                # self.handler.log_anomaly(subcategory, tid, msg)
+                # return True
 
-                elif apiname == "__thread__":
-                    parsed["pid"] = pid = argdict["ProcessIdentifier"]
+            else:
+                parsed = {
+                    "type": "apicall",
+                    "tid": tid,
+                    "time": time,
+                    "pid": self.pid,
+                    "api": apiname,
+                    "category": category,
+                    "status": argdict.pop("is_success", 1),
+                    "return_value": argdict.pop("retval", 0),
+                    "arguments": argdict,
+                    "flags": {},
+                    "stacktrace": dec.get("s", []),
+                    "uniqhash": dec.get("h", 0),
+                }
+
+                if "e" in dec and "E" in dec:
+                    parsed["last_error"] = dec["e"]
+                    parsed["nt_status"] = dec["E"]
+
+                if apiname in self.flags_value:
+                    self.resolve_flags(apiname, argdict, parsed["flags"])
+
+                if self.buffer_sha1:
+                    parsed["buffer"] = self.buffer_sha1
+                    self.buffer_sha1 = None
+
+        return parsed
+
+class BsonSidecar(object):
+    """Pre-decoded events of a BSON log.
+
+    When enabled the ResultServer stores each event of a BSON log, as decoded
+    during the analysis, in a sidecar file. Once the connection has been
+    closed cleanly a summary with the process information, the API call
+    counters, and the generic behavior events is written as well. The
+    behavior processing then uses these instead of decoding the log again.
+    """
 
-                # elif apiname == "__anomaly__":
-                    # tid = argdict["ThreadIdentifier"]
-                    # subcategory = argdict["Subcategory"]
-                    # msg = argdict["Message"]
-                    # self.handler.log_anomaly(subcategory, tid, msg)
-                    # return True
+    # Amount of events pickled together.
+    BATCH_SIZE = 1024
+
+    def __init__(self, path):
+        """@param path: path of the sidecar files, without extension."""
+        self.events_path = path + ".events"
+        self.summary_path = path + ".summary"
+        self.fd = None
+        self.events = []
+        self.stats = None
+
+    def add(self, event):
+        """Store an event as it comes out of the BsonParser."""
+        if event["type"] == "process":
+            # The summary is generated just like the behavior processing
+            # would do it.
+            self.stats = MonitorSummary()
+            self.fd = open(self.events_path, "wb")
+
+        # Events preceding the process event are never used.
+        if not self.fd:
+            return
+
+        self.stats.add(event)
+        self.events.append(event)
+        if len(self.events) >= self.BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.events:
+            cPickle.dump(self.events, self.fd, cPickle.HIGHEST_PROTOCOL)
+            self.events = []
+
+    def close(self, complete=True):
+        """Finalize the sidecar files.
+        @param complete: whether the entire log was parsed successfully,
+                         if not the sidecar files are discarded.
+        """
+        if not self.fd:
+            return
+
+        self.flush()
+        self.fd.close()
+        self.fd = None
+
+        if not complete:
+            os.unlink(self.events_path)
+            return
+
+        summary = self.stats.results()
+
+        # The summary marks the sidecar as complete, so write it atomically.
+        with open(self.summary_path + ".tmp", "wb") as f:
+            cPickle.dump(summary, f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(self.summary_path + ".tmp", self.summary_path)
+
+    def complete(self):
+        """Whether the sidecar files are complete and thus usable."""
+        return os.path.isfile(self.summary_path) and \
+            os.path.isfile(self.events_path)
+
+    def summary(self):
+        """Load the summary.
+        @return: summary dictionary or None if the sidecar is incomplete.
+        """
+        if not self.complete():
+            return
+
+        try:
+            with open(self.summary_path, "rb") as f:
+                return cPickle.load(f)
+        except Exception as e:
+            log.warning("Error loading sidecar summary %s: %s",
+                        self.summary_path, e)
 
-                else:
-                    parsed["type"] = "apicall"
-                    parsed["pid"] = self.pid
-                    parsed["api"] = apiname
-                    parsed["category"] = category
-                    parsed["status"] = argdict.pop("is_success", 1)
-                    parsed["return_value"] = argdict.pop("retval", 0)
-                    parsed["arguments"] = argdict
-                    parsed["flags"] = {}
-
-                    parsed["stacktrace"] = dec.get("s", [])
-                    parsed["uniqhash"] = dec.get("h", 0)
-
-                    if "e" in dec and "E" in dec:
-                        parsed["last_error"] = dec["e"]
-                        parsed["nt_status"] = dec["E"]
-
-                    if apiname in self.flags_value:
-                        self.resolve_flags(apiname, argdict, parsed["flags"])
-
-                    if self.buffer_sha1:
-                        parsed["buffer"] = self.buffer_sha1
-                        self.buffer_sha1 = None
-
-            yield parsed
+    def __iter__(self):
+        with open(self.events_path, "rb") as f:
+            while True:
+                try:
+                    events = cPickle.load(f)
+                except EOFError:
+                    return
+
+                for event in events:
+                    yield event
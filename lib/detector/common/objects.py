@@ -1,10 +1,13 @@
 import binascii
+import cPickle
 import hashlib
 import logging
 import mmap
 import os
 import re
 import subprocess
+import threading
+import time
 from lib.detector.common.constants import DETECTOR_ROOT
 from lib.detector.common.whitelist import is_whitelisted_domain
 
@@ -42,6 +45,10 @@ log = logging.getLogger(__name__)
 
 FILE_CHUNK_SIZE = 16 * 1024
 
+# Files up to this size are read into memory once and all of their analysis
+# is done on that copy. Bigger files are streamed or mapped instead.
+FILE_BUFFER_LIMIT = 64 * 1024 * 1024
+
 URL_REGEX = (
     # HTTP/HTTPS.
     "(https?:\\/\\/)"
@@ -59,6 +66,168 @@ URL_REGEX = (
     "(/[\\(\\)a-zA-Z0-9_:%?=/\\.-]*)?"
 )
 
+def find_urls(data):
+    """Find all URLs embedded in a buffer through a simple regex. URLs of
+    whitelisted domains are included, so that the result can be cached
+    regardless of the whitelist, see filter_urls().
+    @param data: buffer, e.g., a string or mmap.
+    @return: list of unique (URL, domain) tuples.
+    """
+    # http://stackoverflow.com/a/454589
+    urls = set()
+    for url in re.findall(URL_REGEX, data):
+        urls.add(("".join(url), url[1]))
+    return list(urls)
+
+def filter_urls(urls):
+    """Leave out the URLs of whitelisted domains.
+    @param urls: (URL, domain) tuples as returned by find_urls().
+    @return: list of URLs.
+    """
+    return [url for url, domain in urls if not is_whitelisted_domain(domain)]
+
+# Loaded libmagic handles per process and flags, as loading the magic
+# database is far more expensive than identifying a file.
+_magic_handles = {}
+_magic_lock = threading.Lock()
+
+def magic_file(file_path, mime=False):
+    """Identify a file through libmagic, falling back to file(1).
+    @param file_path: file path.
+    @param mime: return the MIME type rather than a description.
+    @return: file type or None.
+    """
+    file_type = None
+    if HAVE_MAGIC:
+        try:
+            with _magic_lock:
+                key = os.getpid(), mime
+                if key not in _magic_handles:
+                    ms = magic.open(magic.MAGIC_MIME if mime else
+                                    magic.MAGIC_NONE)
+                    ms.load()
+                    _magic_handles[key] = ms
+
+                file_type = _magic_handles[key].file(file_path)
+        except Exception:
+            try:
+                file_type = magic.from_file(file_path, mime=mime)
+            except Exception as e:
+                log.debug("Error getting magic from file %s: %s",
+                          file_path, e)
+
+    if file_type is None:
+        args = ["file", "-b", file_path]
+        if mime:
+            args.insert(2, "--mime-type")
+
+        try:
+            file_type = subprocess.check_output(args).strip()
+        except Exception as e:
+            log.debug("Error running file(1) on %s: %s", file_path, e)
+
+    return file_type
+
+class FileCache(object):
+    """On-disk cache of the analysis results of files, keyed by their SHA256
+    hash, so that the same file seen across many tasks is analyzed once. The
+    least recently used entries are evicted once the cache grows too large,
+    or when they have not been used for too long."""
+
+    # Minimum amount of seconds between two evictions by the same process.
+    EVICT_INTERVAL = 600
+
+    def __init__(self, path, max_size=0, max_age=0):
+        """@param path: cache directory.
+        @param max_size: maximum size of the cache in bytes, 0 for no limit.
+        @param max_age: seconds after which unused entries are evicted, 0
+                        for no limit.
+        """
+        self.path = path
+        self.max_size = max_size
+        self.max_age = max_age
+        self.evicted = 0
+
+    def _path(self, sha256):
+        return os.path.join(self.path, sha256[:2], sha256)
+
+    def get(self, sha256):
+        """Get the cached results of a file.
+        @param sha256: SHA256 hash of the file.
+        @return: dict of results.
+        """
+        path = self._path(sha256)
+        try:
+            with open(path, "rb") as f:
+                results = cPickle.load(f)
+        except (IOError, EOFError, cPickle.UnpicklingError):
+            return {}
+
+        # The modification time tells when an entry was last used.
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return results
+
+    def put(self, sha256, results):
+        """Store the results of a file.
+        @param sha256: SHA256 hash of the file.
+        @param results: dict of results.
+        """
+        path = self._path(sha256)
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                pass
+
+        # Concurrent writers each write their own file, the last one wins.
+        tmp_path = "%s.%d.%d" % (path, os.getpid(), threading.current_thread().ident)
+        try:
+            with open(tmp_path, "wb") as f:
+                cPickle.dump(results, f, cPickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_path, path)
+        except (IOError, OSError) as e:
+            log.warning("Unable to cache the results of file %s: %s",
+                        sha256, e)
+
+        if (self.max_size or self.max_age) and \
+                time.time() - self.evicted >= self.EVICT_INTERVAL:
+            self.evict()
+
+    def evict(self):
+        """Evict the least recently used entries that exceed the maximum
+        size or age of the cache.
+        @return: amount of evicted entries.
+        """
+        self.evicted = now = time.time()
+
+        entries = []
+        for dirpath, dirnames, filenames in os.walk(self.path):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+
+        count, size = 0, 0
+        for mtime, length, path in sorted(entries, reverse=True):
+            size += length
+            if (self.max_size and size > self.max_size) or \
+                    (self.max_age and now - mtime > self.max_age):
+                try:
+                    os.unlink(path)
+                    count += 1
+                except OSError:
+                    pass
+
+        if count:
+            log.debug("Evicted %d entries from the file cache", count)
+        return count
+
 class Dictionary(dict):
     """Detector custom dict."""
 
@@ -95,6 +264,10 @@ class File(object):
     # thus we can cache them. If they are updated, one should restart Detector
     # or the processing tasks.
     yara_rules = {}
+    yara_versions = {}
+
+    # Optional FileCache shared by all files.
+    cache = None
 
     def __init__(self, file_path):
         """@param file_path: file path."""
@@ -107,6 +280,10 @@ class File(object):
         self._sha1 = None
         self._sha256 = None
         self._sha512 = None
+        self._size = None
+        self._results = None
+        self._dirty = False
+        self._pe = None
 
     def get_name(self):
         """Get file name.
@@ -136,6 +313,11 @@ class File(object):
                     break
                 yield chunk
 
+    def buffered(self):
+        """Is this file small enough to be read into memory once, for all of
+        its analysis?"""
+        return self.get_size() <= FILE_BUFFER_LIMIT
+
     def calc_hashes(self):
         """Calculate all possible hashes for this file."""
         crc = 0
@@ -144,7 +326,8 @@ class File(object):
         sha256 = hashlib.sha256()
         sha512 = hashlib.sha512()
 
-        for chunk in self.get_chunks():
+        chunks = [self.file_data] if self.buffered() else self.get_chunks()
+        for chunk in chunks:
             crc = binascii.crc32(chunk, crc)
             md5.update(chunk)
             sha1.update(chunk)
@@ -160,15 +343,44 @@ class File(object):
 
     @property
     def file_data(self):
-        if not self._file_data:
-            self._file_data = open(self.file_path, "rb").read()
+        if self._file_data is None:
+            with open(self.file_path, "rb") as f:
+                self._file_data = f.read()
         return self._file_data
 
+    def _cached(self, key, func, *args):
+        """Get a result of this file from the cache, computing it if needed.
+        Computed results are only stored in the cache by store_cache(). In
+        any case every result is only computed once per File object.
+        @param key: name of the result.
+        @param func: function computing the result.
+        @return: the result.
+        """
+        if self._results is None:
+            self._results = {}
+            if File.cache:
+                self._results = File.cache.get(self.get_sha256())
+
+        if key not in self._results:
+            self._results[key] = func(*args)
+            self._dirty = True
+
+        return self._results[key]
+
+    def store_cache(self):
+        """Store the results computed for this file in the cache, at once
+        rather than for each result."""
+        if File.cache and self._dirty:
+            File.cache.put(self.get_sha256(), self._results)
+        self._dirty = False
+
     def get_size(self):
         """Get file size.
         @return: file size.
         """
-        return os.path.getsize(self.file_path)
+        if self._size is None:
+            self._size = os.path.getsize(self.file_path)
+        return self._size
 
     def get_crc32(self):
         """Get CRC32.
@@ -221,7 +433,12 @@ class File(object):
                 log.warning("Unable to import pydeep (install with `pip install pydeep`)")
             return None
 
+        return self._cached("ssdeep", self._get_ssdeep)
+
+    def _get_ssdeep(self):
         try:
+            if self.buffered():
+                return pydeep.hash_buf(self.file_data)
             return pydeep.hash_file(self.file_path)
         except Exception:
             return None
@@ -230,69 +447,20 @@ class File(object):
         """Get MIME file type.
         @return: file type.
         """
-        file_type = None
-        if HAVE_MAGIC:
-            try:
-                ms = magic.open(magic.MAGIC_NONE)
-                ms.load()
-                file_type = ms.file(self.file_path)
-            except Exception as e:
-                try:
-                    file_type = magic.from_file(self.file_path)
-                except Exception as e:
-                    log.debug("Error getting magic from file %s: %s",
-                              self.file_path, e)
-            finally:
-                try:
-                    ms.close()
-                except:
-                    pass
-
-        if file_type is None:
-            try:
-                p = subprocess.Popen(["file", "-b", self.file_path],
-                                     stdout=subprocess.PIPE)
-                file_type = p.stdout.read().strip()
-            except Exception as e:
-                log.debug("Error running file(1) on %s: %s",
-                          self.file_path, e)
-
-        return file_type
+        return self._cached("type", magic_file, self.file_path)
 
     def get_content_type(self):
         """Get MIME content file type (example: image/jpeg).
         @return: file content type.
         """
-        file_type = None
-        if HAVE_MAGIC:
-            try:
-                ms = magic.open(magic.MAGIC_MIME)
-                ms.load()
-                file_type = ms.file(self.file_path)
-            except:
-                try:
-                    file_type = magic.from_file(self.file_path, mime=True)
-                except:
-                    pass
-            finally:
-                try:
-                    ms.close()
-                except:
-                    pass
-
-        if file_type is None:
-            try:
-                args = ["file", "-b", "--mime-type", self.file_path]
-                file_type = subprocess.check_output(args).strip()
-            except:
-                pass
+        return self._cached("content_type", magic_file, self.file_path, True)
 
-        return file_type
-
-    def get_exported_functions(self):
-        """Get the exported function names of this PE file."""
-        filetype = self.get_type()
-        if "MS-DOS" not in filetype and "PE32" not in self.get_type():
+    def _get_pe(self):
+        """Parse this file as PE file, only once.
+        @return: pefile.PE object or None.
+        """
+        filetype = self.get_type() or ""
+        if "MS-DOS" not in filetype and "PE32" not in filetype:
             return
 
         if not HAVE_PEFILE:
@@ -301,43 +469,55 @@ class File(object):
                 log.warning("Unable to import pefile (`pip install pefile`)")
             return
 
-        try:
-            pe = pefile.PE(self.file_path)
-            if not hasattr(pe, "DIRECTORY_ENTRY_EXPORT"):
-                return
+        if self._pe is None:
+            try:
+                if self.buffered():
+                    self._pe = pefile.PE(data=self.file_data)
+                else:
+                    self._pe = pefile.PE(self.file_path)
+            except Exception as e:
+                log.warning("Error parsing PE file: %s", e)
+                self._pe = False
+
+        return self._pe or None
+
+    def get_exported_functions(self):
+        """Get the exported function names of this PE file."""
+        return self._cached("exports", self._get_exported_functions)
 
-            for export in pe.DIRECTORY_ENTRY_EXPORT.symbols:
-                if export.name:
-                    yield export.name
+    def _get_exported_functions(self):
+        pe = self._get_pe()
+        if not pe or not hasattr(pe, "DIRECTORY_ENTRY_EXPORT"):
+            return []
+
+        try:
+            return [export.name for export in pe.DIRECTORY_ENTRY_EXPORT.symbols
+                    if export.name]
         except Exception as e:
             log.warning("Error enumerating exported functions: %s", e)
+            return []
 
     def get_imported_functions(self):
         """Get the imported functions of this PE file."""
-        filetype = self.get_type()
-        if "MS-DOS" not in filetype and "PE32" not in self.get_type():
-            return
+        return self._cached("imports", self._get_imported_functions)
 
-        if not HAVE_PEFILE:
-            if not File.notified_pefile:
-                File.notified_pefile = True
-                log.warning("Unable to import pefile (`pip install pefile`)")
-            return
+    def _get_imported_functions(self):
+        pe = self._get_pe()
+        if not pe or not hasattr(pe, "DIRECTORY_ENTRY_IMPORT"):
+            return []
 
+        ret = []
         try:
-            pe = pefile.PE(self.file_path)
-            if not hasattr(pe, "DIRECTORY_ENTRY_IMPORT"):
-                return
-
             for imp in pe.DIRECTORY_ENTRY_IMPORT:
                 for entry in imp.imports:
-                    yield dict(dll=imp.dll,
-                               name=entry.name,
-                               ordinal=entry.ordinal,
-                               hint=entry.hint,
-                               address=entry.address)
+                    ret.append(dict(dll=imp.dll,
+                                    name=entry.name,
+                                    ordinal=entry.ordinal,
+                                    hint=entry.hint,
+                                    address=entry.address))
         except Exception as e:
             log.warning("Error enumerating imported functions: %s", e)
+        return ret
 
     def get_apk_entry(self):
         """Get the entry point for this APK. The entry point is denoted by a
@@ -385,7 +565,8 @@ class File(object):
 
         return "", ""
 
-    def _yara_encode_string(self, s):
+    @staticmethod
+    def _yara_encode_string(s):
         # Beware, spaghetti code ahead.
         try:
             new = s.encode("utf-8")
@@ -396,7 +577,8 @@ class File(object):
 
         return new
 
-    def _yara_matches_177(self, matches):
+    @classmethod
+    def _yara_matches_177(cls, matches):
         """Extract matches from the Yara output for version 1.7.7."""
         ret = []
         for _, rule_matches in matches.items():
@@ -404,7 +586,7 @@ class File(object):
                 strings = set()
 
                 for s in match["strings"]:
-                    strings.add(self._yara_encode_string(s["data"]))
+                    strings.add(cls._yara_encode_string(s["data"]))
 
                 ret.append({
                     "name": match["rule"],
@@ -414,47 +596,61 @@ class File(object):
 
         return ret
 
-    def get_yara(self, category="binaries"):
-        """Get Yara signatures matches.
-        @return: matched Yara signatures.
+    @classmethod
+    def load_yara(cls, category):
+        """Get the Yara rules of a category, compiling them the first time.
+        @param category: rules category.
+        @return: compiled rules or None.
         """
-        results = []
-
         if not HAVE_YARA:
             if not File.notified_yara:
                 File.notified_yara = True
                 log.warning("Unable to import yara (please compile from sources)")
-            return results
+            return
 
-        # Compile the Yara rules only the first time.
         if category not in File.yara_rules:
-            rulepath = self.YARA_RULEPATH % category
+            rulepath = cls.YARA_RULEPATH % category
             if not os.path.exists(rulepath):
                 log.warning("The specified rule file at %s doesn't exist, "
                             "skip", rulepath)
-                return results
+                return
 
             try:
                 File.yara_rules[category] = yara.compile(rulepath)
+                File.yara_versions[category] = os.path.getmtime(rulepath)
             except:
                 log.exception("Error compiling the Yara rules.")
                 return
 
-        if not os.path.getsize(self.file_path):
-            return results
+        return File.yara_rules[category]
+
+    @classmethod
+    def match_yara(cls, category, data=None, path=None):
+        """Match the Yara rules of a category against a buffer or a file.
+        @param category: rules category.
+        @param data: buffer to match.
+        @param path: path of the file to match, if no buffer is given.
+        @return: matched Yara signatures.
+        """
+        rules = cls.load_yara(category)
+        if not rules:
+            return []
+
+        results = []
 
         try:
-            matches = File.yara_rules[category].match(self.file_path)
+            if data is not None:
+                matches = rules.match(data=data)
+            else:
+                matches = rules.match(path)
 
             if getattr(yara, "__version__", None) == "1.7.7":
-                return self._yara_matches_177(matches)
-
-            results = []
+                return cls._yara_matches_177(matches)
 
             for match in matches:
                 strings = set()
                 for s in match.strings:
-                    strings.add(self._yara_encode_string(s[2]))
+                    strings.add(cls._yara_encode_string(s[2]))
 
                 results.append({
                     "name": match.rule,
@@ -467,23 +663,41 @@ class File(object):
 
         return results
 
+    def get_yara(self, category="binaries"):
+        """Get Yara signatures matches.
+        @return: matched Yara signatures.
+        """
+        if not File.load_yara(category) or not self.get_size():
+            return []
+
+        # Cached results are only valid for the same version of the rules.
+        key = "yara:%s:%s" % (category, File.yara_versions[category])
+        return self._cached(key, self._get_yara, category)
+
+    def _get_yara(self, category):
+        if self.buffered():
+            return File.match_yara(category, data=self.file_data)
+        return File.match_yara(category, path=self.file_path)
+
     def get_urls(self):
         """Extract all URLs embedded in this file through a simple regex."""
-        if not os.path.getsize(self.file_path):
+        if not self.get_size():
             return []
 
-        # http://stackoverflow.com/a/454589
-        urls = set()
-        f = open(self.file_path, "rb")
+        # The whitelist may have changed since the URLs have been cached.
+        return filter_urls(self._cached("url_domains", self._find_urls))
 
-        #m = mmap.mmap(f.fileno(), 0, access=mmap.PROT_READ)
-        m = mmap.mmap(f.fileno(), 0)
+    def _find_urls(self):
+        if self.buffered():
+            return find_urls(self.file_data)
 
-        for url in re.findall(URL_REGEX, m):
-            if not is_whitelisted_domain(url[1]):
-                urls.add("".join(url))
-
-        return list(urls)
+        f = open(self.file_path, "rb")
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return find_urls(data)
+        finally:
+            data.close()
+            f.close()
 
     def get_all(self):
         """Get all information available.
@@ -502,4 +716,5 @@ class File(object):
         infos["type"] = self.get_type()
         infos["yara"] = self.get_yara()
         infos["urls"] = self.get_urls()
+        self.store_cache()
         return infos
@@ -0,0 +1,138 @@
+# Copyright (C) 2010-2013 Claudio Guarnieri.
+# Copyright (C) 2014-2015 Detector Foundation.
+# This file is part of Detector Sandbox - http://www.detectorsandbox.org
+# See the file 'docs/LICENSE' for copying permission.
+
+import collections
+import re
+
+# Characters considered to be part of a string.
+PRINTABLE = "\x1f-\x7e"
+
+# Amount of bytes read at once.
+CHUNK_SIZE = 4 * 1024 * 1024
+
+def _printable(c):
+    return "\x1f" <= c <= "\x7e"
+
+def _ascii_cut(buf, matches, min_length):
+    """Offset of the ASCII string at the end of the buffer, which may
+    continue in the next chunk."""
+    if matches and matches[-1].end() == len(buf):
+        return matches[-1].start()
+
+    # Otherwise any trailing run of characters is too short to be a match.
+    idx = len(buf)
+    while idx > len(buf) - min_length and idx and _printable(buf[idx-1]):
+        idx -= 1
+    return idx
+
+def _wide_cut(buf, matches, min_length):
+    """Offset of the UTF-16LE string at the end of the buffer, which may
+    continue in the next chunk."""
+    # A match may continue if it's at most followed by the first byte of
+    # another character.
+    if matches and (matches[-1].end() == len(buf) or
+                    (matches[-1].end() == len(buf) - 1 and
+                     _printable(buf[-1]))):
+        return matches[-1].start()
+
+    idx = len(buf)
+    if idx and _printable(buf[idx-1]):
+        idx -= 1
+
+    # Otherwise any trailing run of characters is too short to be a match.
+    end = idx
+    while idx > end - 2 * min_length and idx > 1 and \
+            buf[idx-1] == "\x00" and _printable(buf[idx-2]):
+        idx -= 2
+    return idx
+
+def iter_strings(f, min_length=6, chunk_size=CHUNK_SIZE):
+    """Extract the ASCII and UTF-16LE strings of a file in a single pass
+    over its contents, reading one chunk at a time. Strings that straddle
+    two chunks are carried over to the next one, so memory usage is bounded
+    by the chunk size (plus the length of the longest string).
+    @param f: file object.
+    @param min_length: minimum amount of characters of a string.
+    @param chunk_size: amount of bytes read at once.
+    @return: generator of (unicode, string) tuples, where unicode indicates
+             whether the string was encoded as UTF-16LE.
+    """
+    ascii_re = re.compile("[%s]{%d,}" % (PRINTABLE, min_length))
+    wide_re = re.compile("(?:[%s]\x00){%d,}" % (PRINTABLE, min_length))
+
+    buf, ascii_pos, wide_pos = "", 0, 0
+    while True:
+        chunk = f.read(chunk_size)
+        buf += chunk
+
+        ascii_matches = list(ascii_re.finditer(buf, ascii_pos))
+        wide_matches = list(wide_re.finditer(buf, wide_pos))
+
+        if chunk:
+            ascii_cut = _ascii_cut(buf, ascii_matches, min_length)
+            wide_cut = _wide_cut(buf, wide_matches, min_length)
+        else:
+            ascii_cut = wide_cut = len(buf)
+
+        for m in ascii_matches:
+            if m.start() < ascii_cut:
+                yield False, m.group()
+
+        for m in wide_matches:
+            if m.start() < wide_cut:
+                yield True, str(m.group().decode("utf-16le"))
+
+        if not chunk:
+            break
+
+        # Only keep what may be part of a string continuing in the next chunk.
+        carry = min(ascii_cut, wide_cut)
+        buf = buf[carry:]
+        ascii_pos, wide_pos = ascii_cut - carry, wide_cut - carry
+
+def extract_strings(f, min_length=6, max_count=0, dedup=False,
+                    chunk_size=CHUNK_SIZE):
+    """Extract the strings of a file, see iter_strings(). As before, the
+    ASCII strings are listed before the UTF-16LE strings.
+    @param f: file path or file object.
+    @param min_length: minimum amount of characters of a string.
+    @param max_count: maximum amount of strings, 0 for no limit.
+    @param dedup: list each distinct string once, along with the amount of
+                  times it occurs.
+    @param chunk_size: amount of bytes read at once.
+    @return: list of strings or, if deduplicating, (string, count) tuples.
+    """
+    if isinstance(f, basestring):
+        with open(f, "rb") as fp:
+            return extract_strings(fp, min_length, max_count, dedup,
+                                   chunk_size)
+
+    if dedup:
+        strings = collections.OrderedDict(), collections.OrderedDict()
+    else:
+        strings = [], []
+
+    # The strings are kept per encoding, so at most twice the maximum.
+    for wide, string in iter_strings(f, min_length, chunk_size):
+        bucket = strings[wide]
+        if dedup and string in bucket:
+            bucket[string] += 1
+        elif not max_count or len(bucket) < max_count:
+            if dedup:
+                bucket[string] = 1
+            else:
+                bucket.append(string)
+
+    if not dedup:
+        ret = strings[0] + strings[1]
+        return ret[:max_count] if max_count else ret
+
+    ret = strings[0]
+    for string, count in strings[1].items():
+        if string in ret:
+            ret[string] += count
+        elif not max_count or len(ret) < max_count:
+            ret[string] = count
+    return ret.items()
@@ -240,9 +240,13 @@ def cleanup_value(v):
 
 def classlock(f):
     """Classlock decorator (created for database.Database).
-    Used to put a lock to avoid sqlite errors.
+    Used to put a lock to avoid sqlite errors. Nothing is locked if the
+    instance has no lock, i.e., for databases that handle concurrency.
     """
     def inner(self, *args, **kwargs):
+        if not self._lock:
+            return f(self, *args, **kwargs)
+
         curframe = inspect.currentframe()
         calframe = inspect.getouterframes(curframe, 2)
 
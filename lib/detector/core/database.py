@@ -1,7 +1,9 @@
 import os
 import json
+import socket
+import collections
 import logging
-from datetime import datetime
+from datetime import datetime, timedelta
 
 from lib.detector.common.config import Config
 from lib.detector.common.constants import DETECTOR_ROOT
@@ -12,12 +14,13 @@ from lib.detector.common.objects import File, URL
 from lib.detector.common.utils import create_folder, Singleton, classlock, SuperLock
 
 try:
-    from sqlalchemy import create_engine, Column, not_
+    from sqlalchemy import create_engine, Column, not_, or_, inspect, func
     from sqlalchemy import Integer, String, Boolean, DateTime, Enum
     from sqlalchemy import ForeignKey, Text, Index, Table
     from sqlalchemy.ext.declarative import declarative_base
     from sqlalchemy.exc import SQLAlchemyError, IntegrityError
     from sqlalchemy.orm import sessionmaker, relationship, joinedload
+    from sqlalchemy.orm.attributes import set_committed_value
     Base = declarative_base()
 except ImportError:
     raise DetectorDependencyError("Unable to import sqlalchemy "
@@ -35,6 +38,59 @@ TASK_FAILED_ANALYSIS = "failed_analysis"
 TASK_FAILED_PROCESSING = "failed_processing"
 TASK_FAILED_REPORTING = "failed_reporting"
 
+# Amount of pending tasks considered at once when assigning tasks.
+ASSIGN_BATCH_SIZE = 100
+
+# Amount of values looked up at once in "IN" queries, below the limits of
+# the supported databases.
+QUERY_CHUNK_SIZE = 500
+
+# Attempts of add_samples() at inserting samples that other submitters are
+# adding at the same time. Each failed attempt means that another submitter
+# has committed its samples.
+ADD_SAMPLES_ATTEMPTS = 10
+
+# Datagram socket on which a running scheduler is notified of new tasks.
+SCHEDULER_SOCKET = os.path.join(DETECTOR_ROOT, "storage", "scheduler.sock")
+
+def notify_scheduler(path=None):
+    """Wake up the scheduler, if any is listening on this host. If the
+    notification is lost, the scheduler still picks up the new tasks within
+    its polling interval.
+    @param path: path of the scheduler socket.
+    """
+    if not hasattr(socket, "AF_UNIX"):
+        return
+
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        s.sendto("task", path or SCHEDULER_SOCKET)
+    except socket.error:
+        pass
+    finally:
+        s.close()
+
+def sample_info(file_path):
+    """Compute the details of a file as stored in the samples table.
+    @param file_path: file path.
+    @return: dict or None for empty files.
+    """
+    f = File(file_path)
+    file_size = f.get_size()
+    if not file_size:
+        return
+
+    return {
+        "file_size": file_size,
+        "file_type": f.get_type(),
+        "md5": f.get_md5(),
+        "crc32": f.get_crc32(),
+        "sha1": f.get_sha1(),
+        "sha256": f.get_sha256(),
+        "sha512": f.get_sha512(),
+        "ssdeep": f.get_ssdeep(),
+    }
+
 # Secondary table used in association Machine - Tag.
 machines_tags = Table(
     "machines_tags", Base.metadata,
@@ -104,6 +160,27 @@ class Machine(Base):
                 return
         return True
 
+    def matches(self, task):
+        """Can this machine run the given task? A task bound to a machine
+        only runs on that machine. Otherwise the platform and all tags of the
+        task have to match, and only tasks tagged as "service" run on service
+        VMs, and vice versa.
+        @param task: task object
+        @return: boolean
+        """
+        if task.machine:
+            return task.machine in (self.label, self.name)
+
+        if task.platform and task.platform != self.platform:
+            return False
+
+        tags = set(tag.name for tag in self.tags)
+        required = set(tag.name for tag in task.tags)
+        if not required.issubset(tags):
+            return False
+
+        return ("service" in required) != bool(self.is_analysis())
+
     def __init__(self, name, label, ip, platform, options, interface,
                  snapshot, resultserver_ip, resultserver_port):
         self.name = name
@@ -290,6 +367,7 @@ class Task(Base):
     sample = relationship("Sample", backref="tasks")
     guest = relationship("Guest", uselist=False, backref="tasks", cascade="save-update, delete")
     errors = relationship("Error", backref="tasks", cascade="save-update, delete")
+    __table_args__ = Index("pending_index", "status", "priority", "added_on"),
 
     def to_dict(self):
         """Converts object to dict.
@@ -319,6 +397,16 @@ class Task(Base):
     def __repr__(self):
         return "<Task('{0}','{1}')>".format(self.id, self.target)
 
+class ProcessingInstance(Base):
+    """Processing worker instance and its latest heartbeat."""
+    __tablename__ = "processing_instances"
+
+    name = Column(String(16), primary_key=True)
+    heartbeat = Column(DateTime(timezone=False), nullable=False)
+
+    def __repr__(self):
+        return "<ProcessingInstance('{0}')>".format(self.name)
+
 class AlembicVersion(Base):
     """Table used to pinpoint actual database schema release."""
     __tablename__ = "alembic_version"
@@ -339,7 +427,6 @@ class Database(object):
         @param schema_check: disable or enable the db schema version check.
         @param echo: echo sql queries.
         """
-        self._lock = SuperLock()
         cfg = Config()
 
         if dsn:
@@ -358,6 +445,13 @@ class Database(object):
 
             self._connect_database("sqlite:///%s" % db_file)
 
+        # SQLite doesn't cope well with concurrent writers, so serialize the
+        # database accesses of this process when using it.
+        if self.engine.name == "sqlite":
+            self._lock = SuperLock()
+        else:
+            self._lock = None
+
         # Disable SQL logging. Turn it on for debugging.
         self.engine.echo = echo
 
@@ -375,6 +469,7 @@ class Database(object):
         # Create schema.
         try:
             Base.metadata.create_all(self.engine)
+            self._create_indexes()
         except SQLAlchemyError as e:
             raise DetectorDatabaseError("Unable to create or connect to database: {0}".format(e))
 
@@ -405,6 +500,17 @@ class Database(object):
                     "alembic upgrade head).".format(last.version_num,
                                                     SCHEMA_VERSION))
 
+    def _create_indexes(self):
+        """Add the indexes that have been introduced after the tables of an
+        existing database have been created."""
+        inspector = inspect(self.engine)
+        for table in Base.metadata.sorted_tables:
+            existing = [index["name"] for index in
+                        inspector.get_indexes(table.name)]
+            for index in table.indexes:
+                if index.name not in existing:
+                    index.create(self.engine)
+
     def __del__(self):
         """Disconnects pool."""
         self.engine.dispose()
@@ -580,6 +686,128 @@ class Database(object):
         finally:
             session.close()
 
+    @classlock
+    def assign_tasks(self, limit):
+        """Matches pending tasks to free machines and locks both for running,
+        all in a single transaction. Tasks are matched in order of priority
+        and submission, please refer to Machine.matches() for the rules.
+        Tasks that can't run on any of the machines are marked as failed.
+        @param limit: maximum amount of tasks to assign.
+        @return: list of (task, machine) tuples
+        """
+        if limit <= 0:
+            return []
+
+        # Keep the tasks and machines usable after committing.
+        session = self.Session(expire_on_commit=False)
+        try:
+            machines = session.query(Machine).options(joinedload("tags")).all()
+            free = [machine for machine in machines if not machine.locked]
+
+            names, known = set(), set()
+            for machine in machines:
+                known.update((machine.name, machine.label))
+                if not machine.locked:
+                    names.update((machine.name, machine.label))
+
+            q = session.query(Task).filter_by(status=TASK_PENDING)
+            unbound = or_(Task.machine.is_(None), Task.machine == "")
+            now = datetime.now()
+
+            # Tasks bound to unknown machines are failed right away, whether
+            # any machine is free or not.
+            for task in q.filter(not_(unbound), not_(Task.machine.in_(known))):
+                log.error("Task #%d: no machines match selection criteria",
+                          task.id)
+                task.status = TASK_FAILED_ANALYSIS
+                task.completed_on = now
+            session.flush()
+
+            # Tasks bound to one of the free machines go first, then the
+            # unbound ones.
+            queries = [
+                q.filter(Task.machine.in_(names)),
+                q.filter(unbound),
+            ]
+
+            assignments = []
+            for q in queries:
+                q = q.order_by(Task.priority.desc(), Task.added_on)
+                offset = 0
+                while free and len(assignments) < limit:
+                    tasks = q.offset(offset).limit(ASSIGN_BATCH_SIZE).all()
+                    if not tasks:
+                        break
+
+                    for task in tasks:
+                        if not free or len(assignments) >= limit:
+                            break
+
+                        if not any(machine.matches(task)
+                                   for machine in machines):
+                            log.error("Task #%d: no machines match selection "
+                                      "criteria", task.id)
+                            task.status = TASK_FAILED_ANALYSIS
+                            task.completed_on = now
+                            session.flush()
+                            continue
+
+                        machine = self._assign_task(session, task, free, now)
+                        if machine:
+                            free.remove(machine)
+                            assignments.append((task, machine))
+
+                    # Assigned and failed tasks are no longer pending.
+                    offset += len([task for task in tasks
+                                   if task.status == TASK_PENDING])
+
+            session.commit()
+            return assignments
+        except SQLAlchemyError as e:
+            log.debug("Database error assigning tasks: {0}".format(e))
+            session.rollback()
+            return []
+        finally:
+            session.close()
+
+    def _assign_task(self, session, task, machines, now):
+        """Locks the first of the free machines that can run the task, and
+        the task itself. Both are compare-and-set updates, so concurrent
+        schedulers never lock the same machine or task twice.
+        @return: locked machine or None
+        """
+        for machine in list(machines):
+            if not machine.matches(task):
+                continue
+
+            locked = session.query(Machine).filter_by(
+                id=machine.id, locked=False
+            ).update({
+                "locked": True, "locked_changed_on": now,
+            }, synchronize_session=False)
+            if not locked:
+                # Locked by someone else in the meantime.
+                machines.remove(machine)
+                continue
+
+            running = session.query(Task).filter_by(
+                id=task.id, status=TASK_PENDING
+            ).update({
+                "status": TASK_RUNNING, "started_on": now,
+            }, synchronize_session=False)
+            if not running:
+                session.query(Machine).filter_by(id=machine.id).update(
+                    {"locked": False}, synchronize_session=False
+                )
+                return
+
+            # Reflect the updates without flushing them once more.
+            set_committed_value(machine, "locked", True)
+            set_committed_value(machine, "locked_changed_on", now)
+            set_committed_value(task, "status", TASK_RUNNING)
+            set_committed_value(task, "started_on", now)
+            return machine
+
     @classlock
     def guest_start(self, task_id, name, label, manager):
         """Logs guest start.
@@ -935,14 +1163,7 @@ class Database(object):
                 task.tags.append(tag)
 
         if clock:
-            if isinstance(clock, str) or isinstance(clock, unicode):
-                try:
-                    task.clock = datetime.strptime(clock, "%m-%d-%Y %H:%M:%S")
-                except ValueError:
-                    log.warning("The date you specified has an invalid format, using current timestamp.")
-                    task.clock = datetime.now()
-            else:
-                task.clock = clock
+            task.clock = self._parse_clock(clock)
 
         session.add(task)
 
@@ -956,8 +1177,23 @@ class Database(object):
         finally:
             session.close()
 
+        notify_scheduler()
         return task_id
 
+    def _parse_clock(self, clock):
+        """Parse the virtual machine clock time of a task.
+        @param clock: datetime or string (mm-dd-yyyy HH:MM:SS).
+        @return: datetime
+        """
+        if isinstance(clock, str) or isinstance(clock, unicode):
+            try:
+                return datetime.strptime(clock, "%m-%d-%Y %H:%M:%S")
+            except ValueError:
+                log.warning("The date you specified has an invalid format, using current timestamp.")
+                return datetime.now()
+        return clock
+
+    @classlock
     def add_path(self, file_path, timeout=0, package="", options="",
                  priority=1, custom="", owner="", machine="", platform="",
                  tags=None, memory=False, enforce_timeout=False, clock=None):
@@ -990,6 +1226,7 @@ class Database(object):
                         custom, owner, machine, platform, tags, memory,
                         enforce_timeout, clock, "file")
 
+    @classlock
     def add_url(self, url, timeout=0, package="", options="", priority=1,
                 custom="", owner="", machine="", platform="", tags=None,
                 memory=False, enforce_timeout=False, clock=None):
@@ -1019,6 +1256,7 @@ class Database(object):
                         custom, owner, machine, platform, tags, memory,
                         enforce_timeout, clock, "url")
 
+    @classlock
     def add_baseline(self, timeout=0, owner="", machine="", memory=False):
         """Add a baseline task to database.
         @param timeout: selected timeout.
@@ -1030,6 +1268,7 @@ class Database(object):
         return self.add(None, timeout=timeout or 0, priority=999, owner=owner,
                         machine=machine, memory=memory, category="baseline")
 
+    @classlock
     def add_service(self, timeout, owner, tags):
         """Add a service task to database.
         @param timeout: selected timeout.
@@ -1040,6 +1279,151 @@ class Database(object):
         return self.add(None, timeout=timeout, priority=999, owner=owner,
                         tags=tags, category="service")
 
+    @classlock
+    def add_samples(self, samples, timeout=0, package="", options="",
+                    priority=1, custom="", owner="", machine="", platform="",
+                    tags=None, memory=False, enforce_timeout=False,
+                    clock=None, unique=False):
+        """Add a task for each of many files at once. The samples are
+        deduplicated by their SHA256 hash against each other and against the
+        database, and all rows are inserted in batched statements in a single
+        transaction.
+        @param samples: list of (file path, sample info) tuples, where the
+                        sample info is a dict with the columns of the samples
+                        table, e.g., as computed by sample_info().
+        @param unique: skip samples that have been submitted before.
+        @return: list of (file path, task id) tuples of the added tasks.
+        """
+        if not samples:
+            return []
+
+        for attempt in xrange(ADD_SAMPLES_ATTEMPTS):
+            session = self.Session()
+            try:
+                ret = self._add_samples(
+                    session, samples, timeout or 0, package, options,
+                    priority or 1, custom, owner, machine, platform, tags,
+                    memory, enforce_timeout, clock, unique
+                )
+                session.commit()
+                break
+            except IntegrityError as e:
+                # Another submitter added some of the same samples since we
+                # looked them up, so look them up once more.
+                log.debug("Database error adding samples: {0}".format(e))
+                session.rollback()
+                ret = []
+            except SQLAlchemyError as e:
+                log.debug("Database error adding samples: {0}".format(e))
+                session.rollback()
+                return []
+            finally:
+                session.close()
+        else:
+            log.error("Unable to add %d samples after %d attempts, as other "
+                      "submitters kept adding the same samples",
+                      len(samples), ADD_SAMPLES_ATTEMPTS)
+
+        if ret:
+            notify_scheduler()
+        return ret
+
+    def _query_samples(self, session, hashes):
+        """Map SHA256 hashes to the identifiers of the existing samples."""
+        hashes, ret = list(hashes), {}
+        for idx in xrange(0, len(hashes), QUERY_CHUNK_SIZE):
+            q = session.query(Sample.id, Sample.sha256)
+            q = q.filter(Sample.sha256.in_(hashes[idx:idx+QUERY_CHUNK_SIZE]))
+            ret.update((sha256, sample_id) for sample_id, sha256 in q)
+        return ret
+
+    def _add_samples(self, session, samples, timeout, package, options,
+                     priority, custom, owner, machine, platform, tags,
+                     memory, enforce_timeout, clock, unique):
+        """Insert the samples and tasks of add_samples()."""
+        new = collections.OrderedDict()
+        for file_path, info in samples:
+            new.setdefault(info["sha256"], info)
+
+        existing = self._query_samples(session, new)
+        for sha256 in existing:
+            del new[sha256]
+
+        if new:
+            session.execute(Sample.__table__.insert(), new.values())
+            existing.update(self._query_samples(session, new))
+
+        # Only the first of the duplicates within this batch is new.
+        if unique:
+            seen, unique_samples = set(), []
+            for file_path, info in samples:
+                if info["sha256"] in new and info["sha256"] not in seen:
+                    seen.add(info["sha256"])
+                    unique_samples.append((file_path, info))
+            samples = unique_samples
+
+        if not samples:
+            return []
+
+        # All tasks of the batch share this timestamp (in seconds, as not all
+        # databases store more), which, together with the last task identifier
+        # before inserting them, allows to fetch their identifiers without a
+        # query per task.
+        now = datetime.now().replace(microsecond=0)
+        last_id = session.query(func.max(Task.id)).scalar() or 0
+
+        session.execute(Task.__table__.insert(), [{
+            "target": file_path,
+            "category": "file",
+            "timeout": timeout,
+            "priority": priority,
+            "custom": custom,
+            "owner": owner,
+            "machine": machine,
+            "package": package,
+            "options": options,
+            "platform": platform,
+            "memory": memory,
+            "enforce_timeout": enforce_timeout,
+            "clock": self._parse_clock(clock) if clock else now,
+            "added_on": now,
+            "sample_id": existing[info["sha256"]],
+        } for file_path, info in samples])
+
+        # Skip the tasks that have been added concurrently by others.
+        q = session.query(Task.id, Task.target).filter(Task.id > last_id)
+        q = q.filter_by(added_on=now, category="file").order_by(Task.id)
+        task_ids = []
+        for task_id, target in q:
+            if len(task_ids) < len(samples) and \
+                    target == samples[len(task_ids)][0]:
+                task_ids.append(task_id)
+
+        if len(task_ids) != len(samples):
+            raise SQLAlchemyError("Unable to identify the added tasks")
+
+        # Deal with tags format (i.e., foo,bar,baz)
+        names = set(tag.strip() for tag in (tags or "").split(",")
+                    if tag.strip())
+        if names:
+            tag_ids = dict(session.query(Tag.name, Tag.id).filter(
+                Tag.name.in_(names)
+            ))
+            missing = names.difference(tag_ids)
+            if missing:
+                session.execute(Tag.__table__.insert(),
+                                [{"name": name} for name in missing])
+                tag_ids = dict(session.query(Tag.name, Tag.id).filter(
+                    Tag.name.in_(names)
+                ))
+
+            session.execute(tasks_tags.insert(), [
+                {"task_id": task_id, "tag_id": tag_id}
+                for task_id in task_ids for tag_id in tag_ids.values()
+            ])
+
+        return zip([file_path for file_path, info in samples], task_ids)
+
     @classlock
     def reschedule(self, task_id):
         """Reschedule a task.
@@ -1298,8 +1682,16 @@ class Database(object):
             session.close()
         return errors
 
+    @classlock
     def processing_get_task(self, instance):
-        """Get an available task for processing."""
+        """Get an available task for processing.
+        @param instance: name of the processing instance claiming the task.
+        @return: task identifier or None.
+        """
+        # Neither SQLite nor MySQL support the query below.
+        if self.engine.name != "postgresql":
+            return self._processing_get_task(instance)
+
         session = self.Session()
 
         # Please feel free to sqlalchemize the following query, but I didn't
@@ -1333,3 +1725,101 @@ class Database(object):
         finally:
             session.close()
         return
+
+    def _processing_get_task(self, instance):
+        """Get an available task for processing through a compare-and-set
+        update, which works on any database."""
+        session = self.Session()
+        try:
+            # Retry when another instance claimed the task first.
+            for _ in xrange(10):
+                row = session.query(Task.id).filter_by(
+                    status=TASK_COMPLETED, processing=None
+                ).order_by(Task.id).first()
+                if not row:
+                    return
+
+                claimed = session.query(Task).filter_by(
+                    id=row.id, processing=None
+                ).update({"processing": instance}, synchronize_session=False)
+                session.commit()
+
+                if claimed:
+                    return row.id
+        except SQLAlchemyError as e:
+            log.debug("Database error getting new processing tasks: %s", e)
+            session.rollback()
+        finally:
+            session.close()
+
+    @classlock
+    def processing_heartbeat(self, instance):
+        """Mark a processing instance as alive.
+        @param instance: name of the processing instance.
+        """
+        session = self.Session()
+        try:
+            row = session.query(ProcessingInstance).get(instance)
+            if not row:
+                row = ProcessingInstance()
+                row.name = instance
+                session.add(row)
+
+            row.heartbeat = datetime.now()
+            session.commit()
+        except SQLAlchemyError as e:
+            log.debug("Database error updating processing heartbeat: %s", e)
+            session.rollback()
+        finally:
+            session.close()
+
+    @classlock
+    def processing_release(self, instance):
+        """Release the tasks claimed by a processing instance that have not
+        been processed, e.g., after it crashed.
+        @param instance: name of the processing instance.
+        @return: amount of tasks released.
+        """
+        session = self.Session()
+        try:
+            count = session.query(Task).filter_by(
+                status=TASK_COMPLETED, processing=instance
+            ).update({"processing": None}, synchronize_session=False)
+            session.commit()
+            return count
+        except SQLAlchemyError as e:
+            log.debug("Database error releasing processing tasks: %s", e)
+            session.rollback()
+            return 0
+        finally:
+            session.close()
+
+    @classlock
+    def processing_recover(self, timeout):
+        """Release the tasks claimed by processing instances that have not
+        sent a heartbeat within the timeout and forget about them.
+        @param timeout: heartbeat timeout in seconds.
+        @return: amount of tasks released.
+        """
+        session = self.Session()
+        try:
+            threshold = datetime.now() - timedelta(seconds=timeout)
+            stale = [row.name for row in session.query(ProcessingInstance).
+                     filter(ProcessingInstance.heartbeat < threshold)]
+            if not stale:
+                return 0
+
+            count = session.query(Task).filter(
+                Task.status == TASK_COMPLETED, Task.processing.in_(stale)
+            ).update({"processing": None}, synchronize_session=False)
+            session.query(ProcessingInstance).filter(
+                ProcessingInstance.name.in_(stale)
+            ).delete(synchronize_session=False)
+            session.commit()
+            return count
+        except SQLAlchemyError as e:
+            log.debug("Database error recovering processing tasks: %s", e)
+            session.rollback()
+            return 0
+        finally:
+            session.close()
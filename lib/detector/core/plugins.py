@@ -8,6 +8,9 @@ import pkgutil
 import importlib
 import inspect
 import logging
+import Queue
+import threading
+import time
 from collections import defaultdict
 from distutils.version import StrictVersion
 
@@ -20,6 +23,7 @@ from lib.detector.common.exceptions import DetectorOperationalError
 from lib.detector.common.exceptions import DetectorProcessingError
 from lib.detector.common.exceptions import DetectorReportError
 from lib.detector.common.exceptions import DetectorDependencyError
+from lib.detector.common.objects import File, FileCache
 
 log = logging.getLogger(__name__)
 
@@ -157,8 +161,9 @@ class RunProcessing(object):
     """Analysis Results Processing Engine.
 
     This class handles the loading and execution of the processing modules.
-    It executes the enabled ones sequentially and generates a dictionary which
-    is then passed over the reporting engine.
+    It executes the enabled ones concurrently, each as soon as the modules it
+    depends on have finished, and generates a dictionary which is then passed
+    over the reporting engine.
     """
 
     def __init__(self, task):
@@ -168,6 +173,148 @@ class RunProcessing(object):
         self.baseline_path = os.path.join(DETECTOR_ROOT, "storage", "baseline")
         self.cfg = Config("processing")
 
+        processing = Config().processing
+        self.threads = max(processing.threads or 1, 1)
+        self.timeout = processing.module_timeout or 0
+
+        if processing.file_cache and not File.cache:
+            File.cache = FileCache(
+                os.path.join(DETECTOR_ROOT, "storage", "cache", "files"),
+                max_size=(processing.file_cache_size or 0) * 1024 * 1024,
+                max_age=(processing.file_cache_age or 0) * 24 * 60 * 60,
+            )
+
+    def module_name(self, module):
+        """Name of a processing module, as used in processing.conf."""
+        return module.__module__.rsplit(".", 1)[-1]
+
+    def module_timeout(self, module):
+        """Timeout of a processing module in seconds, if any. This is the
+        module_timeout option of its section in processing.conf, as modules
+        may use a timeout option of their own, e.g., for HTTP requests."""
+        try:
+            options = self.cfg.get(self.module_name(module))
+        except DetectorOperationalError:
+            return self.timeout
+
+        timeout = options.get("module_timeout")
+        if timeout is None or timeout == "":
+            return self.timeout
+        return timeout
+
+    def dependencies(self, modules):
+        """Determine the dependencies of each processing module.
+        @param modules: processing modules sorted by their order.
+        @return: list of sets of module indices.
+        """
+        names = [self.module_name(module) for module in modules]
+
+        ret = []
+        for idx, module in enumerate(modules):
+            if module.dependencies is None:
+                ret.append(set(
+                    dep for dep in xrange(idx)
+                    if modules[dep].order < module.order
+                ))
+            else:
+                ret.append(set(
+                    dep for dep, name in enumerate(names)
+                    if name in module.dependencies and dep != idx
+                ))
+        return ret
+
+    def _process(self, idx, module, results, finished):
+        """Run a processing module in its own thread."""
+        start = time.time()
+        key, data = self.process(module, results)
+        finished.put((idx, key, data, time.time() - start))
+
+    def run_modules(self, modules, results):
+        """Run the processing modules on a bounded amount of threads. A module
+        is started once all the modules it depends on have finished. Modules
+        that fork worker processes run on their own, see Processing.forks.
+        @param modules: processing modules sorted by their order.
+        @param results: results dict.
+        @return: wall time per processing module.
+        """
+        dependencies = self.dependencies(modules)
+        pending = range(len(modules))
+        running, done, durations = {}, set(), {}
+        finished = Queue.Queue()
+
+        while pending or running:
+            for idx in pending[:]:
+                if len(running) >= self.threads or \
+                        any(modules[dep].forks for dep in running):
+                    break
+
+                if not dependencies[idx].issubset(done):
+                    continue
+
+                # Don't start any other module until this one gets to run.
+                if modules[idx].forks and running:
+                    break
+
+                timeout = self.module_timeout(modules[idx])
+                running[idx] = time.time() + timeout if timeout else None
+                pending.remove(idx)
+
+                t = threading.Thread(
+                    target=self._process,
+                    args=(idx, modules[idx], results, finished)
+                )
+                t.daemon = True
+                t.start()
+
+                if modules[idx].forks:
+                    break
+
+            if not running:
+                log.error("Processing modules %s have cyclic dependencies, "
+                          "running them in order",
+                          ", ".join(self.module_name(modules[idx])
+                                    for idx in pending))
+                for idx in pending:
+                    dependencies[idx] = set()
+                continue
+
+            deadlines = [deadline for deadline in running.values() if deadline]
+            try:
+                if deadlines:
+                    wait = max(min(deadlines) - time.time(), 0)
+                    idx, key, data, duration = finished.get(timeout=wait)
+                else:
+                    # Without a timeout Queue.get() can't be interrupted.
+                    idx, key, data, duration = finished.get(timeout=86400)
+            except Queue.Empty:
+                now = time.time()
+                for idx, deadline in running.items():
+                    if deadline and deadline <= now:
+                        log.error("The processing module \"%s\" timed out "
+                                  "for task #%d, discarding its results",
+                                  self.module_name(modules[idx]),
+                                  self.task["id"])
+                        del running[idx]
+                        done.add(idx)
+                continue
+
+            # The results of timed out modules are discarded.
+            if idx not in running:
+                continue
+
+            del running[idx]
+            done.add(idx)
+
+            name = self.module_name(modules[idx])
+            if key:
+                durations[name] = round(duration, 3)
+
+            # If the module provided results, append it to the fat dict.
+            if key and data:
+                results[key] = data
+
+        return durations
+
     def process(self, module, results):
         """Run a processing module.
         @param module: processing module to run.
@@ -254,12 +401,11 @@ class RunProcessing(object):
             processing_list.sort(key=lambda module: module.order)
 
             # Run every loaded processing module.
-            for module in processing_list:
-                key, result = self.process(module, results)
+            durations = self.run_modules(processing_list, results)
 
-                # If the module provided results, append it to the fat dict.
-                if key and result:
-                    results[key] = result
+            # Record the wall time of each module that has been run.
+            if "info" in results:
+                results["info"]["processing"] = durations
         else:
             log.info("No processing modules loaded")
 
@@ -268,9 +414,87 @@ class RunProcessing(object):
         # Return the fat dict.
         return results
 
+def _implements(signature, method):
+    """Whether a signature overrides the given Signature event handler."""
+    return getattr(signature.__class__, method).im_func is not \
+        getattr(Signature, method).im_func
+
+class SignatureIndex(object):
+    """Precompiled dispatch tables for a set of signatures.
+
+    Signatures are referred to by their index in the signature list, so that
+    a SignatureIndex can be shared by every task that runs the same set of
+    signatures. Only signatures that actually implement an event handler are
+    indexed for it.
+    """
+
+    def __init__(self, signatures):
+        # Signatures implementing on_call(), indexed on their API filter.
+        self.any_api = []
+        self.by_api = {}
+        self.categories = {}
+
+        # Signatures implementing on_signature(), indexed on the names of the
+        # signatures they depend on.
+        self.any_signature = []
+        self.by_signature = {}
+
+        # Compiled dispatch tables.
+        self.calls = {}
+        self.signatures = {}
+
+        for idx, sig in enumerate(signatures):
+            if _implements(sig, "on_call"):
+                if sig.filter_categories:
+                    self.categories[idx] = frozenset(sig.filter_categories)
+
+                if sig.filter_apinames:
+                    for apiname in sig.filter_apinames:
+                        self.by_api.setdefault(apiname, []).append(idx)
+                else:
+                    self.any_api.append(idx)
+
+            if _implements(sig, "on_signature"):
+                if sig.filter_signatures:
+                    for name in sig.filter_signatures:
+                        self.by_signature.setdefault(name, []).append(idx)
+                else:
+                    self.any_signature.append(idx)
+
+    def call_signatures(self, apiname, category):
+        """Signatures interested in an API call, in signature order.
+        @param apiname: API name.
+        @param category: API category.
+        @return: tuple of signature indices.
+        """
+        key = apiname, category
+        if key not in self.calls:
+            indices = set(self.any_api)
+            indices.update(self.by_api.get(apiname, []))
+            self.calls[key] = tuple(
+                idx for idx in sorted(indices)
+                if idx not in self.categories or
+                category in self.categories[idx]
+            )
+        return self.calls[key]
+
+    def signature_signatures(self, name):
+        """Signatures interested in a matched signature, in signature order.
+        @param name: name of the matched signature.
+        @return: tuple of signature indices.
+        """
+        if name not in self.signatures:
+            indices = set(self.any_signature)
+            indices.update(self.by_signature.get(name, []))
+            self.signatures[name] = tuple(sorted(indices))
+        return self.signatures[name]
+
 class RunSignatures(object):
     """Run Signatures."""
 
+    # Signature indices per set of signature classes and filters.
+    indexes = {}
+
     def __init__(self, results):
         self.results = results
         self.matched = []
@@ -286,9 +510,35 @@ class RunSignatures(object):
             if self._should_enable_signature(signature):
                 self.signatures.append(signature(self))
 
-        # Signatures to call per API name.
+        # Dispatch tables, built once the signatures have been initialized.
+        self.index = None
+
+        # Signatures to call per API name and category.
         self.api_sigs = {}
 
+        # Indexed behavior summary, created by the first signature using it.
+        self.summary_index = None
+
+        # Signature, pattern, and value for each registered pattern match.
+        self.pattern_hits = []
+
+    def build_index(self):
+        """Get the dispatch tables for the signatures of this analysis. As
+        signatures may set their filters in init(), the tables are shared
+        with other analyses only if all filters are the same.
+        @return: SignatureIndex.
+        """
+        key = tuple(
+            (sig.__class__,
+             frozenset(sig.filter_apinames or ()),
+             frozenset(sig.filter_categories or ()),
+             frozenset(sig.filter_signatures or ()))
+            for sig in self.signatures
+        )
+        if key not in self.indexes:
+            self.indexes[key] = SignatureIndex(self.signatures)
+        return self.indexes[key]
+
     def _should_enable_signature(self, signature):
         """Should the given signature be enabled for this analysis?"""
         if not signature.enabled:
@@ -376,9 +626,7 @@ class RunSignatures(object):
         event to the signature and handles matched signatures recursively."""
         try:
             if handler(*args, **kwargs):
-                signature.matched = True
-                for sig in self.signatures:
-                    self.call_signature(sig, sig.on_signature, signature)
+                self.signature_matched(signature)
         except NotImplementedError:
             return False
         except:
@@ -386,34 +634,48 @@ class RunSignatures(object):
                           handler.__name__, signature.name)
         return True
 
+    def signature_matched(self, signature):
+        """Mark a signature as matched and yield it to the signatures that
+        depend on it."""
+        signature.matched = True
+        for idx in self.index.signature_signatures(signature.name):
+            sig = self.signatures[idx]
+            self.call_signature(sig, sig.on_signature, signature)
+
     def init_api_sigs(self, apiname, category):
         """Initialize a list of signatures for which we should trigger its
         on_call method for this particular API name and category."""
-        self.api_sigs[apiname] = []
-
-        for sig in self.signatures:
-            if sig.filter_apinames and apiname not in sig.filter_apinames:
-                continue
-
-            if sig.filter_categories and category not in sig.filter_categories:
-                continue
-
-            self.api_sigs[apiname].append(sig)
+        sigs = self.api_sigs[apiname, category] = [
+            self.signatures[idx]
+            for idx in self.index.call_signatures(apiname, category)
+        ]
+        return sigs
 
     def yield_calls(self, proc):
         """Yield calls of interest to each interested signature."""
-        for idx, call in enumerate(proc.get("calls", [])):
+        api_sigs = self.api_sigs
 
+        for idx, call in enumerate(proc.get("calls", [])):
             # Initialize a list of signatures to call for this API call.
-            if call["api"] not in self.api_sigs:
-                self.init_api_sigs(call["api"], call["category"])
+            sigs = api_sigs.get((call["api"], call["category"]))
+            if sigs is None:
+                sigs = self.init_api_sigs(call["api"], call["category"])
 
             # See the following SO answer on why we're using reversed() here.
             # http://stackoverflow.com/a/10665800
-            for sig in reversed(self.api_sigs[call["api"]]):
+            for sig in reversed(sigs):
                 sig.cid, sig.call = idx, call
-                if self.call_signature(sig, sig.on_call, call, proc) is False:
-                    self.api_sigs[call["api"]].remove(sig)
+
+                # This is call_signature() inlined, as it is by far the most
+                # frequently called signature handler.
+                try:
+                    if sig.on_call(call, proc):
+                        self.signature_matched(sig)
+                except NotImplementedError:
+                    sigs.remove(sig)
+                except:
+                    log.exception("Failed to run 'on_call' of the %s "
+                                  "signature", sig.name)
 
     def run(self):
         """Run signatures."""
@@ -421,6 +683,15 @@ class RunSignatures(object):
         for signature in self.signatures:
             signature.init()
 
+        self.index = self.build_index()
+
+        # Match the regular expressions registered by the signatures.
+        if self.summary_index is not None:
+            self.pattern_hits = \
+                self.summary_index.match_patterns(Signature.patterns)
+            log.debug("Registered patterns matched %d times",
+                      len(self.pattern_hits))
+
         log.debug("Running %d signatures", len(self.signatures))
 
         # Iterate calls and tell interested signatures about them.
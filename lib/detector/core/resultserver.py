@@ -4,8 +4,10 @@
 # See the file 'docs/LICENSE' for copying permission.
 
 import os
+import errno
 import socket
 import select
+import struct
 import logging
 import datetime
 import SocketServer
@@ -16,13 +18,18 @@ from lib.detector.common.constants import DETECTOR_ROOT
 from lib.detector.common.exceptions import DetectorOperationalError
 from lib.detector.common.exceptions import DetectorCriticalError
 from lib.detector.common.exceptions import DetectorResultError
-from lib.detector.common.netlog import BsonParser
+from lib.detector.common.netlog import BsonParser, BsonSidecar
+from lib.detector.common.netlog import MAX_MESSAGE_LENGTH
 from lib.detector.common.utils import create_folder, Singleton
 
 log = logging.getLogger(__name__)
 
 BUFSIZE = 16 * 1024
 
+# Buffer size for writing the raw BSON logs, batching many small messages
+# into few large writes.
+RAWLOG_BUFSIZE = 1024 * 1024
+
 class Disconnect(Exception):
     pass
 
@@ -30,6 +37,10 @@ class ResultServer(SocketServer.ThreadingTCPServer, object):
     """Result server. Singleton!
 
     This class handles results coming back from the analysis machines.
+
+    By default every incoming connection is served by its own thread. With the
+    "eventloop" backend all connections are multiplexed by a single
+    ResultEventLoop thread instead.
     """
 
     __metaclass__ = Singleton
@@ -37,10 +48,15 @@ class ResultServer(SocketServer.ThreadingTCPServer, object):
     allow_reuse_address = True
     daemon_threads = True
 
+    # Many guests may (re)connect at once, e.g., when a sample spawns a lot
+    # of processes, so don't rely on the default listen backlog of 5.
+    request_queue_size = 128
+
     def __init__(self, *args, **kwargs):
         self.cfg = Config()
         self.analysistasks = {}
         self.analysishandlers = {}
+        self.eventloop = None
 
         ip = self.cfg.resultserver.ip
         self.port = int(self.cfg.resultserver.port)
@@ -67,7 +83,13 @@ class ResultServer(SocketServer.ThreadingTCPServer, object):
                                                   ip, self.port, str(e)))
             else:
                 log.debug("ResultServer running on %s:%s.", ip, self.port)
-                self.servethread = Thread(target=self.serve_forever)
+
+                if self.cfg.resultserver.backend == "eventloop":
+                    self.eventloop = ResultEventLoop(self)
+                    self.servethread = Thread(target=self.eventloop.run)
+                else:
+                    self.servethread = Thread(target=self.serve_forever)
+
                 self.servethread.setDaemon(True)
                 self.servethread.start()
                 break
@@ -86,6 +108,11 @@ class ResultServer(SocketServer.ThreadingTCPServer, object):
         handlers = self.analysishandlers.pop(task.id, None)
         for h in handlers:
             h.end_request.set()
+
+        if self.eventloop:
+            self.eventloop.wakeup()
+
+        for h in handlers:
             h.done_event.wait()
 
     def register_handler(self, handler):
@@ -113,7 +140,91 @@ class ResultServer(SocketServer.ThreadingTCPServer, object):
 
         return os.path.join(DETECTOR_ROOT, "storage", "analyses", str(task.id))
 
-class ResultHandler(SocketServer.BaseRequestHandler):
+class ProtocolMixin(object):
+    """Protocol state shared between the threaded ResultHandler and the
+    connections of the ResultEventLoop."""
+
+    def select_protocol(self, buf):
+        """Initialize the protocol handler requested by the guest.
+        @param buf: protocol negotiation line.
+        """
+        if "BSON" in buf:
+            self.protocol = BsonParser(self)
+        elif "FILE" in buf:
+            self.protocol = FileUpload(self)
+        elif "LOG" in buf:
+            self.protocol = LogHandler(self)
+        else:
+            raise DetectorOperationalError("Netlog failure, unknown "
+                                         "protocol requested.")
+
+    def open_process_log(self, event):
+        pid = event["pid"]
+        ppid = event["ppid"]
+        procname = event["process_name"]
+
+        if self.pid is not None:
+            log.debug("ResultServer got a new process message but already "
+                      "has pid %d ppid %s procname %s.",
+                      pid, str(ppid), procname)
+            raise DetectorResultError("ResultServer connection state "
+                                    "inconsistent.")
+
+        # Only report this process when we're tracking it.
+        if event["track"]:
+            log.debug("New process (pid=%s, ppid=%s, name=%s)",
+                      pid, ppid, procname)
+
+        path = os.path.join(self.storagepath, "logs", str(pid) + ".bson")
+        self.rawlogfd = open(path, "wb", RAWLOG_BUFSIZE)
+        self.rawlogfd.write(self.startbuf)
+
+        self.pid, self.ppid, self.procname = pid, ppid, procname
+
+        if self.server.cfg.resultserver.preprocess:
+            try:
+                create_folder(self.storagepath, folder="sidecar")
+            except DetectorOperationalError:
+                log.error("Unable to create folder sidecar")
+            else:
+                self.sidecar = BsonSidecar(
+                    os.path.join(self.storagepath, "sidecar", str(pid))
+                )
+
+    def handle_event(self, event):
+        """Handle an event coming out of the BsonParser."""
+        if event["type"] == "process":
+            self.open_process_log(event)
+
+        if not self.sidecar:
+            return
+
+        # Never let the sidecar interfere with capturing the raw log.
+        try:
+            self.sidecar.add(event)
+        except Exception:
+            log.exception("Error storing sidecar event, discarding the "
+                          "sidecar for pid %s", self.pid)
+            self.close_sidecar(False)
+
+    def close_sidecar(self, complete):
+        sidecar, self.sidecar = self.sidecar, None
+        try:
+            sidecar.close(complete=complete)
+        except Exception:
+            log.exception("Error closing sidecar for pid %s", self.pid)
+
+    def create_folders(self):
+        folders = "shots", "files", "logs", "buffer"
+
+        for folder in folders:
+            try:
+                create_folder(self.storagepath, folder=folder)
+            except DetectorOperationalError:
+                log.error("Unable to create folder %s" % folder)
+                return False
+
+class ResultHandler(SocketServer.BaseRequestHandler, ProtocolMixin):
     """Result handler.
 
     This handler speaks our analysis log network protocol.
@@ -121,20 +232,30 @@ class ResultHandler(SocketServer.BaseRequestHandler):
 
     def setup(self):
         self.rawlogfd = None
+        self.sidecar = None
+        self.failed = False
         self.protocol = None
-        self.startbuf = ""
+        self.startbuf = bytearray()
+
+        # Receive buffer, holding the pending data in rbuf[rstart:rend].
+        self.rbuf = bytearray(BUFSIZE)
+        self.rstart = self.rend = 0
+
         self.end_request = Event()
         self.done_event = Event()
         self.pid, self.ppid, self.procname = None, None, None
         self.server.register_handler(self)
 
     def finish(self):
-        self.done_event.set()
-
         if self.protocol:
             self.protocol.close()
         if self.rawlogfd:
             self.rawlogfd.close()
+        if self.sidecar:
+            self.close_sidecar(not self.failed)
+
+        # Only signal completion once all buffered data has been written.
+        self.done_event.set()
 
     def wait_sock_or_end(self):
         while True:
@@ -147,15 +268,41 @@ class ResultHandler(SocketServer.BaseRequestHandler):
     def seek(self, pos):
         pass
 
+    def fill(self, length):
+        """Receive more data, making sure there's room for at least length
+        bytes of pending data in the receive buffer."""
+        pending = self.rend - self.rstart
+
+        # Drop an oversized buffer from an earlier large message.
+        if not pending and length <= BUFSIZE < len(self.rbuf):
+            self.rbuf = bytearray(BUFSIZE)
+            self.rstart = self.rend = 0
+
+        if len(self.rbuf) - self.rstart < length:
+            # Move the pending data to the start of the buffer and grow the
+            # buffer if it's still too small.
+            if self.rstart:
+                self.rbuf[:pending] = self.rbuf[self.rstart:self.rend]
+                self.rstart, self.rend = 0, pending
+
+            if len(self.rbuf) < length:
+                self.rbuf.extend(bytearray(length - len(self.rbuf)))
+
+        if not self.wait_sock_or_end():
+            raise Disconnect()
+
+        count = self.request.recv_into(memoryview(self.rbuf)[self.rend:])
+        if not count:
+            raise Disconnect()
+
+        self.rend += count
+
     def read(self, length):
-        buf = ""
-        while len(buf) < length:
-            if not self.wait_sock_or_end():
-                raise Disconnect()
-            tmp = self.request.recv(length-len(buf))
-            if not tmp:
-                raise Disconnect()
-            buf += tmp
+        while self.rend - self.rstart < length:
+            self.fill(length)
+
+        buf = str(self.rbuf[self.rstart:self.rstart+length])
+        self.rstart += length
 
         if isinstance(self.protocol, BsonParser):
             if self.rawlogfd:
@@ -165,32 +312,28 @@ class ResultHandler(SocketServer.BaseRequestHandler):
         return buf
 
     def read_any(self):
-        if not self.wait_sock_or_end():
-            raise Disconnect()
-        tmp = self.request.recv(BUFSIZE)
-        if not tmp:
-            raise Disconnect()
-        return tmp
+        if self.rstart == self.rend:
+            self.fill(1)
 
-    def read_newline(self):
-        buf = ""
-        while "\n" not in buf:
-            buf += self.read(1)
+        buf = str(self.rbuf[self.rstart:self.rend])
+        self.rstart = self.rend
         return buf
 
+    def read_newline(self):
+        offset = self.rstart
+        while True:
+            idx = self.rbuf.find("\n", offset, self.rend)
+            if idx >= 0:
+                return self.read(idx - self.rstart + 1)
+
+            # Only search the newly received data next time around.
+            offset = self.rend - self.rstart
+            self.fill(offset + 1)
+            offset += self.rstart
+
     def negotiate_protocol(self):
         # Read until newline.
-        buf = self.read_newline()
-
-        if "BSON" in buf:
-            self.protocol = BsonParser(self)
-        elif "FILE" in buf:
-            self.protocol = FileUpload(self)
-        elif "LOG" in buf:
-            self.protocol = LogHandler(self)
-        else:
-            raise DetectorOperationalError("Netlog failure, unknown "
-                                         "protocol requested.")
+        self.select_protocol(self.read_newline())
 
     def handle(self):
         ip, port = self.client_address
@@ -208,53 +351,263 @@ class ResultHandler(SocketServer.BaseRequestHandler):
             self.negotiate_protocol()
 
             for event in self.protocol:
-                if isinstance(self.protocol, BsonParser) and event["type"] == "process":
-                    self.open_process_log(event)
+                if isinstance(self.protocol, BsonParser):
+                    self.handle_event(event)
 
         except DetectorResultError as e:
             log.warning("ResultServer connection stopping because of "
                         "DetectorResultError: %s.", str(e))
+            self.failed = True
         except (Disconnect, socket.error):
             pass
         except:
+            self.failed = True
             log.exception("FIXME - exception in resultserver connection %s",
                           str(self.client_address))
 
         log.debug("Connection closed: {0}:{1}".format(ip, port))
 
-    def open_process_log(self, event):
-        pid = event["pid"]
-        ppid = event["ppid"]
-        procname = event["process_name"]
+class ResultConnection(ProtocolMixin):
+    """Guest connection served by the ResultEventLoop.
 
-        if self.pid is not None:
-            log.debug("ResultServer got a new process message but already "
-                      "has pid %d ppid %s procname %s.",
-                      pid, str(ppid), procname)
-            raise DetectorResultError("ResultServer connection state "
-                                    "inconsistent.")
+    Rather than blocking on reads, incoming data is fed to the connection as
+    it arrives and the negotiated protocol is driven as far as the buffered
+    data allows.
+    """
 
-        # Only report this process when we're tracking it.
-        if event["track"]:
-            log.debug("New process (pid=%s, ppid=%s, name=%s)",
-                      pid, ppid, procname)
+    def __init__(self, server, request, client_address):
+        self.server = server
+        self.request = request
+        self.client_address = client_address
+        self.rawlogfd = None
+        self.sidecar = None
+        self.failed = False
+        self.protocol = None
+        self.startbuf = bytearray()
+        self.buf = bytearray()
+        self.uploading = False
+        self.end_request = Event()
+        self.done_event = Event()
+        self.pid, self.ppid, self.procname = None, None, None
+        self.server.register_handler(self)
 
-        path = os.path.join(self.storagepath, "logs", str(pid) + ".bson")
-        self.rawlogfd = open(path, "wb")
-        self.rawlogfd.write(self.startbuf)
+        self.connect_time = datetime.datetime.now()
+        self.storagepath = self.server.build_storage_path(client_address[0])
+        if self.storagepath:
+            # Create all missing folders for this analysis.
+            self.create_folders()
 
-        self.pid, self.ppid, self.procname = pid, ppid, procname
+    def finish(self):
+        if self.protocol:
+            self.protocol.close()
+        if self.rawlogfd:
+            self.rawlogfd.close()
+        if self.sidecar:
+            self.close_sidecar(not self.failed)
 
-    def create_folders(self):
-        folders = "shots", "files", "logs", "buffer"
+        self.request.close()
+        log.debug("Connection closed: {0}:{1}".format(*self.client_address))
 
-        for folder in folders:
-            try:
-                create_folder(self.storagepath, folder=folder)
-            except DetectorOperationalError:
-                log.error("Unable to create folder %s" % folder)
+        self.done_event.set()
+
+    def feed(self, data):
+        """Process newly received data.
+        @param data: data read from the socket.
+        @return: whether the connection should be kept open.
+        """
+        self.buf.extend(data)
+
+        try:
+            return self.process()
+        except DetectorResultError as e:
+            log.warning("ResultServer connection stopping because of "
+                        "DetectorResultError: %s.", str(e))
+        except:
+            log.exception("FIXME - exception in resultserver connection %s",
+                          str(self.client_address))
+
+        self.failed = True
+        return False
+
+    def read_newline(self):
+        """Pop a line from the receive buffer, if there's one."""
+        idx = self.buf.find("\n")
+        if idx < 0:
+            return
+
+        line = str(self.buf[:idx+1])
+        del self.buf[:idx+1]
+        return line
+
+    def process(self):
+        if not self.protocol:
+            line = self.read_newline()
+            if line is None:
+                return True
+
+            self.select_protocol(line)
+
+        if isinstance(self.protocol, BsonParser):
+            return self.process_bson()
+
+        if isinstance(self.protocol, FileUpload):
+            return self.process_upload()
+
+        if self.buf:
+            self.protocol.write(str(self.buf))
+            del self.buf[:]
+        return True
+
+    def process_bson(self):
+        offset, length = 0, len(self.buf)
+
+        while length - offset >= 4:
+            blen = struct.unpack_from("I", self.buf, offset)[0]
+            if blen > MAX_MESSAGE_LENGTH:
+                log.critical("BSON message larger than MAX_MESSAGE_LENGTH, "
+                             "stopping handler.")
+                return False
+
+            # Wait for the remainder of this message.
+            if length - offset < blen:
+                break
+
+            data = str(self.buf[offset:offset+blen])
+            offset += blen
+
+            if self.rawlogfd:
+                self.rawlogfd.write(data)
+            else:
+                self.startbuf += data
+
+            dec = self.protocol.decode(data)
+            if dec is None:
+                return False
+
+            event = self.protocol.handle_message(dec)
+            if event:
+                self.handle_event(event)
+
+        del self.buf[:offset]
+        return True
+
+    def process_upload(self):
+        if not self.uploading:
+            line = self.read_newline()
+            if line is None:
+                return True
+
+            if not self.protocol.init(line):
                 return False
 
+            self.uploading = True
+
+        if not self.buf:
+            return True
+
+        chunk = str(self.buf)
+        del self.buf[:]
+        return self.protocol.write(chunk)
+
+class ResultEventLoop(object):
+    """Event loop serving all ResultServer connections from a single thread.
+
+    Guest connections are multiplexed through epoll (or poll on platforms
+    that lack epoll) so that the amount of threads stays constant regardless
+    of the amount of analysis machines and monitored processes.
+    """
+
+    EVENTS = select.POLLIN | select.POLLPRI | select.POLLHUP | select.POLLERR
+
+    def __init__(self, server):
+        self.server = server
+        self.connections = {}
+
+        if hasattr(select, "epoll"):
+            self.poller = select.epoll()
+            self.poll_timeout = 1
+        else:
+            self.poller = select.poll()
+            self.poll_timeout = 1000
+
+        # Self-pipe used by other threads to interrupt the poll() call.
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        self.poller.register(self.wakeup_r, self.EVENTS)
+
+        self.server.socket.setblocking(0)
+        self.poller.register(self.server.socket.fileno(), self.EVENTS)
+
+    def wakeup(self):
+        """Wake up the event loop, e.g., to handle finished analyses."""
+        os.write(self.wakeup_w, "x")
+
+    def run(self):
+        listen_fd = self.server.socket.fileno()
+
+        while True:
+            try:
+                events = self.poller.poll(self.poll_timeout)
+            except (IOError, select.error) as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            for fd, _ in events:
+                if fd == listen_fd:
+                    self.accept()
+                elif fd == self.wakeup_r:
+                    os.read(self.wakeup_r, BUFSIZE)
+                    self.reap()
+                else:
+                    self.read(fd)
+
+    def accept(self):
+        while True:
+            try:
+                request, client_address = self.server.socket.accept()
+            except socket.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    log.warning("ResultServer unable to accept "
+                                "connection: %s", e)
+                return
+
+            request.setblocking(0)
+            conn = ResultConnection(self.server, request, client_address)
+            if not conn.storagepath:
+                conn.finish()
+                continue
+
+            self.connections[request.fileno()] = conn
+            self.poller.register(request.fileno(), self.EVENTS)
+
+    def read(self, fd):
+        conn = self.connections.get(fd)
+        if not conn:
+            return
+
+        try:
+            data = conn.request.recv(BUFSIZE)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            data = ""
+
+        if not data or not conn.feed(data):
+            self.close(conn)
+
+    def reap(self):
+        """Close all connections belonging to finished analyses."""
+        for conn in self.connections.values():
+            if conn.end_request.isSet():
+                self.close(conn)
+
+    def close(self, conn):
+        fd = conn.request.fileno()
+        if self.connections.pop(fd, None):
+            self.poller.unregister(fd)
+        conn.finish()
 
 class FileUpload(object):
     RESTRICTED_DIRECTORIES = "reports/",
@@ -269,8 +622,25 @@ class FileUpload(object):
     def __iter__(self):
         # Read until newline for file path, e.g.,
         # shots/0001.jpg or files/9498687557/libcurl-4.dll.bin
+        if not self.init(self.handler.read_newline()):
+            return
+
+        chunk = self.handler.read_any()
+        while chunk and self.write(chunk):
+            try:
+                chunk = self.handler.read_any()
+            except:
+                break
 
-        buf = self.handler.read_newline().strip().replace("\\", "/")
+        return
+        yield
+
+    def init(self, buf):
+        """Validate the requested upload path and open the target file.
+        @param buf: upload path as sent by the analyzer.
+        @return: whether the upload should proceed.
+        """
+        buf = buf.strip().replace("\\", "/")
         log.debug("File upload request for %s", buf)
 
         dir_part, filename = os.path.split(buf)
@@ -286,7 +656,7 @@ class FileUpload(object):
             create_folder(self.storagepath, dir_part)
         except DetectorOperationalError:
             log.error("Unable to create folder %s", dir_part)
-            return
+            return False
 
         file_path = os.path.join(self.storagepath, buf.strip())
 
@@ -295,29 +665,26 @@ class FileUpload(object):
 
         if os.path.exists(file_path):
             log.warning("Analyzer tried to overwrite an existing file, closing connection.")
-            return
+            return False
 
         self.fd = open(file_path, "wb")
-        chunk = self.handler.read_any()
-        while chunk:
-            self.fd.write(chunk)
+        return True
 
-            if self.fd.tell() >= self.upload_max_size:
-                log.warning("Uploaded file length larger than upload_max_size, stopping upload.")
-                self.fd.write("... (truncated)")
-                break
+    def write(self, chunk):
+        """Write a chunk of the uploaded file.
+        @return: whether more data is accepted.
+        """
+        self.fd.write(chunk)
 
-            try:
-                chunk = self.handler.read_any()
-            except:
-                break
-
-        log.debug("Uploaded file length: %s", self.fd.tell())
-        return
-        yield
+        if self.fd.tell() >= self.upload_max_size:
+            log.warning("Uploaded file length larger than upload_max_size, stopping upload.")
+            self.fd.write("... (truncated)")
+            return False
+        return True
 
     def close(self):
         if self.fd:
+            log.debug("Uploaded file length: %s", self.fd.tell())
             self.fd.close()
 
 class LogHandler(object):
@@ -340,12 +707,15 @@ class LogHandler(object):
             if not buf:
                 break
 
-            self.fd.write(buf)
-            self.fd.flush()
+            self.write(buf)
 
         return
         yield
 
+    def write(self, buf):
+        self.fd.write(buf)
+        self.fd.flush()
+
     def close(self):
         if self.fd:
             self.fd.close()
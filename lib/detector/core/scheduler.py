@@ -1,6 +1,8 @@
 import os
 import time
+import datetime
 import shutil
+import socket
 import logging
 import threading
 import Queue
@@ -13,6 +15,7 @@ from lib.detector.common.exceptions import DetectorCriticalError
 from lib.detector.common.objects import File
 from lib.detector.common.utils import create_folder
 from lib.detector.core.database import Database, TASK_COMPLETED, TASK_REPORTED
+from lib.detector.core.database import SCHEDULER_SOCKET
 from lib.detector.core.guest import GuestManager
 from lib.detector.core.plugins import list_plugins, RunAuxiliary, RunProcessing
 from lib.detector.core.plugins import RunSignatures, RunReporting
@@ -27,6 +30,18 @@ latest_symlink_lock = threading.Lock()
 
 active_analysis_count = 0
 
+# Set whenever the scheduler may be able to dispatch new tasks, i.e., when a
+# task has been submitted, a machine has been released or has finished
+# starting up, or an analysis has completed.
+scheduler_wakeup = threading.Event()
+
+# Seconds after which the scheduler looks for new tasks even if it has not
+# been woken up, e.g., for tasks submitted from another host.
+POLL_INTERVAL = 1
+
+# Seconds between two reports of the dispatch metrics.
+METRICS_INTERVAL = 300
+
 class AnalysisManager(threading.Thread):
     """Analysis Manager.
 
@@ -36,8 +51,11 @@ class AnalysisManager(threading.Thread):
     complete the analysis and store, process and report its results.
     """
 
-    def __init__(self, task, error_queue):
-        """@param task: task object containing the details for the analysis."""
+    def __init__(self, task, error_queue, machine):
+        """@param task: task object containing the details for the analysis.
+        @param error_queue: queue to report errors to.
+        @param machine: machine locked for this analysis by the scheduler.
+        """
         threading.Thread.__init__(self)
 
         self.task = task
@@ -45,7 +63,7 @@ class AnalysisManager(threading.Thread):
         self.cfg = Config()
         self.storage = ""
         self.binary = ""
-        self.machine = None
+        self.machine = machine
         self.db = Database()
 
         self.task.options = parse_options(self.task.options)
@@ -121,39 +139,11 @@ class AnalysisManager(threading.Thread):
         return True
 
     def acquire_machine(self):
-        """Acquire an analysis machine from the pool of available ones."""
-        machine = None
-
-        # Start a loop to acquire the a machine to run the analysis on.
-        while True:
-            machine_lock.acquire()
-
-            # In some cases it's possible that we enter this loop without
-            # having any available machines. We should make sure this is not
-            # such case, or the analysis task will fail completely.
-            if not machinery.availables():
-                machine_lock.release()
-                time.sleep(1)
-                continue
-
-            # If the user specified a specific machine ID, a platform to be
-            # used or machine tags acquire the machine accordingly.
-            machine = machinery.acquire(machine_id=self.task.machine,
-                                        platform=self.task.platform,
-                                        tags=self.task.tags)
-
-            # If no machine is available at this moment, wait for one second
-            # and try again.
-            if not machine:
-                machine_lock.release()
-                log.debug("Task #%d: no machine available yet", self.task.id)
-                time.sleep(1)
-            else:
-                log.info("Task #%d: acquired machine %s (label=%s)",
-                         self.task.id, machine.name, machine.label)
-                break
-
-        self.machine = machine
+        """Wait for our turn to start the analysis machine, as only a limited
+        amount of machines are started at once."""
+        machine_lock.acquire()
+        log.info("Task #%d: acquired machine %s (label=%s)",
+                 self.task.id, self.machine.name, self.machine.label)
 
     def build_options(self):
         """Generate analysis options.
@@ -261,19 +251,11 @@ class AnalysisManager(threading.Thread):
 
             self.db.guest_set_status(self.task.id, "stopping")
 
-    def launch_analysis(self):
-        """Start analysis."""
-        succeeded = False
-
-        target = self.task.target
-        if self.task.category == "file":
-            target = os.path.basename(target)
-
-        log.info("Starting analysis of %s \"%s\" (task #%d, options \"%s\")",
-                 self.task.category.upper(), target, self.task.id,
-                 emit_options(self.task.options))
-
-        # Initialize the analysis folders.
+    def prepare_analysis(self):
+        """Initialize the analysis folders and, for files, verify and store
+        a copy of the target.
+        @return: operation status.
+        """
         if not self.init_storage():
             return False
 
@@ -287,14 +269,29 @@ class AnalysisManager(threading.Thread):
             if not self.store_file():
                 return False
 
-        # Acquire analysis machine.
-        try:
-            self.acquire_machine()
-        except DetectorOperationalError as e:
-            machine_lock.release()
-            log.error("Cannot acquire machine: {0}".format(e))
+        return True
+
+    def launch_analysis(self):
+        """Start analysis."""
+        succeeded = False
+
+        target = self.task.target
+        if self.task.category == "file":
+            target = os.path.basename(target)
+
+        log.info("Starting analysis of %s \"%s\" (task #%d, options \"%s\")",
+                 self.task.category.upper(), target, self.task.id,
+                 emit_options(self.task.options))
+
+        if not self.prepare_analysis():
+            # Hand the machine locked for us back to the scheduler.
+            machinery.release(self.machine.label)
+            scheduler_wakeup.set()
             return False
 
+        # Wait for our turn to start the analysis machine.
+        self.acquire_machine()
+
         # At this point we can tell the ResultServer about it.
         try:
             ResultServer().add_task(self.task, self.machine)
@@ -326,6 +323,7 @@ class AnalysisManager(threading.Thread):
             # By the time start returns it will have fully started the Virtual
             # Machine. We can now safely release the machine lock.
             machine_lock.release()
+            scheduler_wakeup.set()
             unlocked = True
 
             # Run and manage the components inside the guest unless this
@@ -398,6 +396,8 @@ class AnalysisManager(threading.Thread):
                           "You might need to restore it manually.",
                           self.machine.label, e)
 
+            scheduler_wakeup.set()
+
         return succeeded
 
     def process_results(self):
@@ -484,6 +484,7 @@ class AnalysisManager(threading.Thread):
             log.exception("Failure in AnalysisManager.run")
 
         active_analysis_count -= 1
+        scheduler_wakeup.set()
 
 class Scheduler(object):
     """Tasks Scheduler.
@@ -501,6 +502,15 @@ class Scheduler(object):
         self.db = Database()
         self.maxcount = maxcount
         self.total_analysis_count = 0
+        self.metrics = {
+            "wakeups": 0,
+            "dispatched": 0,
+            "latency_total": 0.0,
+            "latency_max": 0.0,
+        }
+        self.metrics_reported = time.time()
+        self.freespace_checked = 0
+        self.freespace_ok = True
 
     def initialize(self):
         """Initialize the machine manager."""
@@ -557,8 +567,9 @@ class Scheduler(object):
         if len(machinery.machines()) > 4 and self.cfg.detector.process_results:
             log.warning("When running many virtual machines it is recommended "
                         "to process the results in a separate process.py to "
-                        "increase throughput and stability. Please read the "
-                        "documentation about the `Processing Utility`.")
+                        "increase throughput and stability. Disable "
+                        "`process_results` and run `utils/process.py -p N` "
+                        "on one or more hosts instead.")
 
         # Drop all existing packet forwarding rules for each VM. Just in case
         # Detector was terminated for some reason and various forwarding rules
@@ -583,6 +594,153 @@ class Scheduler(object):
                 rooter("forward_disable", machine.interface,
                        self.cfg.routing.internet, machine.ip)
 
+    def listen(self, path=None):
+        """Listen for notifications of newly submitted tasks. Without them,
+        new tasks are still picked up within the polling interval.
+        @param path: path of the scheduler socket.
+        @return: listening thread or None.
+        """
+        if not hasattr(socket, "AF_UNIX"):
+            return
+
+        path = path or SCHEDULER_SOCKET
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            if os.path.exists(path):
+                os.unlink(path)
+            sock.bind(path)
+        except (OSError, socket.error) as e:
+            log.warning("Unable to listen for task submissions, new tasks "
+                        "will be picked up every %d second(s): %s",
+                        POLL_INTERVAL, e)
+            sock.close()
+            return
+
+        def notified():
+            try:
+                while self.running:
+                    sock.recv(64)
+                    scheduler_wakeup.set()
+            except socket.error as e:
+                log.warning("Stopped listening for task submissions, new "
+                            "tasks will be picked up every %d second(s): %s",
+                            POLL_INTERVAL, e)
+            finally:
+                sock.close()
+
+        t = threading.Thread(target=notified)
+        t.daemon = True
+        t.start()
+        return t
+
+    def wait(self):
+        """Wait until the scheduler is woken up, or for at most the polling
+        interval, so that tasks are picked up even if a notification is lost.
+        @return: whether the scheduler has been woken up.
+        """
+        woken = scheduler_wakeup.wait(POLL_INTERVAL)
+        scheduler_wakeup.clear()
+        self.metrics["wakeups"] += 1
+        return woken
+
+    def enough_freespace(self):
+        """Check whether there is enough free disk space available for new
+        analyses (this check is ignored when the freespace configuration
+        variable is set to zero). Done at most once per polling interval.
+        @return: boolean
+        """
+        if not self.cfg.detector.freespace:
+            return True
+
+        # TODO: Windows support
+        if not hasattr(os, "statvfs"):
+            return True
+
+        if time.time() - self.freespace_checked < POLL_INTERVAL:
+            return self.freespace_ok
+
+        self.freespace_checked = time.time()
+
+        # Resolve the full base path to the analysis folder, just in
+        # case somebody decides to make a symbolic link out of it.
+        dir_path = os.path.join(DETECTOR_ROOT, "storage", "analyses")
+        dir_stats = os.statvfs(dir_path)
+
+        # Calculate the free disk space in megabytes.
+        space_available = dir_stats.f_bavail * dir_stats.f_frsize
+        space_available /= 1024 * 1024
+
+        self.freespace_ok = space_available >= self.cfg.detector.freespace
+        if not self.freespace_ok:
+            log.error("Not enough free disk space! (Only %d MB!)",
+                      space_available)
+        return self.freespace_ok
+
+    def dispatch(self, errors):
+        """Start an analysis for as many pending tasks as there are
+        machines available for them.
+        @param errors: queue to which the analysis managers report errors.
+        @return: amount of tasks dispatched.
+        """
+        limit = machinery.availables()
+
+        # Have we limited the number of concurrently executing machines?
+        if self.cfg.detector.max_machines_count:
+            limit = min(limit, self.cfg.detector.max_machines_count -
+                        len(machinery.running()))
+
+        # Exits if max_analysis_count is defined in the configuration
+        # file and has been reached.
+        if self.maxcount:
+            if self.total_analysis_count >= self.maxcount:
+                if active_analysis_count <= 0:
+                    log.debug("Reached max analysis count, exiting.")
+                    self.stop()
+                return 0
+
+            limit = min(limit, self.maxcount - self.total_analysis_count)
+
+        # If no machines are available, it's pointless to fetch for
+        # pending tasks.
+        if limit <= 0:
+            return 0
+
+        assignments = self.db.assign_tasks(limit)
+
+        now = datetime.datetime.now()
+        for task, machine in assignments:
+            latency = (now - task.added_on).total_seconds()
+            log.debug("Processing task #%s on machine %s (waited %.3fs)",
+                      task.id, machine.name, latency)
+
+            self.total_analysis_count += 1
+            self.metrics["dispatched"] += 1
+            self.metrics["latency_total"] += latency
+            self.metrics["latency_max"] = max(
+                self.metrics["latency_max"], latency
+            )
+
+            # Initialize and start the analysis manager.
+            analysis = AnalysisManager(task, errors, machine)
+            analysis.daemon = True
+            analysis.start()
+
+        return len(assignments)
+
+    def report_metrics(self):
+        """Periodically log how fast tasks are being dispatched."""
+        if time.time() - self.metrics_reported < METRICS_INTERVAL:
+            return
+
+        self.metrics_reported = time.time()
+        if self.metrics["dispatched"]:
+            log.info("Dispatched %d task(s) in %d wakeup(s), average wait "
+                     "%.3fs, maximum wait %.3fs", self.metrics["dispatched"],
+                     self.metrics["wakeups"],
+                     self.metrics["latency_total"] /
+                     self.metrics["dispatched"],
+                     self.metrics["latency_max"])
+
     def stop(self):
         """Stop scheduler."""
         self.running = False
@@ -602,89 +760,24 @@ class Scheduler(object):
         if self.maxcount is None:
             self.maxcount = self.cfg.detector.max_analysis_count
 
+        # Tasks submitted on this host wake us up right away.
+        self.listen()
+
         # This loop runs forever.
         while self.running:
-            time.sleep(1)
-
-            # Wait until the machine lock is not locked. This is only the case
-            # when all machines are fully running, rather that about to start
-            # or still busy starting. This way we won't have race conditions
-            # with finding out there are no available machines in the analysis
-            # manager or having two analyses pick the same machine.
-            if not machine_lock.acquire(False):
-                continue
-
-            machine_lock.release()
+            self.wait()
 
-            # If not enough free disk space is available, then we print an
-            # error message and wait another round (this check is ignored
-            # when the freespace configuration variable is set to zero).
-            if self.cfg.detector.freespace:
-                # Resolve the full base path to the analysis folder, just in
-                # case somebody decides to make a symbolic link out of it.
-                dir_path = os.path.join(DETECTOR_ROOT, "storage", "analyses")
-
-                # TODO: Windows support
-                if hasattr(os, "statvfs"):
-                    dir_stats = os.statvfs(dir_path)
-
-                    # Calculate the free disk space in megabytes.
-                    space_available = dir_stats.f_bavail * dir_stats.f_frsize
-                    space_available /= 1024 * 1024
-
-                    if space_available < self.cfg.detector.freespace:
-                        log.error("Not enough free disk space! (Only %d MB!)",
-                                  space_available)
-                        continue
-
-            # Have we limited the number of concurrently executing machines?
-            if self.cfg.detector.max_machines_count:
-                # Are too many running?
-                if len(machinery.running()) >= self.cfg.detector.max_machines_count:
-                    continue
-
-            # If no machines are available, it's pointless to fetch for
-            # pending tasks. Loop over.
-            if not machinery.availables():
+            # If not enough free disk space is available, then we wait
+            # another round.
+            if not self.enough_freespace():
                 continue
 
-            # Exits if max_analysis_count is defined in the configuration
-            # file and has been reached.
-            if self.maxcount and self.total_analysis_count >= self.maxcount:
-                if active_analysis_count <= 0:
-                    log.debug("Reached max analysis count, exiting.")
-                    self.stop()
-                continue
+            # Keep dispatching until we run out of either pending tasks or
+            # available machines, rather than one task per wakeup.
+            while self.running and self.dispatch(errors):
+                pass
 
-            # Fetch a pending analysis task.
-            # TODO This fixes only submissions by --machine, need to add
-            # other attributes (tags etc).
-            # TODO We should probably move the entire "acquire machine" logic
-            # from the Analysis Manager to the Scheduler and then pass the
-            # selected machine onto the Analysis Manager instance.
-            task, available = None, False
-            for machine in self.db.get_available_machines():
-                task = self.db.fetch(machine=machine.name)
-                if task:
-                    break
-
-                if machine.is_analysis():
-                    available = True
-
-            # We only fetch a new task if at least one of the available
-            # machines is not a "service" machine (again, please refer to the
-            # services auxiliary module for more information on service VMs).
-            if not task and available:
-                task = self.db.fetch(service=False)
-
-            if task:
-                log.debug("Processing task #%s", task.id)
-                self.total_analysis_count += 1
-
-                # Initialize and start the analysis manager.
-                analysis = AnalysisManager(task, errors)
-                analysis.daemon = True
-                analysis.start()
+            self.report_metrics()
 
             # Deal with errors.
             try:
@@ -4,6 +4,7 @@ import logging
 import subprocess
 
 from lib.detector.common.abstracts import Auxiliary
+from lib.detector.common.config import Config
 from lib.detector.common.constants import DETECTOR_ROOT, DETECTOR_GUEST_PORT
 
 log = logging.getLogger(__name__)
@@ -12,6 +13,7 @@ class Sniffer(Auxiliary):
     def __init__(self):
         Auxiliary.__init__(self)
         self.proc = None
+        self.live = None
 
     def start(self):
         if not self.machine.interface:
@@ -93,6 +95,22 @@ class Sniffer(Auxiliary):
             self.proc.pid, self.machine.interface, self.machine.ip, file_path,
         )
 
+        # Process the network traffic while it's being captured. The network
+        # processing module is only imported if needed.
+        if self.options.get("live"):
+            from modules.processing.network import HAVE_DPKT, LivePcap
+            if not HAVE_DPKT:
+                log.warning("Python DPKT is not installed, unable to process "
+                            "the network traffic while it's being captured")
+                return
+
+            self.live = LivePcap(
+                file_path, Config("processing").get("network"),
+                self.options.get("checkpoint_interval") or 30,
+                self.options.get("stop_timeout") or 60
+            )
+            self.live.start()
+
     def stop(self):
         """Stop sniffing.
         @return: operation status.
@@ -111,3 +129,6 @@ class Sniffer(Auxiliary):
                 except Exception as e:
                     log.exception("Unable to stop the sniffer with pid %d: %s",
                                   self.proc.pid, e)
+
+        if self.live:
+            self.live.stop()
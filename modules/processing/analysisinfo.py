@@ -11,6 +11,8 @@ log = logging.getLogger(__name__)
 class AnalysisInfo(Processing):
     """General information about analysis session."""
 
+    dependencies = []
+
     def run(self):
         """Run information gathering.
         @return: information dict.
@@ -22,6 +22,8 @@ log = logging.getLogger(__name__)
 class ApkInfo(Processing):
     """Static android information about analysis session."""
 
+    dependencies = []
+
     def check_size(self, file_list):
         for file in file_list:
             if "classes.dex" in file["name"]:
@@ -1,3 +1,4 @@
+import cPickle
 import json
 import logging
 import os.path
@@ -6,9 +7,16 @@ from lib.detector.common.abstracts import Processing
 
 log = logging.getLogger(__name__)
 
+# Fields of the rows of a Volatility plugin that are not part of their key,
+# as they change regardless of what happens during the analysis.
+IGNORED_FIELDS = {
+    "pslist": ["num_threads", "num_handles"],
+}
+
 class Baseline(Processing):
     """Reduces Baseline results from gathered information."""
     order = 2
+    dependencies = ["analysisinfo", "memory"]
 
     def deep_tuple(self, o, bl=None):
         if isinstance(o, (tuple, list)):
@@ -28,46 +36,124 @@ class Baseline(Processing):
         return o
 
     def normalize(self, plugin, o):
-        plugins = {
-            "pslist": ["num_threads", "num_handles"],
-        }
-        return self.deep_tuple(o, plugins.get(plugin))
-
-    def memory(self, baseline, report):
+        return self.deep_tuple(o, IGNORED_FIELDS.get(plugin))
+
+    def roundtrip(self, o):
+        """Convert results as they would be loaded from a baseline report,
+        e.g., with lists rather than tuples and string keys only, so that
+        they're indexed the same."""
+        return json.loads(json.dumps(o, encoding="latin-1"))
+
+    def index(self, plugin, rows):
+        """Index the rows of a plugin by their key.
+        @param plugin: Volatility plugin name.
+        @param rows: plugin rows.
+        @return: dict mapping each key to the positions of its rows.
+        """
+        index = {}
+        for idx, row in enumerate(rows):
+            index.setdefault(self.normalize(plugin, row), []).append(idx)
+        return index
+
+    def difference(self, index, other):
+        """Find the rows of one index that have no counterpart in the other.
+        Rows are compared as a multiset, i.e., if a key has more rows in
+        the first index, the excess rows are part of the difference.
+        @param index: index of the rows.
+        @param other: index of the rows to compare against.
+        @return: sorted positions of the rows.
+        """
+        ret = []
+        for key, positions in index.iteritems():
+            count = len(other.get(key, ()))
+            if len(positions) > count:
+                ret.extend(positions[count:])
+        return sorted(ret)
+
+    def memory(self, baseline, report, indexes=None):
         """Finds the differences between the analysis report and the baseline
         report. Puts the differences into the baseline part of the report and
-        also marks the existing rows with a `class_` attribute."""
+        also marks the existing rows with a `class_` attribute.
+        @param baseline: baseline memory results.
+        @param report: analysis memory results.
+        @param indexes: precomputed baseline index of each plugin.
+        """
         results = {}
 
-        for plugin in baseline.keys() + report.keys():
+        for plugin in set(baseline.keys() + report.keys()):
             results[plugin] = {
                 "config": {},
                 "data": [],
             }
 
-        # TODO Support having more keys in one report than the other.
-        for plugin in set(baseline.keys() + report.keys()):
-            lr = [self.normalize(plugin, x) for x in report[plugin]["data"]]
-            lb = [self.normalize(plugin, x) for x in baseline[plugin]["data"]]
-            sr, sb = set(lr), set(lb)
+            # Plugins that are missing from the analysis report are not added
+            # to it, the rows no longer present are only in the results.
+            lb = baseline.get(plugin, {}).get("data", [])
+            lr = report.get(plugin, {}).get("data", [])
+
+            if indexes and plugin in indexes:
+                ib = indexes[plugin]
+            else:
+                ib = self.index(plugin, lb)
+            ir = self.index(plugin, self.roundtrip(lr))
+
+            # Analysis vs Baseline. These events were added during
+            # the analysis.
+            added = [lr[idx] for idx in self.difference(ir, ib)]
 
             # Baseline vs Analysis. These events were no longer present
             # after the analysis.
-            for row in sb.difference(sr):
-                row = baseline[plugin]["data"][lb.index(row)]
+            for idx in self.difference(ib, ir):
+                row = lb[idx]
                 row["class_"] = "warning"
                 results[plugin]["data"].append(row)
-                report[plugin]["data"].append(row)
+                lr.append(row)
 
-            # Analysis vs Baseline. These events were added during
-            # the analysis.
-            for row in sr.difference(sb):
-                row = report[plugin]["data"][lr.index(row)]
+            for row in added:
                 row["class_"] = "danger"
                 results[plugin]["data"].append(row)
 
         return results
 
+    def store_index(self, baseline, memory):
+        """Store the index of a baseline report next to it, so that it
+        doesn't have to be computed again for each analysis.
+        @param baseline: path of the baseline report.
+        @param memory: memory results as loaded from the baseline report.
+        """
+        index = {
+            "size": os.path.getsize(baseline),
+            "mtime": os.path.getmtime(baseline),
+            "fields": IGNORED_FIELDS,
+            "memory": dict((plugin, self.index(plugin, results["data"]))
+                           for plugin, results in memory.items()),
+        }
+
+        path = os.path.splitext(baseline)[0] + ".idx"
+        with open(path + ".tmp", "wb") as f:
+            cPickle.dump(index, f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(path + ".tmp", path)
+        return index
+
+    def load_index(self, baseline):
+        """Load the index of a baseline report, if it's up-to-date."""
+        path = os.path.splitext(baseline)[0] + ".idx"
+        if not os.path.isfile(path):
+            return
+
+        try:
+            with open(path, "rb") as f:
+                index = cPickle.load(f)
+        except Exception as e:
+            log.warning("Index of baseline report %s seems corrupted, "
+                        "rebuilding it: %s.", baseline, e)
+            return
+
+        if index.get("size") == os.path.getsize(baseline) and \
+                index.get("mtime") == os.path.getmtime(baseline) and \
+                index.get("fields") == IGNORED_FIELDS:
+            return index
+
     def store_baseline(self, machine, baseline):
         """Store a new baseline report for a particular VM."""
         results = {
@@ -77,6 +163,8 @@ class Baseline(Processing):
         with open(baseline, "wb") as report:
             json.dump(results, report, indent=4, encoding="latin-1")
 
+        self.store_index(baseline, self.roundtrip(results["memory"]))
+
     def run(self):
         self.key = "baseline"
 
@@ -110,7 +198,21 @@ class Baseline(Processing):
         results = {}
 
         if "memory" in self.results:
-            results["memory"] = \
-                self.memory(self.baseline["memory"], self.results["memory"])
+            # Baseline reports stored before they were indexed, or with
+            # different ignored fields, are indexed once here.
+            index = self.load_index(baseline)
+            if not index:
+                try:
+                    index = self.store_index(baseline,
+                                             self.baseline.get("memory", {}))
+                except (IOError, OSError) as e:
+                    log.warning("Unable to store the index of the baseline "
+                                "report for machine '%s': %s.", machine, e)
+                    index = {"memory": {}}
+
+            results["memory"] = self.memory(
+                self.baseline.get("memory", {}), self.results["memory"],
+                index["memory"]
+            )
 
         return results
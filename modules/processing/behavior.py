@@ -140,7 +140,7 @@ class GenericBehavior(BehaviorHandler):
 class ApiStats(BehaviorHandler):
     """Counts API calls."""
     key = "apistats"
-    event_types = ["apicall"]
+    event_types = ["apicall", "apistats"]
 
     def __init__(self, *args, **kwargs):
         super(ApiStats, self).__init__(*args, **kwargs)
@@ -149,6 +149,12 @@ class ApiStats(BehaviorHandler):
     def handle_event(self, event):
         self.processes["%d" % event["pid"]][event["api"]] += 1
 
+    def handle_apistats_event(self, event):
+        """API calls that have already been counted, e.g., by the
+        ResultServer."""
+        for api, count in event["apistats"]:
+            self.processes["%d" % event["pid"]][api] += count
+
     def run(self):
         return self.processes
 
@@ -222,6 +228,8 @@ class BehaviorAnalysis(Processing):
     """
 
     key = "behavior"
+    dependencies = []
+    forks = True
 
     def _enum_logs(self):
         """Enumerate all behavior logs."""
@@ -296,10 +304,16 @@ class BehaviorAnalysis(Processing):
                 elif h.handle_event not in interest_map[event_type]:
                     interest_map[event_type].append(h.handle_event)
 
+        paths = list(self._enum_logs())
+
+        # Allow handlers to preprocess the log files, e.g., in parallel.
+        for handler in handlers:
+            handler.prepare(paths)
+
         # Each log file should be parsed by one of the handlers. This handler
         # then yields every event in it which are forwarded to the various
         # behavior/analysis/etc handlers.
-        for path in self._enum_logs():
+        for path in paths:
             for handler in handlers:
                 # ... whether it is responsible
                 if not handler.handles_path(path):
@@ -6,6 +6,8 @@ from lib.detector.common.objects import File
 class DroppedBuffer(Processing):
     """Dropped buffer analysis."""
 
+    dependencies = []
+
     def run(self):
         """Run analysis.
         @return: list of dropped files with related information.
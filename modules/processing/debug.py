@@ -8,6 +8,8 @@ from lib.detector.core.database import Database
 class Debug(Processing):
     """Analysis debug information."""
 
+    dependencies = []
+
     def run(self):
         """Run debug analysis.
         @return: debug information dict.
@@ -8,6 +8,8 @@ log = logging.getLogger(__name__)
 class Droidmon(Processing):
     """Extract Dynamic API calls Info From Droidmon logs."""
 
+    dependencies = []
+
     def __init__(self):
         self.key = "droidmon"
 
@@ -1,28 +1,175 @@
+import logging
+import multiprocessing
 import os
+import threading
+import time
 
 from lib.detector.common.abstracts import Processing
 from lib.detector.common.objects import File
 
+log = logging.getLogger(__name__)
+
+def analyze_file(file_path):
+    """Analyze a dropped file in one of the worker processes.
+    @param file_path: file path.
+    @return: file information dict.
+    """
+    return File(file_path=file_path).get_all()
+
+def file_hashes(file_path):
+    """Information on a dropped file whose analysis failed or took too
+    long, i.e., only its hashes.
+    @param file_path: file path.
+    @return: file information dict.
+    """
+    f = File(file_path=file_path)
+    return {
+        "name": f.get_name(),
+        "path": file_path,
+        "size": f.get_size(),
+        "crc32": f.get_crc32(),
+        "md5": f.get_md5(),
+        "sha1": f.get_sha1(),
+        "sha256": f.get_sha256(),
+        "sha512": f.get_sha512(),
+        "ssdeep": None,
+        "type": None,
+        "yara": [],
+        "urls": [],
+    }
+
 class Dropped(Processing):
     """Dropped files analysis."""
 
+    dependencies = []
+    forks = True
+
+    def enum_files(self):
+        """Enumerate the dropped files in a deterministic order."""
+        for path in (self.dropped_path, self.package_files):
+            for dir_name, dir_names, file_names in os.walk(path):
+                dir_names.sort()
+                for file_name in sorted(file_names):
+                    yield os.path.join(dir_name, file_name)
+
+    def unique_files(self, paths):
+        """Find the dropped files with identical contents. Only files of the
+        same size are hashed for this.
+        @param paths: file paths.
+        @return: dict mapping each duplicate to the first file path with
+                 the same contents.
+        """
+        sizes = {}
+        for path in paths:
+            sizes.setdefault(os.path.getsize(path), []).append(path)
+
+        duplicates = {}
+        for same_size in sizes.values():
+            if len(same_size) < 2:
+                continue
+
+            hashes = {}
+            for path in same_size:
+                sha256 = File(file_path=path).get_sha256()
+                if sha256 in hashes:
+                    duplicates[path] = hashes[sha256]
+                else:
+                    hashes[sha256] = path
+        return duplicates
+
+    def analyze_files(self, paths, workers, budget):
+        """Analyze the dropped files in worker processes. Each worker has a
+        pool of its own, so that a worker that exceeds the time budget of a
+        file, e.g., in Yara or another C extension, can be terminated and
+        replaced without affecting the other workers.
+        @param paths: file paths.
+        @param workers: amount of worker processes.
+        @param budget: seconds per file, 0 for no limit.
+        @return: dict mapping file paths to file information dicts.
+        """
+        pending, running, infos = list(paths), {}, {}
+        finished = threading.Event()
+        pools = [multiprocessing.Pool(1) for _ in xrange(workers)]
+
+        try:
+            while pending or running:
+                for idx, pool in enumerate(pools):
+                    if idx in running or not pending:
+                        continue
+
+                    path = pending.pop(0)
+                    result = pool.apply_async(
+                        analyze_file, (path,),
+                        callback=lambda _: finished.set()
+                    )
+                    running[idx] = path, result, \
+                        time.time() + budget if budget else None
+
+                # Failed analyses don't call back, hence the upper bound.
+                now = time.time()
+                deadlines = [deadline for _, _, deadline in running.values()
+                             if deadline]
+                finished.wait(max(min(deadlines + [now + 1]) - now, 0))
+                finished.clear()
+
+                for idx, (path, result, deadline) in running.items():
+                    if result.ready():
+                        try:
+                            infos[path] = result.get()
+                        except Exception as e:
+                            log.warning("Failed to analyze dropped file %s, "
+                                        "only its hashes are reported: %s",
+                                        path, e)
+                            infos[path] = file_hashes(path)
+                    elif deadline and deadline <= time.time():
+                        log.warning("Analysis of dropped file %s took longer "
+                                    "than %d seconds, only its hashes are "
+                                    "reported", path, budget)
+                        pools[idx].terminate()
+                        pools[idx].join()
+                        pools[idx] = multiprocessing.Pool(1)
+                        infos[path] = file_hashes(path)
+                    else:
+                        continue
+
+                    del running[idx]
+        finally:
+            for pool in pools:
+                pool.terminate()
+                pool.join()
+
+        return infos
+
     def run(self):
         """Run analysis.
         @return: list of dropped files with related information.
         """
         self.key = "dropped"
-        dropped_files = []
+        workers = self.options.get("workers") or 0
+        budget = self.options.get("file_timeout") or 0
+
+        paths = list(self.enum_files())
+        duplicates = self.unique_files(paths)
+        unique = [path for path in paths if path not in duplicates]
 
-        for dir_name, dir_names, file_names in os.walk(self.dropped_path):
-            for file_name in file_names:
-                file_path = os.path.join(dir_name, file_name)
-                file_info = File(file_path=file_path).get_all()
-                dropped_files.append(file_info)
-
-        for dir_name, dir_names, file_names in os.walk(self.package_files):
-            for file_name in file_names:
-                file_path = os.path.join(dir_name, file_name)
-                file_info = File(file_path=file_path).get_all()
-                dropped_files.append(file_info)
+        if workers < 2 or len(unique) < 2:
+            # The time budget is only enforced for worker processes.
+            infos = dict((path, analyze_file(path)) for path in unique)
+        else:
+            # Start with the biggest files to keep the workers equally busy.
+            infos = self.analyze_files(
+                sorted(unique, key=os.path.getsize, reverse=True),
+                min(workers, len(unique)), budget
+            )
+
+        dropped_files = []
+        for path in paths:
+            if path in duplicates:
+                file_info = dict(infos[duplicates[path]])
+                file_info["name"] = os.path.basename(path)
+                file_info["path"] = path
+            else:
+                file_info = infos[path]
+            dropped_files.append(file_info)
 
         return dropped_files
@@ -11,6 +11,7 @@ class TLSMasterSecrets(Processing):
 
     order = 3
     key = "dumptls"
+    dependencies = ["behavior", "network"]
 
     def run(self):
         metakeys = {}
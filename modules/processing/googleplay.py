@@ -23,6 +23,8 @@ log = logging.getLogger(__name__)
 class GooglePlay(Processing):
     """Google Play information about the analysis session"""
 
+    dependencies = []
+
     def run(self):
         """Run Google play unofficial python api the get the google play information
         @return: list of google play features
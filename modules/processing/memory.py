@@ -1004,6 +1004,8 @@ class VolatilityManager(object):
 class Memory(Processing):
     """Volatility Analyzer."""
 
+    dependencies = []
+
     def run(self):
         """Run analysis.
         @return: volatility results dict.
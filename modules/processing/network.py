@@ -1,18 +1,27 @@
+import collections
+import cPickle
+import hashlib
+import heapq
 import logging
 import json
 import os
 import re
+import shutil
 import socket
 import struct
 import tempfile
+import threading
+import time
 import urlparse
 
 from lib.detector.common.abstracts import Processing
+from lib.detector.common.addresses import AddressRanges, PRIVATE_NETWORKS
 from lib.detector.common.config import Config
-from lib.detector.common.dns import resolve
+from lib.detector.common.dns import parse_server, resolve_many
 from lib.detector.common.irc import ircMessage
 from lib.detector.common.objects import File
 from lib.detector.common.utils import convert_to_printable
+from lib.detector.common.exceptions import DetectorOperationalError
 from lib.detector.common.exceptions import DetectorProcessingError
 
 try:
@@ -32,47 +41,209 @@ try:
 except ImportError:
     HAVE_HTTPREPLAY = False
 
-# Imports for the batch sort.
-# http://stackoverflow.com/questions/10665925/how-to-sort-huge-files-with-python
-# http://code.activestate.com/recipes/576755/
-import heapq
-from itertools import islice
-from collections import namedtuple
-
-Keyed = namedtuple("Keyed", ["key", "obj"])
-Packet = namedtuple("Packet", ["raw", "ts"])
-
 log = logging.getLogger(__name__)
 cfg = Config()
 
+# Domains that are not reported.
+DOMAIN_FILTERS = [
+    re.compile(".*\\.windows\\.com$"),
+    re.compile(".*\\.in\\-addr\\.arpa$"),
+]
+
+# Flow identifier of the packets that are not IP packets, or can't be parsed,
+# which sorts them after all flows. They are not part of any flow.
+NON_IP_FLOW = 0xffffffff
+
+# Magic of the global header of a PCAP file, mapped to the byte order and the
+# resolution of the timestamps of the file.
+PCAP_MAGIC = {
+    "\xd4\xc3\xb2\xa1": ("<", 1e6),
+    "\xa1\xb2\xc3\xd4": (">", 1e6),
+    "\x4d\x3c\xb2\xa1": ("<", 1e9),
+    "\xa1\xb2\x3c\x4d": (">", 1e9),
+}
+
+# Version of the format of the processing checkpoints, see Pcap.checkpoint().
+CHECKPOINT_VERSION = 3
+
+class Flow(object):
+    """Entry of the flow table, identified by the (src, dst, sport, dport,
+    proto) tuple of its first packet. The other IP protocols than TCP and
+    UDP have one flow per pair of hosts."""
+
+    __slots__ = "key", "id", "reported"
+
+    def __init__(self, key, id):
+        self.key = key
+        # Flows are numbered in the order they're first seen.
+        self.id = id
+        # Whether the flow has been reported as a TCP or UDP connection.
+        self.reported = False
+
+class FlowSorter(object):
+    """External sort of the packets of a PCAP file by flow. Each packet is
+    represented by a compact (flow, timestamp, offset, length) record. The
+    records are sorted in chunks, which are spilled to temporary files and
+    merged at the end, so that memory usage is bounded by the chunk size
+    rather than by the size of the PCAP file."""
+
+    RECORD = struct.Struct("<IdQI")
+
+    # Amount of records that are sorted in memory.
+    CHUNK_SIZE = 256 * 1024
+
+    def __init__(self, chunk_size=CHUNK_SIZE, path=None):
+        """@param chunk_size: amount of records that are sorted in memory.
+        @param path: directory to spill the chunks to, which is required
+                     to checkpoint the sorter, or None for temporary files.
+        """
+        self.chunk_size = chunk_size
+        self.path = path
+        self.records = []
+        self.chunks = []
+
+    def __getstate__(self):
+        if not self.path:
+            raise DetectorProcessingError("Unable to checkpoint a flow "
+                                          "sorter with temporary chunks")
+
+        return {
+            "chunk_size": self.chunk_size,
+            "path": self.path,
+            "records": self.records,
+            "chunks": [f.name for f in self.chunks],
+        }
+
+    def __setstate__(self, state):
+        self.chunk_size = state["chunk_size"]
+        self.path = state["path"]
+        self.records = state["records"]
+        self.chunks = [open(name, "rb") for name in state["chunks"]]
+
+    def add(self, flow, ts, offset, length):
+        """Add the record of a packet.
+        @param flow: flow identifier.
+        @param ts: timestamp of the packet.
+        @param offset: offset of the packet record in the PCAP file.
+        @param length: length of the packet record in the PCAP file.
+        """
+        self.records.append((flow, float(ts), offset, length))
+        if len(self.records) >= self.chunk_size:
+            self._spill()
+
+    def _spill(self):
+        self.records.sort()
+
+        if self.path:
+            f = tempfile.NamedTemporaryFile(dir=self.path, suffix=".chunk",
+                                            delete=False)
+        else:
+            f = tempfile.TemporaryFile()
+
+        for idx in xrange(0, len(self.records), 4096):
+            f.write("".join(self.RECORD.pack(*record) for record in
+                            self.records[idx:idx+4096]))
+        f.seek(0)
+
+        self.chunks.append(f)
+        self.records = []
+
+    def _read(self, f):
+        f.seek(0)
+        while True:
+            buf = f.read(self.RECORD.size * 4096)
+            if not buf:
+                break
+
+            for idx in xrange(0, len(buf), self.RECORD.size):
+                yield self.RECORD.unpack_from(buf, idx)
+
+    def __iter__(self):
+        """Iterate the records ordered by flow, by time within each flow,
+        and by position in the PCAP file for equal timestamps."""
+        self.records.sort()
+        if not self.chunks:
+            return iter(self.records)
+
+        return heapq.merge(self.records,
+                           *[self._read(f) for f in self.chunks])
+
+    def close(self):
+        for f in self.chunks:
+            f.close()
+            if self.path:
+                os.remove(f.name)
+        self.chunks = []
+        self.records = []
+
 class Pcap(object):
     """Reads network data from PCAP file."""
     ssl_ports = 443,
 
     notified_dpkt = False
 
-    def __init__(self, filepath):
+    def __init__(self, filepath, sorted_path=None, private_networks=(),
+                 chunks_path=None):
         """Creates a new instance.
         @param filepath: path to PCAP file
+        @param sorted_path: path to write the PCAP file sorted by flow to
+        @param private_networks: networks to consider private besides the
+                                 default ones
+        @param chunks_path: directory for the chunks of the flow sorter, which
+                            is required to checkpoint the processing
         """
         self.filepath = filepath
+        self.sorted_path = sorted_path
+        self.extra_networks = list(private_networks)
 
-        # List of all hosts.
-        self.hosts = []
+        self.private_networks = AddressRanges(PRIVATE_NETWORKS)
+        for network in private_networks:
+            try:
+                self.private_networks.add(network)
+            except DetectorOperationalError as e:
+                log.warning("Ignoring private network: %s", e)
+
+        # SHA256 hashes of the PCAP file and of the sorted PCAP file, and
+        # of the part of the PCAP file that has been processed so far.
+        self.sha256 = None
+        self.sorted_sha256 = None
+        self._sha256 = hashlib.sha256()
+
+        # Offset up to which the PCAP file has been processed, and the byte
+        # order and resolution of the timestamps of the PCAP file.
+        self.offset = 0
+        self.byteorder = None
+        self.divisor = None
+
+        # Flow table, in which each flow is present in both directions, and
+        # the flows in the order they're first seen.
+        self.flows = {}
+        self.flow_list = []
+        self.sorter = None
+        if sorted_path:
+            self.sorter = FlowSorter(path=chunks_path)
+        self.packets = 0
+        self.first_ts = None
+        self.linktype = 1
+
+        # Dissectors for the payload of each IP protocol, see add_dissector().
+        self._register_dissectors()
+
+        # Ordered set of all hosts.
+        self.hosts = collections.OrderedDict()
         # List containing all non-private IP addresses.
         self.unique_hosts = []
-        # List of unique domains.
+        # List of unique domains, and the set of their names.
         self.unique_domains = []
+        self.domains = set()
         # List containing all TCP packets.
         self.tcp_connections = []
-        self.tcp_connections_seen = set()
         # Lookup table to identify connection requests to services or IP
         # addresses that are no longer available.
         self.tcp_connections_dead = {}
         self.dead_hosts = {}
         # List containing all UDP packets.
         self.udp_connections = []
-        self.udp_connections_seen = set()
         # List containing all ICMP requests.
         self.icmp_requests = []
         # List containing all HTTP requests.
@@ -91,16 +262,31 @@ class Pcap(object):
         # Dictionary containing all the results of this processing.
         self.results = {}
 
-    def _dns_gethostbyname(self, name):
-        """Get host by name wrapper.
-        @param name: hostname.
-        @return: IP address or blank
+    def add_dissector(self, proto, dissector):
+        """Register a dissector, which is called with the connection dict and
+        the payload of each TCP or UDP packet that carries data, or with
+        the dpkt.icmp.ICMP object of each ICMP packet.
+        @param proto: IP protocol number, e.g., socket.IPPROTO_TCP.
+        @param dissector: callable.
         """
-        if cfg.processing.resolve_dns:
-            ip = resolve(name)
-        else:
-            ip = ""
-        return ip
+        self.dissectors.setdefault(proto, []).append(dissector)
+
+    def resolve_domains(self):
+        """Resolve the domains that haven't been resolved yet, all at once
+        and concurrently, rather than one after the other as they're found.
+        """
+        domains = [entry for entry in self.unique_domains
+                   if entry["ip"] is None]
+        if not domains:
+            return
+
+        ips = resolve_many(
+            [entry["domain"] for entry in domains],
+            workers=cfg.processing.dns_workers or 16,
+            server=parse_server(cfg.processing.dns_server),
+        )
+        for entry in domains:
+            entry["ip"] = ips.get(entry["domain"], "")
 
     def _is_private_ip(self, ip):
         """Check if the IP belongs to private network blocks.
@@ -108,40 +294,7 @@ class Pcap(object):
         @return: boolean representing whether the IP belongs or not to
                  a private network block.
         """
-        networks = [
-            "0.0.0.0/8",
-            "10.0.0.0/8",
-            "100.64.0.0/10",
-            "127.0.0.0/8",
-            "169.254.0.0/16",
-            "172.16.0.0/12",
-            "192.0.0.0/24",
-            "192.0.2.0/24",
-            "192.88.99.0/24",
-            "192.168.0.0/16",
-            "198.18.0.0/15",
-            "198.51.100.0/24",
-            "203.0.113.0/24",
-            "240.0.0.0/4",
-            "255.255.255.255/32",
-            "224.0.0.0/4"
-        ]
-
-        for network in networks:
-            try:
-                ipaddr = struct.unpack(">I", socket.inet_aton(ip))[0]
-
-                netaddr, bits = network.split("/")
-
-                network_low = struct.unpack(">I", socket.inet_aton(netaddr))[0]
-                network_high = network_low | (1 << (32 - int(bits))) - 1
-
-                if ipaddr <= network_high and ipaddr >= network_low:
-                    return True
-            except:
-                continue
-
-        return False
+        return ip in self.private_networks
 
     def _add_hosts(self, connection):
         """Add IPs to unique list.
@@ -160,13 +313,13 @@ class Pcap(object):
                     # If the IP is not a local one, this might be a leftover
                     # packet as described in issue #249.
                     if self._is_private_ip(ip):
-                        self.hosts.append(ip)
+                        self.hosts[ip] = None
 
             if connection["dst"] not in self.hosts:
                 ip = convert_to_printable(connection["dst"])
 
                 if ip not in self.hosts:
-                    self.hosts.append(ip)
+                    self.hosts[ip] = None
 
                     # We add external IPs to the list, only the first time
                     # we see them and if they're the destination of the
@@ -176,28 +329,40 @@ class Pcap(object):
         except:
             pass
 
-    def _tcp_dissect(self, conn, data):
-        """Runs all TCP dissectors.
+    def _http_dissect(self, conn, data):
+        """Runs the HTTP dissector.
         @param conn: connection.
         @param data: payload data.
         """
         if self._check_http(data):
             self._add_http(data, conn["dport"])
 
-        # SMTP.
+    def _smtp_dissect(self, conn, data):
+        """Runs the SMTP dissector.
+        @param conn: connection.
+        @param data: payload data.
+        """
         if conn["dport"] == 25:
             self._reassemble_smtp(conn, data)
 
-        # IRC.
+    def _irc_dissect(self, conn, data):
+        """Runs the IRC dissector.
+        @param conn: connection.
+        @param data: payload data.
+        """
         if conn["dport"] != 21 and self._check_irc(data):
             self._add_irc(data)
 
-        # HTTPS.
+    def _tls_dissect(self, conn, data):
+        """Runs the HTTPS dissector.
+        @param conn: connection.
+        @param data: payload data.
+        """
         if conn["dport"] in self.ssl_ports or conn["sport"] in self.ssl_ports:
             self._https_identify(conn, data)
 
-    def _udp_dissect(self, conn, data):
-        """Runs all UDP dissectors.
+    def _dns_dissect(self, conn, data):
+        """Runs the DNS dissector.
         @param conn: connection.
         @param data: payload data.
         """
@@ -353,25 +518,22 @@ class Pcap(object):
         return True
 
     def _add_domain(self, domain):
-        """Add a domain to unique list.
+        """Add a domain to unique list. Its IP address is looked up later
+        on, see resolve_domains().
         @param domain: domain name.
         """
-        filters = [
-            ".*\\.windows\\.com$",
-            ".*\\.in\\-addr\\.arpa$"
-        ]
-
-        regexps = [re.compile(filter) for filter in filters]
-        for regexp in regexps:
+        for regexp in DOMAIN_FILTERS:
             if regexp.match(domain):
                 return
 
-        for entry in self.unique_domains:
-            if entry["domain"] == domain:
-                return
+        if domain in self.domains:
+            return
 
-        self.unique_domains.append({"domain": domain,
-                                    "ip": self._dns_gethostbyname(domain)})
+        self.domains.add(domain)
+        self.unique_domains.append({
+            "domain": domain,
+            "ip": None if cfg.processing.resolve_dns else "",
+        })
 
     def _check_http(self, tcpdata):
         """Checks for HTTP traffic.
@@ -533,6 +695,324 @@ class Pcap(object):
 
         return True
 
+    def _flow(self, key):
+        """Look up a flow in the flow table, or add it.
+        @param key: (src, dst, sport, dport, proto) tuple of a packet.
+        @return: Flow.
+        """
+        flow = self.flows.get(key)
+        if flow is None:
+            src, dst, sport, dport, proto = key
+            flow = Flow(key, len(self.flow_list))
+            self.flows[key] = self.flows[dst, src, dport, sport, proto] = flow
+            self.flow_list.append(flow)
+        return flow
+
+    def _dissect(self, dissectors, conn, data):
+        """Runs the dissectors of a protocol.
+        @param dissectors: dissectors.
+        @param conn: connection.
+        @param data: payload data.
+        """
+        for dissector in dissectors:
+            dissector(conn, data)
+
+    def process_packet(self, ts, buf, offset=0, length=0):
+        """Decode a packet and feed it to the flow table and the dissectors.
+        @param ts: timestamp of the packet.
+        @param buf: raw packet.
+        @param offset: offset of the packet record in the PCAP file.
+        @param length: length of the packet record in the PCAP file.
+        """
+        if self.first_ts is None:
+            self.first_ts = ts
+
+        self.packets += 1
+        key = None
+
+        try:
+            ip = iplayer_from_raw(buf, self.linktype)
+
+            connection = {}
+            if isinstance(ip, dpkt.ip.IP):
+                connection["src"] = socket.inet_ntoa(ip.src)
+                connection["dst"] = socket.inet_ntoa(ip.dst)
+            elif isinstance(ip, dpkt.ip6.IP6):
+                connection["src"] = socket.inet_ntop(socket.AF_INET6,
+                                                     ip.src)
+                connection["dst"] = socket.inet_ntop(socket.AF_INET6,
+                                                     ip.dst)
+            else:
+                return
+
+            key = connection["src"], connection["dst"], 0, 0, ip.p
+            self._add_hosts(connection)
+
+            if ip.p == dpkt.ip.IP_PROTO_TCP:
+                tcp = ip.data
+                if not isinstance(tcp, dpkt.tcp.TCP):
+                    tcp = dpkt.tcp.TCP(tcp)
+
+                key = (connection["src"], connection["dst"],
+                       tcp.sport, tcp.dport, ip.p)
+
+                if tcp.data:
+                    connection["sport"] = tcp.sport
+                    connection["dport"] = tcp.dport
+                    self._dissect(self.dissectors.get(ip.p, ()),
+                                  connection, tcp.data)
+
+                    flow = self._flow(key)
+                    if not flow.reported:
+                        flow.reported = True
+                        self.tcp_connections.append((
+                            connection["src"], tcp.sport,
+                            connection["dst"], tcp.dport,
+                            offset, ts - self.first_ts,
+                        ))
+                else:
+                    ipconn = (
+                        connection["src"], tcp.sport,
+                        connection["dst"], tcp.dport,
+                    )
+                    seqack = self.tcp_connections_dead.get(ipconn)
+                    if seqack == (tcp.seq, tcp.ack):
+                        host = connection["dst"], tcp.dport
+                        self.dead_hosts[host] = self.dead_hosts.get(host, 1) + 1
+
+                    self.tcp_connections_dead[ipconn] = tcp.seq, tcp.ack
+
+            elif ip.p == dpkt.ip.IP_PROTO_UDP:
+                udp = ip.data
+                if not isinstance(udp, dpkt.udp.UDP):
+                    udp = dpkt.udp.UDP(udp)
+
+                key = (connection["src"], connection["dst"],
+                       udp.sport, udp.dport, ip.p)
+
+                if len(udp.data) > 0:
+                    connection["sport"] = udp.sport
+                    connection["dport"] = udp.dport
+                    self._dissect(self.dissectors.get(ip.p, ()),
+                                  connection, udp.data)
+
+                    flow = self._flow(key)
+                    if not flow.reported:
+                        flow.reported = True
+                        self.udp_connections.append((
+                            connection["src"], udp.sport,
+                            connection["dst"], udp.dport,
+                            offset, ts - self.first_ts,
+                        ))
+
+            elif ip.p == dpkt.ip.IP_PROTO_ICMP:
+                icmp = ip.data
+                if not isinstance(icmp, dpkt.icmp.ICMP):
+                    icmp = dpkt.icmp.ICMP(icmp)
+
+                self._dissect(self.dissectors.get(ip.p, ()),
+                              connection, icmp)
+        except AttributeError:
+            pass
+        except dpkt.dpkt.NeedData:
+            pass
+        except Exception as e:
+            log.exception("Failed to process packet: %s", e)
+        finally:
+            if self.sorter:
+                flow = self._flow(key).id if key else NON_IP_FLOW
+                self.sorter.add(flow, ts, offset, length)
+
+    def write_sorted(self):
+        """Write the packets grouped by flow, in the order the flows are
+        first seen, and ordered by time within each flow, to the sorted PCAP
+        file. The packet records are copied from the original PCAP file
+        as-is. The byte range of each flow in the sorted PCAP file is
+        written to its flow index, see read_flow_index().
+        @return: dict mapping the offset of the first packet of each
+                 reported connection to its offset in the sorted PCAP file.
+        """
+        wanted = set(conn[4] for conn in
+                     self.tcp_connections + self.udp_connections)
+        offsets, index = {}, []
+
+        sha256 = hashlib.sha256()
+        with open(self.filepath, "rb") as src:
+            with open(self.sorted_path, "wb") as dst:
+                # The global header of the PCAP file.
+                buf = src.read(24)
+                sha256.update(buf)
+                dst.write(buf)
+
+                position = len(buf)
+                for flow, ts, offset, length in self.sorter:
+                    if offset in wanted:
+                        offsets[offset] = position
+
+                    src.seek(offset)
+                    buf = src.read(length)
+                    sha256.update(buf)
+                    dst.write(buf)
+
+                    # The packets that are not part of a flow come last and
+                    # are not indexed.
+                    if flow != NON_IP_FLOW:
+                        if not index or index[-1]["flow"] != flow:
+                            index.append({
+                                "flow": flow,
+                                "offset": position,
+                                "end": position,
+                                "packets": 0,
+                            })
+
+                        index[-1]["end"] = position + len(buf)
+                        index[-1]["packets"] += 1
+
+                    position += len(buf)
+
+        self.sorter.close()
+        self.sorted_sha256 = sha256.hexdigest()
+
+        for entry in index:
+            src, dst, sport, dport, proto = \
+                self.flow_list[entry.pop("flow")].key
+            entry.update(src=src, dst=dst, sport=sport, dport=dport,
+                         proto=proto)
+
+        with open(self.sorted_path + ".idx.tmp", "wb") as f:
+            json.dump(index, f)
+        os.rename(self.sorted_path + ".idx.tmp", self.sorted_path + ".idx")
+
+        return offsets
+
+    def _register_dissectors(self):
+        """Register the default dissectors."""
+        self.dissectors = {}
+        self.add_dissector(socket.IPPROTO_TCP, self._http_dissect)
+        self.add_dissector(socket.IPPROTO_TCP, self._smtp_dissect)
+        self.add_dissector(socket.IPPROTO_TCP, self._irc_dissect)
+        self.add_dissector(socket.IPPROTO_TCP, self._tls_dissect)
+        self.add_dissector(socket.IPPROTO_UDP, self._dns_dissect)
+        self.add_dissector(socket.IPPROTO_ICMP, self._icmp_dissect)
+
+    def process(self, f, final=True, abort=None):
+        """Process the packets that have been added to the PCAP file since
+        the previous call, or all of them the first time around. The PCAP
+        file may still be written to, in which case an incomplete packet
+        record at its end is processed the next time.
+        @param f: PCAP file object.
+        @param final: whether the PCAP file is complete.
+        @param abort: event to stop processing at the next packet.
+        @return: whether the PCAP file could be read.
+        """
+        f.seek(self.offset)
+
+        if not self.byteorder:
+            buf = f.read(24)
+            if len(buf) < 24:
+                if final:
+                    log.error("Unable to read PCAP file at path \"%s\".",
+                              self.filepath)
+                return not final
+
+            if buf[:4] not in PCAP_MAGIC:
+                log.error("Unable to read PCAP file at path \"%s\". File is "
+                          "corrupted or wrong format." % self.filepath)
+                return False
+
+            self.byteorder, self.divisor = PCAP_MAGIC[buf[:4]]
+            self.linktype = struct.unpack(self.byteorder + "I", buf[20:])[0]
+
+            self._sha256.update(buf)
+            self.offset = len(buf)
+
+        record = struct.Struct(self.byteorder + "IIII")
+        while not abort or not abort.is_set():
+            header = f.read(record.size)
+            if len(header) < record.size:
+                break
+
+            sec, frac, caplen, length = record.unpack(header)
+            buf = f.read(caplen)
+            if len(buf) < caplen:
+                break
+
+            self._sha256.update(header)
+            self._sha256.update(buf)
+
+            length = record.size + caplen
+            self.process_packet(sec + frac / self.divisor, buf,
+                                self.offset, length)
+            self.offset += length
+
+        return True
+
+    def checkpoint(self, path):
+        """Store the state of the processing, so that it can be resumed
+        with resume() at the packet it stopped at, e.g., after processing
+        the PCAP file while it was being captured.
+        @param path: path of the checkpoint file.
+        """
+        with open(path + ".tmp", "wb") as f:
+            cPickle.dump((CHECKPOINT_VERSION, self), f,
+                         cPickle.HIGHEST_PROTOCOL)
+        os.rename(path + ".tmp", path)
+
+    @classmethod
+    def resume(cls, path, filepath, sorted_path=None, private_networks=()):
+        """Resume processing from a checkpoint, if it was made for the same
+        PCAP file and configuration. The part of the PCAP file that has been
+        processed is hashed again to make sure it hasn't been modified.
+        @param path: path of the checkpoint file.
+        @param filepath: path to PCAP file
+        @param sorted_path: path to write the PCAP file sorted by flow to
+        @param private_networks: networks to consider private besides the
+                                 default ones
+        @return: Pcap instance, or None if the checkpoint can't be used.
+        """
+        try:
+            with open(path, "rb") as f:
+                version, pcap = cPickle.load(f)
+        except Exception as e:
+            log.warning("Unable to load network processing checkpoint %s: "
+                        "%s", path, e)
+            return
+
+        if version != CHECKPOINT_VERSION or pcap.filepath != filepath or \
+                pcap.sorted_path != sorted_path or \
+                pcap.extra_networks != list(private_networks):
+            return
+
+        sha256 = hashlib.sha256()
+        with open(filepath, "rb") as f:
+            remaining = pcap.offset
+            while remaining:
+                buf = f.read(min(remaining, 1024*1024))
+                if not buf:
+                    break
+                sha256.update(buf)
+                remaining -= len(buf)
+
+        if remaining or sha256.hexdigest() != pcap._sha256:
+            log.warning("The PCAP file %s has changed since network "
+                        "processing checkpoint %s", filepath, path)
+            return
+
+        pcap._sha256 = sha256
+        return pcap
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # The dissectors are registered again when resuming, and the hash is
+        # verified then, see resume().
+        del state["dissectors"]
+        state["_sha256"] = self._sha256.hexdigest()
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._register_dissectors()
+
     def run(self):
         """Process PCAP.
         @return: dict with network analysis data.
@@ -544,101 +1024,45 @@ class Pcap(object):
             log.error("Unable to open %s" % self.filepath)
             return self.results
 
+        start, packets = time.time(), self.packets
         try:
-            pcap = dpkt.pcap.Reader(file)
-        except dpkt.dpkt.NeedData:
-            log.error("Unable to read PCAP file at path \"%s\".",
-                      self.filepath)
-            return self.results
-        except ValueError:
-            log.error("Unable to read PCAP file at path \"%s\". File is "
-                      "corrupted or wrong format." % self.filepath)
+            success = self.process(file)
+
+            # Anything that's not a packet record is part of the hash, too.
+            sha256 = self._sha256.copy()
+            file.seek(self.offset)
+            while True:
+                buf = file.read(1024*1024)
+                if not buf:
+                    break
+                sha256.update(buf)
+            self.sha256 = sha256.hexdigest()
+        finally:
+            file.close()
+
+        if not success:
             return self.results
 
-        offset = file.tell()
-        first_ts = None
-        for ts, buf in pcap:
-            if not first_ts:
-                first_ts = ts
-
-            try:
-                ip = iplayer_from_raw(buf, pcap.datalink())
-
-                connection = {}
-                if isinstance(ip, dpkt.ip.IP):
-                    connection["src"] = socket.inet_ntoa(ip.src)
-                    connection["dst"] = socket.inet_ntoa(ip.dst)
-                elif isinstance(ip, dpkt.ip6.IP6):
-                    connection["src"] = socket.inet_ntop(socket.AF_INET6,
-                                                         ip.src)
-                    connection["dst"] = socket.inet_ntop(socket.AF_INET6,
-                                                         ip.dst)
-                else:
-                    offset = file.tell()
-                    continue
-
-                self._add_hosts(connection)
-
-                if ip.p == dpkt.ip.IP_PROTO_TCP:
-                    tcp = ip.data
-                    if not isinstance(tcp, dpkt.tcp.TCP):
-                        tcp = dpkt.tcp.TCP(tcp)
-
-                    if tcp.data:
-                        connection["sport"] = tcp.sport
-                        connection["dport"] = tcp.dport
-                        self._tcp_dissect(connection, tcp.data)
-
-                        src, sport, dst, dport = (connection["src"], connection["sport"], connection["dst"], connection["dport"])
-                        if not ((dst, dport, src, sport) in self.tcp_connections_seen or (src, sport, dst, dport) in self.tcp_connections_seen):
-                            self.tcp_connections.append((src, sport, dst, dport, offset, ts-first_ts))
-                            self.tcp_connections_seen.add((src, sport, dst, dport))
-                    else:
-                        ipconn = (
-                            connection["src"], tcp.sport,
-                            connection["dst"], tcp.dport,
-                        )
-                        seqack = self.tcp_connections_dead.get(ipconn)
-                        if seqack == (tcp.seq, tcp.ack):
-                            host = connection["dst"], tcp.dport
-                            self.dead_hosts[host] = self.dead_hosts.get(host, 1) + 1
-
-                        self.tcp_connections_dead[ipconn] = tcp.seq, tcp.ack
-
-                elif ip.p == dpkt.ip.IP_PROTO_UDP:
-                    udp = ip.data
-                    if not isinstance(udp, dpkt.udp.UDP):
-                        udp = dpkt.udp.UDP(udp)
-
-                    if len(udp.data) > 0:
-                        connection["sport"] = udp.sport
-                        connection["dport"] = udp.dport
-                        self._udp_dissect(connection, udp.data)
-
-                        src, sport, dst, dport = (connection["src"], connection["sport"], connection["dst"], connection["dport"])
-                        if not ((dst, dport, src, sport) in self.udp_connections_seen or (src, sport, dst, dport) in self.udp_connections_seen):
-                            self.udp_connections.append((src, sport, dst, dport, offset, ts-first_ts))
-                            self.udp_connections_seen.add((src, sport, dst, dport))
-
-                elif ip.p == dpkt.ip.IP_PROTO_ICMP:
-                    icmp = ip.data
-                    if not isinstance(icmp, dpkt.icmp.ICMP):
-                        icmp = dpkt.icmp.ICMP(icmp)
-
-                    self._icmp_dissect(connection, icmp)
-
-                offset = file.tell()
-            except AttributeError:
-                continue
-            except dpkt.dpkt.NeedData:
-                continue
-            except Exception as e:
-                log.exception("Failed to process packet: %s", e)
-
-        file.close()
+        # Point the connections to their packets in the sorted PCAP file.
+        if self.sorted_path:
+            offsets = self.write_sorted()
+            self.tcp_connections = [
+                conn[:4] + (offsets[conn[4]],) + conn[5:]
+                for conn in self.tcp_connections
+            ]
+            self.udp_connections = [
+                conn[:4] + (offsets[conn[4]],) + conn[5:]
+                for conn in self.udp_connections
+            ]
+
+        duration, packets = time.time() - start, self.packets - packets
+        log.info("Processed %d packets of %s in %.2f seconds (%d packets "
+                 "per second)", packets, self.filepath, duration,
+                 packets / duration if duration else packets)
 
         # Post processors for reconstructed flows.
         self._process_smtp()
+        self.resolve_domains()
 
         # Build results dict.
         self.results["hosts"] = self.unique_hosts
@@ -705,11 +1129,125 @@ class Pcap2(object):
 
         return results
 
+def pcap_options(pcap_path, options):
+    """Get the configured arguments to process a PCAP file with.
+    @param pcap_path: path to the PCAP file.
+    @param options: options of the network processing module.
+    @return: tuple of the path to write the sorted PCAP file to, or None,
+             and of the additional private networks.
+    """
+    sorted_path = None
+    if cfg.processing.sort_pcap:
+        sorted_path = pcap_path.replace("dump.", "dump_sorted.")
+
+    private_networks = []
+    if options.get("private_networks"):
+        private_networks = options["private_networks"].split(",")
+
+    return sorted_path, private_networks
+
+def checkpoint_paths(pcap_path):
+    """Get the paths of the processing checkpoint of a PCAP file and of the
+    directory with the chunks of its flow sorter."""
+    return pcap_path + ".ckpt", pcap_path + ".chunks"
+
+class LivePcap(threading.Thread):
+    """Processes a PCAP file while it's being captured during the analysis,
+    and checkpoints the state of the processing periodically and when the
+    capture has finished. The network processing module then only has to
+    process the packets that were captured after the last checkpoint."""
+
+    # Seconds between two reads of the PCAP file.
+    POLL_INTERVAL = 1
+
+    def __init__(self, pcap_path, options, interval=30, stop_timeout=60):
+        """@param pcap_path: path to the PCAP file.
+        @param options: options of the network processing module.
+        @param interval: seconds between two checkpoints.
+        @param stop_timeout: seconds to wait for the remainder of the PCAP
+                             file to be processed when stopping.
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.pcap_path = pcap_path
+        self.options = options
+        self.interval = interval
+        self.stop_timeout = stop_timeout
+        self.stopped = threading.Event()
+        # Set if stopping took too long, after which no more packets are
+        # processed and no more checkpoints are made.
+        self.abandoned = threading.Event()
+
+    def run(self):
+        checkpoint_path, chunks_path = checkpoint_paths(self.pcap_path)
+        if not os.path.isdir(chunks_path):
+            os.makedirs(chunks_path)
+
+        sorted_path, private_networks = \
+            pcap_options(self.pcap_path, self.options)
+        pcap = Pcap(self.pcap_path, sorted_path, private_networks,
+                    chunks_path)
+
+        f, checkpointed = None, time.time()
+        try:
+            while True:
+                stopped = self.stopped.wait(self.POLL_INTERVAL)
+
+                if not f and os.path.exists(self.pcap_path):
+                    f = open(self.pcap_path, "rb")
+
+                if f:
+                    if not pcap.process(f, False, self.abandoned) or \
+                            self.abandoned.is_set():
+                        break
+
+                    if stopped or \
+                            time.time() - checkpointed >= self.interval:
+                        pcap.resolve_domains()
+                        if self.abandoned.is_set():
+                            break
+
+                        pcap.checkpoint(checkpoint_path)
+                        checkpointed = time.time()
+
+                if stopped:
+                    break
+        except Exception as e:
+            log.exception("Error processing PCAP file %s during the "
+                          "analysis: %s", self.pcap_path, e)
+        finally:
+            if f:
+                f.close()
+
+    def stop(self):
+        """Process the remainder of the PCAP file and stop. If that takes
+        longer than the stop timeout, the processing is abandoned without
+        a further checkpoint, and the network processing module continues
+        from the last checkpoint instead.
+        @return: whether the remainder of the PCAP file has been processed.
+        """
+        self.stopped.set()
+        self.join(self.stop_timeout)
+        if not self.is_alive():
+            return True
+
+        log.warning("Processing the PCAP file %s during the analysis didn't "
+                    "finish within %d seconds, continuing from its last "
+                    "checkpoint afterwards", self.pcap_path, self.stop_timeout)
+
+        # The thread stops at the next packet, or once it has finished
+        # resolving domains. Wait for that, as the network processing module
+        # removes the checkpoint and the chunks of the flow sorter.
+        self.abandoned.set()
+        self.join()
+        return False
+
 class NetworkAnalysis(Processing):
     """Network analysis."""
 
     order = 2
     key = "network"
+    dependencies = ["behavior"]
 
     def run(self):
         results = {}
@@ -732,27 +1270,46 @@ class NetworkAnalysis(Processing):
             log.error("The PCAP file at path \"%s\" is empty." % self.pcap_path)
             return results
 
-        # PCAP file hash.
-        if os.path.exists(self.pcap_path):
-            results["pcap_sha256"] = File(self.pcap_path).get_sha256()
-
         if not HAVE_DPKT and not HAVE_HTTPREPLAY:
             log.error("Both Python HTTPReplay and Python DPKT are not "
                       "installed, no PCAP analysis possible.")
+            results["pcap_sha256"] = File(self.pcap_path).get_sha256()
             return results
 
-        sorted_path = self.pcap_path.replace("dump.", "dump_sorted.")
-        if cfg.processing.sort_pcap:
-            sort_pcap(self.pcap_path, sorted_path)
-            pcap_path = sorted_path
+        # The PCAP file is hashed, dissected, and sorted by flow in a single
+        # pass over it, continuing from where it was left off if the PCAP file
+        # was processed during the analysis.
+        pcap_path = self.pcap_path
+        if HAVE_DPKT:
+            sorted_path, private_networks = \
+                pcap_options(self.pcap_path, self.options)
+            checkpoint_path, chunks_path = checkpoint_paths(self.pcap_path)
 
-            # Sorted PCAP file hash.
-            results["sorted_pcap_sha256"] = File(sorted_path).get_sha256()
-        else:
-            pcap_path = self.pcap_path
+            pcap = None
+            if os.path.exists(checkpoint_path):
+                pcap = Pcap.resume(checkpoint_path, self.pcap_path,
+                                   sorted_path, private_networks)
+                if pcap:
+                    log.debug("Resuming network processing at packet %d",
+                              pcap.packets)
 
-        if HAVE_DPKT:
-            results.update(Pcap(pcap_path).run())
+            if not pcap:
+                pcap = Pcap(self.pcap_path, sorted_path, private_networks)
+
+            try:
+                results.update(pcap.run())
+            finally:
+                if os.path.exists(checkpoint_path):
+                    os.remove(checkpoint_path)
+                shutil.rmtree(chunks_path, ignore_errors=True)
+
+            results["pcap_sha256"] = pcap.sha256
+
+            if pcap.sorted_sha256:
+                pcap_path = sorted_path
+                results["sorted_pcap_sha256"] = pcap.sorted_sha256
+        else:
+            results["pcap_sha256"] = File(self.pcap_path).get_sha256()
 
         if HAVE_HTTPREPLAY:
             try:
@@ -798,98 +1355,6 @@ def conn_from_flowtuple(ft):
             "dst": dip, "dport": dport,
             "offset": offset, "time": relts}
 
-# input_iterator should be a class that also supports writing so we can use
-# it for the temp files
-# this code is mostly taken from some SO post, can't remember the url though
-def batch_sort(input_iterator, output_path, buffer_size=32000, output_class=None):
-    """batch sort helper with temporary files, supports sorting large stuff"""
-    if not output_class:
-        output_class = input_iterator.__class__
-
-    chunks = []
-    try:
-        while True:
-            current_chunk = list(islice(input_iterator, buffer_size))
-            if not current_chunk:
-                break
-
-            current_chunk.sort()
-            fd, filepath = tempfile.mkstemp()
-            os.close(fd)
-            output_chunk = output_class(filepath)
-            chunks.append(output_chunk)
-
-            for elem in current_chunk:
-                output_chunk.write(elem.obj)
-            output_chunk.close()
-
-        output_file = output_class(output_path)
-        for elem in heapq.merge(*chunks):
-            output_file.write(elem.obj)
-        output_file.close()
-    finally:
-        for chunk in chunks:
-            try:
-                chunk.close()
-                os.remove(chunk.name)
-            except Exception:
-                pass
-
-class SortCap(object):
-    """SortCap is a wrapper around the packet lib (dpkt) that allows us to sort pcaps
-    together with the batch_sort function above."""
-
-    def __init__(self, path, linktype=1):
-        self.name = path
-        self.linktype = linktype
-        self.fd = None
-        self.ctr = 0  # counter to pass through packets without flow info (non-IP)
-        self.conns = set()
-
-    def write(self, p):
-        if not self.fd:
-            self.fd = dpkt.pcap.Writer(open(self.name, "wb"), linktype=self.linktype)
-        self.fd.writepkt(p.raw, p.ts)
-
-    def __iter__(self):
-        if not self.fd:
-            self.fd = dpkt.pcap.Reader(open(self.name, "rb"))
-            self.fditer = iter(self.fd)
-            self.linktype = self.fd.datalink()
-        return self
-
-    def close(self):
-        if self.fd:
-            self.fd.close()
-            self.fd = None
-
-    def next(self):
-        rp = next(self.fditer)
-        if rp is None:
-            return None
-
-        self.ctr += 1
-
-        ts, raw = rp
-        rpkt = Packet(raw, ts)
-
-        sip, dip, sport, dport, proto = flowtuple_from_raw(raw, self.linktype)
-
-        # check other direction of same flow
-        if (dip, sip, dport, sport, proto) in self.conns:
-            flowtuple = (dip, sip, dport, sport, proto)
-        else:
-            flowtuple = (sip, dip, sport, dport, proto)
-
-        self.conns.add(flowtuple)
-        return Keyed((flowtuple, ts, self.ctr), rpkt)
-
-def sort_pcap(inpath, outpath):
-    """Use SortCap class together with batch_sort to sort a pcap"""
-    inc = SortCap(inpath)
-    batch_sort(inc, outpath, output_class=lambda path: SortCap(path, linktype=inc.linktype))
-    return 0
-
 def flowtuple_from_raw(raw, linktype=1):
     """Parse a packet from a pcap just enough to gain a flow description tuple"""
     ip = iplayer_from_raw(raw, linktype)
@@ -939,13 +1404,39 @@ def next_connection_packets(piter, linktype=1):
             "direction": first_ft == ft,
         }
 
-def packets_for_stream(fobj, offset):
+def read_flow_index(path):
+    """Read the flow index of a sorted PCAP file.
+    @param path: path to the sorted PCAP file.
+    @return: dict mapping the (src, sport, dst, dport, proto) tuple of each
+             flow, in both directions, to its index entry, which holds the
+             offset and end of its packets in the sorted PCAP file.
+    """
+    flows = {}
+    for entry in json.load(open(path + ".idx", "rb")):
+        src, sport = entry["src"], entry["sport"]
+        dst, dport = entry["dst"], entry["dport"]
+        flows[src, sport, dst, dport, entry["proto"]] = entry
+        flows[dst, dport, src, sport, entry["proto"]] = entry
+    return flows
+
+def packets_until(fobj, piter, end):
+    """Yield the packets of a pcap packet iterator up to an offset."""
+    for ts, raw in piter:
+        yield ts, raw
+        if fobj.tell() >= end:
+            break
+
+def packets_for_stream(fobj, offset, end=None):
     """Open a PCAP, seek to a packet offset, then get all packets belonging to
-    the same connection."""
+    the same connection. If the end offset of the connection is given, e.g.,
+    from the flow index, only the packets up to there are read."""
     pcap = dpkt.pcap.Reader(fobj)
     pcapiter = iter(pcap)
     ts, raw = pcapiter.next()
 
     fobj.seek(offset)
+    if end is not None:
+        pcapiter = packets_until(fobj, pcapiter, end)
+
     for p in next_connection_packets(pcapiter, linktype=pcap.datalink()):
         yield p
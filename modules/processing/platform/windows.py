@@ -1,5 +1,7 @@
+import os
 import logging
 import datetime
+import multiprocessing
 
 try:
     import jsbeautifier
@@ -8,7 +10,9 @@ except ImportError:
     HAVE_JSBEAUTIFIER = False
 
 from lib.detector.common.abstracts import BehaviorHandler
-from lib.detector.common.netlog import BsonParser
+from lib.detector.common.behavior import BehaviorReconstructor, MonitorSummary
+from lib.detector.common.callstore import CallStore
+from lib.detector.common.netlog import BsonParser, BsonSidecar
 
 log = logging.getLogger(__name__)
 
@@ -20,6 +24,8 @@ class MonitorProcessLog(list):
         self.eventstream = eventstream
         self.first_seen = None
         self.has_apicalls = False
+        self.store = None
+        self.decoded = None
 
     def _api_COleScript_Compile(self, event):
         if HAVE_JSBEAUTIFIER:
@@ -27,7 +33,50 @@ class MonitorProcessLog(list):
             event["arguments"]["script"] = \
                 jsbeautifier.beautify(event["arguments"]["script"])
 
+    def build_store(self, path):
+        """Write the API calls to an indexed CallStore, which is then used
+        instead of the event stream.
+        @param path: path of the store files, without extension.
+        """
+        store = CallStore(path)
+        store.build(self._calls())
+        self.store = store
+
     def __iter__(self):
+        if self.store is not None:
+            return iter(self.store)
+        if self.decoded is not None:
+            return iter(self.decoded)
+        return self._calls()
+
+    def _decoded(self):
+        """Without the CallStore, random access requires all API calls to be
+        decoded, which is therefore only done once."""
+        if self.decoded is None:
+            self.decoded = list(self._calls())
+        return self.decoded
+
+    def __len__(self):
+        if self.store is not None:
+            return len(self.store)
+        return len(self._decoded())
+
+    def __getitem__(self, index):
+        if self.store is not None:
+            return self.store[index]
+        return self._decoded()[index]
+
+    def filter(self, apis=None, categories=None):
+        """Yield only the API calls to the given APIs and/or categories.
+        Without the CallStore each call has to be decoded to do so."""
+        if self.store is not None:
+            return self.store.filter(apis, categories)
+
+        return (call for call in iter(self)
+                if (apis is None or call["api"] in apis) and
+                (categories is None or call["category"] in categories))
+
+    def _calls(self):
         # call_id = 0
         for event in self.eventstream:
             if event["type"] == "process":
@@ -86,6 +135,7 @@ class WindowsMonitor(BehaviorHandler):
         super(WindowsMonitor, self).__init__(*args, **kwargs)
         self.processes = []
         self.reconstructors = {}
+        self.summaries = {}
         self.matched = False
 
     def handles_path(self, path):
@@ -93,7 +143,82 @@ class WindowsMonitor(BehaviorHandler):
             self.matched = True
             return True
 
+    def _sidecar(self, path):
+        return BsonSidecar(os.path.join(
+            self.analysis.analysis_path, "sidecar",
+            os.path.splitext(os.path.basename(path))[0]
+        ))
+
+    def prepare(self, paths):
+        """Summarize the monitor logs in worker processes if enabled through
+        the "workers" option of the behavior processing module."""
+        options = self.analysis.options or {}
+        workers = options.get("workers") or 0
+
+        logs = []
+        for path in paths:
+            if path.endswith(".bson") and not self._sidecar(path).complete():
+                logs.append(path)
+
+        if workers < 2 or len(logs) < 2:
+            return
+
+        # Start with the biggest logs to keep the workers equally busy.
+        logs.sort(key=os.path.getsize, reverse=True)
+
+        pool = multiprocessing.Pool(min(workers, len(logs)))
+        try:
+            summaries = pool.map(summarize_log, logs, chunksize=1)
+        finally:
+            pool.terminate()
+            pool.join()
+
+        for path, summary in zip(logs, summaries):
+            if summary:
+                self.summaries[path] = summary
+
     def parse(self, path):
+        # Summarized by one of the worker processes. The API calls are then
+        # only parsed on-demand, just like with parse_bson().
+        summary = self.summaries.pop(path, None)
+        if summary:
+            parser = BsonParser(open(path, "rb"))
+            parser.is_64bit = summary["is_64bit"]
+            return self.parse_summary(summary, parser)
+
+        # Use the events as pre-decoded by the ResultServer, if available.
+        sidecar = self._sidecar(path)
+        summary = sidecar.summary()
+        if summary:
+            return self.parse_summary(summary, sidecar)
+
+        return self.parse_bson(path)
+
+    def parse_summary(self, summary, eventstream):
+        """Yield the events of a summarized log, see MonitorSummary."""
+        process = dict(summary["process"])
+        process["calls"] = MonitorProcessLog(eventstream)
+        process["calls"].has_apicalls = bool(summary["apistats"])
+        self.processes.append(process)
+
+        yield summary["process"]
+
+        pid = process["pid"]
+        for category, value in summary["generic"]:
+            yield {
+                "type": "generic",
+                "pid": pid,
+                "category": category,
+                "value": value,
+            }
+
+        yield {
+            "type": "apistats",
+            "pid": pid,
+            "apistats": summary["apistats"],
+        }
+
+    def parse_bson(self, path):
         # Invoke parsing of current log file.
         parser = BsonParser(open(path, "rb"))
 
@@ -132,219 +257,47 @@ class WindowsMonitor(BehaviorHandler):
         if not self.matched:
             return
 
+        if (self.analysis.options or {}).get("callstore"):
+            self.build_stores()
+
         self.processes.sort(key=lambda process: process["first_seen"])
         return self.processes
 
-def NT_SUCCESS(value):
-    return value % 2**32 < 0x80000000
-
-class BehaviorReconstructor(object):
-    """Reconstructs the behavior of behavioral API logs."""
-    def __init__(self):
-        self.files = {}
-
-    def process_apicall(self, event):
-        fn = getattr(self, "_api_%s" % event["api"], None)
-        if fn is not None:
-            return fn(event["return_value"], event["arguments"])
-
-    # Generic file & directory stuff.
-
-    def _api_CreateDirectoryW(self, return_value, arguments):
-        return ("directory_created", arguments["dirpath"])
-
-    _api_CreateDirectoryExW = _api_CreateDirectoryW
-
-    def _api_RemoveDirectoryA(self, return_value, arguments):
-        return ("directory_removed", arguments["dirpath"])
-
-    _api_RemoveDirectoryW = _api_RemoveDirectoryA
-
-    def _api_MoveFileWithProgressW(self, return_value, arguments):
-        return ("file_moved", (arguments["oldfilepath"],
-                               arguments["newfilepath"]))
-
-    def _api_CopyFileA(self, return_value, arguments):
-        return ("file_copied", (arguments["oldfilepath"],
-                                arguments["newfilepath"]))
-
-    _api_CopyFileW = _api_CopyFileA
-    _api_CopyFileExW = _api_CopyFileA
-
-    def _api_DeleteFileA(self, return_value, arguments):
-        return ("file_deleted", arguments["filepath"])
-
-    _api_DeleteFileW = _api_DeleteFileA
-    _api_NtDeleteFile = _api_DeleteFileA
-
-    def _api_FindFirstFileExA(self, return_value, arguments):
-        return ("directory_enumerated", arguments["filepath"])
-
-    _api_FindFirstFileExW = _api_FindFirstFileExA
-
-    def _api_LdrLoadDll(self, return_value, arguments):
-        return ("dll_loaded", arguments["module_name"])
-
-    def _api_NtCreateFile(self, return_value, arguments):
-        self.files[arguments["file_handle"]] = arguments["filepath"]
-        return [
-            ("file_opened", arguments["filepath"]),
-            ("file_exists", arguments["filepath"]),
-        ]
-
-    _api_NtOpenFile = _api_NtCreateFile
-
-    def _api_NtReadFile(self, return_value, arguments):
-        h = arguments["file_handle"]
-        if NT_SUCCESS(return_value) and h in self.files:
-            return ("file_read", self.files[h])
-
-    def _api_NtWriteFile(self, return_value, arguments):
-        h = arguments["file_handle"]
-        if NT_SUCCESS(return_value) and h in self.files:
-            return ("file_written", self.files[h])
-
-    def _api_GetFileAttributesW(self, return_value, arguments):
-        return ("file_exists", arguments["filepath"])
-
-    _api_GetFileAttributesExW = _api_GetFileAttributesW
-
-    # Registry stuff.
-
-    def _api_RegOpenKeyExA(self, return_value, arguments):
-        return ("regkey_opened", arguments["regkey"])
-
-    _api_RegOpenKeyExW = _api_RegOpenKeyExA
-    _api_RegCreateKeyExA = _api_RegOpenKeyExA
-    _api_RegCreateKeyExW = _api_RegOpenKeyExA
-
-    def _api_RegDeleteKeyA(self, return_value, arguments):
-        return ("regkey_deleted", arguments["regkey"])
-
-    _api_RegDeleteKeyW = _api_RegDeleteKeyA
-    _api_RegDeleteValueA = _api_RegDeleteKeyA
-    _api_RegDeleteValueW = _api_RegDeleteKeyA
-    _api_NtDeleteValueKey = _api_RegDeleteKeyA
-
-    def _api_RegQueryValueExA(self, return_value, arguments):
-        return ("regkey_read", arguments["regkey"])
-
-    _api_RegQueryValueExW = _api_RegQueryValueExA
-    _api_NtQueryValueKey = _api_RegQueryValueExA
-
-    def _api_RegSetValueExA(self, return_value, arguments):
-        return ("regkey_written", arguments["regkey"])
-
-    _api_RegSetValueExW = _api_RegSetValueExA
-    _api_NtSetValueKey = _api_RegSetValueExA
-
-    def _api_NtClose(self, return_value, arguments):
-        self.files.pop(arguments["handle"], None)
-
-    # Network stuff.
-
-    def _api_URLDownloadToFileW(self, return_value, arguments):
-        return [
-            ("downloads_file", arguments["url"]),
-            ("file_opened", arguments["filepath"]),
-            ("file_written", arguments["filepath"]),
-        ]
-
-    def _api_InternetConnectA(self, return_value, arguments):
-        return ("connects_host", arguments["hostname"])
-
-    _api_InternetConnectW = _api_InternetConnectA
-
-    def _api_InternetOpenUrlA(self, return_value, arguments):
-        return ("fetches_url", arguments["url"])
-
-    _api_InternetOpenUrlW = _api_InternetOpenUrlA
-
-    def _api_DnsQuery_A(self, return_value, arguments):
-        if arguments["hostname"]:
-            return ("resolves_host", arguments["hostname"])
-
-    _api_DnsQuery_W = _api_DnsQuery_A
-    _api_DnsQuery_UTF8 = _api_DnsQuery_A
-    _api_getaddrinfo = _api_DnsQuery_A
-    _api_GetAddrInfoW = _api_DnsQuery_A
-    _api_gethostbyname = _api_DnsQuery_A
-
-    def _api_connect(self, return_value, arguments):
-        return ("connects_ip", arguments["ip_address"])
-
-    # Mutex stuff
-
-    def _api_NtCreateMutant(self, return_value, arguments):
-        if arguments["mutant_name"]:
-            return ("mutex", arguments["mutant_name"])
-
-    _api_ConnectEx = _api_connect
-
-    # Process stuff.
-
-    def _api_CreateProcessInternalW(self, return_value, arguments):
-        cmdline = arguments["command_line"] or arguments["filepath"]
-        return ("command_line", cmdline)
-
-    def _api_ShellExecuteExW(self, return_value, arguments):
-        if arguments["parameters"]:
-            cmdline = "%s %s" % (arguments["filepath"], arguments["parameters"])
-        else:
-            cmdline = arguments["filepath"]
-        return ("command_line", cmdline)
-
-    def _api_system(self, return_value, arguments):
-        return ("command_line", arguments["command"])
-
-    # WMI stuff.
-
-    def _api_IWbemServices_ExecQuery(self, return_value, arguments):
-        return ("wmi_query", arguments["query"])
-
-    def _api_IWbemServices_ExecQueryAsync(self, return_value, arguments):
-        return ("wmi_query", arguments["query"])
-
-    # GUIDs.
-
-    def _api_CoCreateInstance(self, return_value, arguments):
-        return [
-            ("guid", arguments["clsid"]),
-            ("guid", arguments["iid"]),
-        ]
-
-    def _api_CoCreateInstanceEx(self, return_value, arguments):
-        ret = [
-            ("guid", arguments["clsid"]),
-        ]
-        for iid in arguments["iid"]:
-            ret.append(("guid", iid))
-        return ret
+    def build_stores(self):
+        """Store the API calls of each process in a CallStore."""
+        dirpath = os.path.join(self.analysis.analysis_path, "calls")
+        if not os.path.isdir(dirpath):
+            os.makedirs(dirpath)
+
+        for idx, process in enumerate(self.processes):
+            if not process["calls"].has_apicalls:
+                continue
+
+            path = os.path.join(dirpath, "%d-%d" % (idx, process["pid"]))
+            try:
+                process["calls"].build_store(path)
+            except (IOError, OSError) as e:
+                log.warning("Unable to store the API calls of process %d: "
+                            "%s", process["pid"], e)
+
+def summarize_log(path):
+    """Summarize a monitor log in one of the worker processes.
+    @param path: path to the BSON log.
+    @return: summary dictionary or None if it has to be parsed serially.
+    """
+    try:
+        parser = BsonParser(open(path, "rb"))
 
-    def _api_CoGetClassObject(self, return_value, arguments):
-        return [
-            ("guid", arguments["clsid"]),
-            ("guid", arguments["iid"]),
-        ]
+        summary = MonitorSummary()
+        for event in parser:
+            summary.add(event)
 
-    # SSLv3 & TLS Master Secrets.
+        if summary.process is None:
+            return
 
-    def _api_Ssl3GenerateKeyMaterial(self, return_value, arguments):
-        if arguments["client_random"] and arguments["server_random"]:
-            return [
-                ("tls_master", (
-                    arguments["client_random"],
-                    arguments["server_random"],
-                    arguments["master_secret"],
-                ))
-            ]
-
-    def _api_PRF(self, return_value, arguments):
-        if arguments["type"] == "key expansion":
-            return [
-                ("tls_master", (
-                    arguments["client_random"],
-                    arguments["server_random"],
-                    arguments["master_secret"],
-                )),
-            ]
+        results = summary.results()
+        results["is_64bit"] = parser.is_64bit
+        return results
+    except Exception as e:
+        log.warning("Unable to summarize behavior log %s in a worker "
+                    "process: %s", path, e)
@@ -1,84 +1,100 @@
+import binascii
+import logging
+import multiprocessing
 import os
-import struct
 
 from lib.detector.common.abstracts import Processing
-from lib.detector.common.objects import File
-
-PAGE_READONLY = 0x00000002
-PAGE_READWRITE = 0x00000004
-PAGE_WRITECOPY = 0x00000008
-PAGE_EXECUTE = 0x00000010
-PAGE_EXECUTE_READ = 0x00000020
-PAGE_EXECUTE_READWRITE = 0x00000040
-PAGE_EXECUTE_WRITECOPY = 0x00000080
-
-page_access = {
-    PAGE_READONLY: "r",
-    PAGE_READWRITE: "rw",
-    PAGE_WRITECOPY: "rwc",
-    PAGE_EXECUTE: "rx",
-    PAGE_EXECUTE_READ: "rx",
-    PAGE_EXECUTE_READWRITE: "rwx",
-    PAGE_EXECUTE_WRITECOPY: "rwxc",
-}
+from lib.detector.common.memdump import MEM_IMAGE, MemoryDump
+from lib.detector.common.objects import File, filter_urls, find_urls
+
+log = logging.getLogger(__name__)
+
+# Minimum size of the memory regions, other than images, whose scan results
+# are cached. Most regions are small heap and stack allocations that are
+# specific to a single process and not worth caching.
+CACHE_MIN_SIZE = 1024 * 1024
+
+def index_dump(path):
+    """Load or build the index of a memory dump, in a worker process.
+    @param path: path of the memory dump.
+    @return: list of regions.
+    """
+    with MemoryDump(path) as dump:
+        return dump.regions
+
+def scan_regions(args):
+    """Match the Yara rules against and extract the URLs from regions of a
+    memory dump, in a worker process.
+    @param args: tuple of the path of the memory dump and its regions.
+    @return: dict mapping region hashes to tuples of Yara matches and URLs.
+    """
+    path, regions = args
+
+    # Images and large regions that have been seen before, e.g., the image
+    # of a system DLL, come from the file cache.
+    key = None
+    if File.load_yara("memory"):
+        key = "yara:memory:%s" % File.yara_versions["memory"]
+
+    results = {}
+    with MemoryDump(path) as dump:
+        for region in regions:
+            sha256 = binascii.hexlify(region.sha256)
+            cache = File.cache
+            if region.type != MEM_IMAGE and region.size < CACHE_MIN_SIZE:
+                cache = None
+
+            cached = cache.get(sha256) if cache else {}
+
+            if "url_domains" not in cached or (key and key not in cached):
+                data = dump.read(region)
+                cached["url_domains"] = find_urls(data)
+                if key:
+                    cached[key] = File.match_yara("memory", data=data)
+
+                if cache:
+                    cache.put(sha256, cached)
+
+            results[region.sha256] = \
+                cached.get(key, []), filter_urls(cached["url_domains"])
+    return results
 
 class ProcessMemory(Processing):
     """Analyze process memory dumps."""
-    def read_dump(self, filepath):
-        f = open(filepath, "rb")
-
-        while True:
-            buf = f.read(24)
-            if not buf:
-                break
-
-            row = struct.unpack("QIIII", buf)
-            addr, size, state, typ, protect = row
-
-            yield {
-                "addr": "0x%08x" % addr,
-                "end": "0x%08x" % (addr + size),
-                "size": size,
-                "type": typ,
-                "protect": page_access.get(protect),
-                "offset": f.tell(),
-            }
-
-            f.seek(size, 1)
-
-    def create_idapy(self, process):
-        i = open(process["file"], "rb")
+
+    dependencies = []
+    forks = True
+
+    def create_idapy(self, process, dump):
         o = open(process["file"].replace(".dmp", ".py"), "wb")
 
         print>>o, "from idaapi import add_segm, mem2base, autoMark, AU_CODE"
         print>>o, "from idaapi import set_processor_type, SETPROC_ALL"
         print>>o, "set_processor_type('80386r', SETPROC_ALL)"
 
-        for idx, region in enumerate(process["regions"]):
-            i.seek(region["offset"])
-
-            if not region["protect"]:
+        for idx, region in enumerate(dump.regions):
+            if not region.access:
                 section = "unk_%d" % idx
                 type_ = "DATA"
-            elif "x" in region["protect"]:
+            elif "x" in region.access:
                 section = "text_%d" % idx
                 type_ = "CODE"
-            elif "w" in region["protect"]:
+            elif "w" in region.access:
                 section = "data_%d" % idx
                 type_ = "DATA"
             else:
                 section = "rdata_%d" % idx
                 type_ = "DATA"
 
-            print>>o, "add_segm(0, %s, %s, '%s', '%s')" % (
-                region["addr"], region["end"], section, type_
+            addr = "0x%08x" % region.addr
+            print>>o, "add_segm(0, %s, 0x%08x, '%s', '%s')" % (
+                addr, region.addr + region.size, section, type_
             )
             print>>o, "mem2base('%s'.decode('base64'), %s)" % (
-                i.read(region["size"]).encode("base64").replace("\n", ""),
-                region["addr"]
+                dump.read(region).encode("base64").replace("\n", ""), addr
             )
             if type_ == "CODE":
-                print>>o, "autoMark(%s, AU_CODE)" % region["addr"]
+                print>>o, "autoMark(%s, AU_CODE)" % addr
 
     def run(self):
         """Run analysis.
@@ -87,29 +103,80 @@ class ProcessMemory(Processing):
         self.key = "procmemory"
         results = []
 
-        if os.path.exists(self.pmemory_path):
-            for dmp in os.listdir(self.pmemory_path):
-                if not dmp.endswith(".dmp"):
-                    continue
-
-                dump_path = os.path.join(self.pmemory_path, dmp)
-                dump_file = File(dump_path)
-
-                if "-" in os.path.basename(dump_path):
-                    pid = int(os.path.basename(dump_path).split("-")[0])
-                else:
-                    pid = int(os.path.basename(dump_path).split(".")[0])
-
-                proc = dict(
-                    file=dump_path, pid=pid,
-                    yara=dump_file.get_yara("memory"),
-                    urls=list(dump_file.get_urls()),
-                    regions=list(self.read_dump(dump_path)),
-                )
+        if not os.path.exists(self.pmemory_path):
+            return results
+
+        paths = []
+        for dmp in sorted(os.listdir(self.pmemory_path)):
+            if dmp.endswith(".dmp"):
+                paths.append(os.path.join(self.pmemory_path, dmp))
+
+        workers = self.options.get("workers") or 0
+        if workers < 2 or len(paths) < 2:
+            pool, map_ = None, map
+        else:
+            pool = multiprocessing.Pool(min(workers, len(paths)))
+            map_ = pool.map
+
+        dumps, scans = [], {}
+        try:
+            # Start with the biggest dumps to keep the workers equally busy.
+            paths.sort(key=os.path.getsize, reverse=True)
+            for path, regions in zip(paths, map_(index_dump, paths)):
+                dump = MemoryDump(path)
+                dump.regions = regions
+                dumps.append(dump)
+
+            # Scan each distinct region only once, even if it's present in
+            # multiple processes.
+            access = self.options.get("scan_regions") or None
+            scanned, todo = set(), []
+            for dump in dumps:
+                regions = []
+                for region in dump.select(access):
+                    if region.sha256 not in scanned:
+                        scanned.add(region.sha256)
+                        regions.append(region)
+                todo.append((dump.path, regions))
+
+            for ret in map_(scan_regions, todo):
+                scans.update(ret)
+        finally:
+            if pool:
+                pool.terminate()
+                pool.join()
+
+        for dump in sorted(dumps, key=lambda dump: dump.path):
+            if "-" in os.path.basename(dump.path):
+                pid = int(os.path.basename(dump.path).split("-")[0])
+            else:
+                pid = int(os.path.basename(dump.path).split(".")[0])
+
+            yara, urls = {}, set()
+            for region in dump.select(access):
+                matches, region_urls = scans[region.sha256]
+                urls.update(region_urls)
+                for match in matches:
+                    if match["name"] not in yara:
+                        yara[match["name"]] = dict(match)
+                        yara[match["name"]]["strings"] = set()
+                    yara[match["name"]]["strings"].update(match["strings"])
+
+            yara = sorted(yara.values(), key=lambda match: match["name"])
+            for match in yara:
+                match["strings"] = sorted(match["strings"])
+
+            proc = dict(
+                file=dump.path, pid=pid,
+                yara=yara,
+                urls=sorted(urls),
+                regions=[region.to_dict() for region in dump.regions],
+            )
 
-                if self.options.get("idapro"):
-                    self.create_idapy(proc)
+            if self.options.get("idapro"):
+                with dump:
+                    self.create_idapy(proc, dump)
 
-                results.append(proc)
+            results.append(proc)
 
         return results
@@ -9,6 +9,8 @@ log = logging.getLogger(__name__)
 class Screenshots(Processing):
     """Screenshot file OCR analysis."""
 
+    dependencies = []
+
     def run(self):
         """Run analysis.
         @return: list of screenshots with OCR content.
@@ -12,6 +12,8 @@ log = logging.getLogger(__name__)
 class Snort(Processing):
     """Snort processing module."""
 
+    dependencies = []
+
     # Thanks to Steve Handerson for the following regex query.
     alert_re = re.compile(
         r"(?P<timestamp>\d{2}/\d{2}/\d{2}-\d{2}:\d{2}:\d{2}\.\d+)\s+"
@@ -1,12 +1,14 @@
 import os.path
-import re
 
 from lib.detector.common.abstracts import Processing
 from lib.detector.common.exceptions import DetectorProcessingError
+from lib.detector.common.strings import extract_strings
 
 class Strings(Processing):
     """Extract strings from analyzed file."""
 
+    dependencies = []
+
     def run(self):
         """Run extract of printable strings.
         @return: list of printable strings.
@@ -19,10 +21,13 @@ class Strings(Processing):
                 raise DetectorProcessingError("Sample file doesn't exist: \"%s\"" % self.file_path)
 
             try:
-                data = open(self.file_path, "r").read()
+                strings = extract_strings(
+                    self.file_path,
+                    min_length=self.options.get("min_length") or 6,
+                    max_count=self.options.get("max_count") or 0,
+                    dedup=self.options.get("dedup") or False
+                )
             except (IOError, OSError) as e:
                 raise DetectorProcessingError("Error opening file %s" % e)
-            strings = re.findall("[\x1f-\x7e]{6,}", data)
-            strings += [str(ws.decode("utf-16le")) for ws in re.findall("(?:[\x1f-\x7e][\x00]){6,}", data)]
 
         return strings
@@ -20,6 +20,8 @@ log = logging.getLogger(__name__)
 class Suricata(Processing):
     """Suricata processing module."""
 
+    dependencies = []
+
     # List of Suricata Signatures IDs that should be ignored.
     sid_blacklist = [
         # SURICATA FRAG IPv6 Fragmentation overlap
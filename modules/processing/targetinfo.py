@@ -6,6 +6,8 @@ from lib.detector.common.objects import File
 class TargetInfo(Processing):
     """General information about a file."""
 
+    dependencies = []
+
     def run(self):
         """Run file information gathering.
         @return: information dict.
@@ -16,6 +16,7 @@ class VirusTotal(Processing):
     dropped files.
     """
     order = 2
+    dependencies = ["dropped"]
 
     def run(self):
         """Runs VirusTotal processing
@@ -1,6 +1,6 @@
 import os
 import json
-import codecs
+import gzip
 import calendar
 import datetime
 
@@ -14,29 +14,146 @@ def default(obj):
         return calendar.timegm(obj.timetuple()) + obj.microsecond / 1000.0
     raise TypeError("%r is not JSON serializable" % obj)
 
-class JsonDump(Report):
-    """Saves analysis results in JSON format."""
+class JsonWriter(object):
+    """Writes the results as JSON, one top-level section at a time.
+
+    Each section is encoded on its own, so memory usage is bounded by the
+    biggest section rather than by the entire report. The API calls of each
+    process are streamed one by one through the C encoder, either inline or
+    to a separate newline-delimited JSON file per process.
+    """
+
+    def __init__(self, f, indent, encoding, calls, calls_path=None,
+                 compress=False):
+        """@param f: file object to write the report to.
+        @param indent: indentation level, 0 for compact output.
+        @param encoding: encoding of the byte strings in the results.
+        @param calls: whether to include the API calls.
+        @param calls_path: directory for the per-process call files, if any.
+        @param compress: whether to gzip the per-process call files.
+        """
+        self.f = f
+        self.indent = indent
+        self.encoding = encoding
+        self.calls = calls
+        self.calls_path = calls_path
+        self.compress = compress
+        self.separator = "," if indent else ", "
+
+    def dumps(self, value, level=0, indent=True):
+        """Encode a value at the given nesting level."""
+        if not self.indent or not indent:
+            return json.dumps(value, default=default, encoding=self.encoding)
+
+        ret = json.dumps(value, default=default, encoding=self.encoding,
+                         indent=self.indent)
+        return ret.replace("\n", self.newline(level))
 
-    def erase_calls(self, results):
-        """Temporarily removes calls from the report by replacing them with
-        empty lists."""
-        if self.calls:
-            self.calls = None
+    def newline(self, level):
+        if not self.indent:
+            return ""
+        return "\n" + " " * (self.indent * level)
+
+    def write_dict(self, items, level, writers=None):
+        """Write a dictionary, using custom writers for some of its keys."""
+        writers = writers or {}
+        items = list(items)
+        if not items:
+            self.f.write("{}")
             return
 
-        self.calls = []
-        for process in results.get("behavior", {}).get("processes", []):
-            self.calls.append(process["calls"])
-            process["calls"] = []
+        self.f.write("{")
+        for idx, (key, value) in enumerate(items):
+            if idx:
+                self.f.write(self.separator)
+            self.f.write(self.newline(level + 1))
+            if not isinstance(key, basestring):
+                key = str(key)
+            self.f.write("%s: " % self.dumps(key))
+
+            if key in writers:
+                writers[key](value, level + 1)
+            else:
+                self.f.write(self.dumps(value, level + 1))
+        self.f.write(self.newline(level))
+        self.f.write("}")
+
+    def write_list(self, values, level, writer):
+        """Write a list of which each value is written by the writer."""
+        self.f.write("[")
+        empty = True
+        for value in values:
+            if not empty:
+                self.f.write(self.separator)
+            self.f.write(self.newline(level + 1))
+            writer(value, level + 1)
+            empty = False
+
+        if not empty:
+            self.f.write(self.newline(level))
+        self.f.write("]")
+
+    def write_results(self, results):
+        self.write_dict(results.items(), 0, {
+            "behavior": self.write_behavior,
+        })
+
+    def write_behavior(self, behavior, level):
+        self.write_dict(behavior.items(), level, {
+            "processes": self.write_processes,
+        })
 
-    def restore_calls(self, results):
-        """Restores calls that were temporarily removed in the report by
-        replacing the calls with the original values."""
-        if not self.calls:
+    def write_processes(self, processes, level):
+        self.idx = 0
+        self.write_list(processes, level, self.write_process)
+
+    def write_process(self, process, level):
+        items = process.items()
+
+        # Move the API calls to their own file, if so requested.
+        if self.calls and self.calls_path and process.get("calls"):
+            filename = "%d-%d.json" % (self.idx, process["pid"])
+            if self.compress:
+                filename += ".gz"
+
+            self.write_calls_file(
+                process["calls"], os.path.join(self.calls_path, filename)
+            )
+            items.append(
+                ("calls_file", os.path.join(
+                    os.path.basename(self.calls_path), filename
+                ))
+            )
+
+        self.idx += 1
+        self.write_dict(items, level, {
+            "calls": self.write_calls,
+        })
+
+    def write_calls(self, calls, level):
+        if not self.calls or self.calls_path:
+            self.f.write("[]")
             return
 
-        for process in results.get("behavior", {}).get("processes", []):
-            process["calls"] = self.calls.pop(0)
+        self.write_list(calls, level, self.write_call)
+
+    def write_call(self, call, level):
+        self.f.write(self.dumps(call, indent=False))
+
+    def write_calls_file(self, calls, filepath):
+        """Write each API call as a separate line of JSON."""
+        if self.compress:
+            f = gzip.open(filepath, "wb")
+        else:
+            f = open(filepath, "wb", 1024*1024)
+
+        with f:
+            for call in calls:
+                f.write(self.dumps(call, indent=False))
+                f.write("\n")
+
+class JsonDump(Report):
+    """Saves analysis results in JSON format."""
 
     def run(self, results):
         """Writes report.
@@ -49,19 +166,24 @@ class JsonDump(Report):
         # Determine whether we want to include the behavioral data in the
         # JSON report.
         if "json.calls" in self.task["options"]:
-            self.calls = int(self.task["options"]["json.calls"])
+            calls = int(self.task["options"]["json.calls"])
         else:
-            self.calls = self.options.get("calls", True)
+            calls = self.options.get("calls", True)
 
-        self.erase_calls(results)
+        # Determine whether the API calls go into separate files.
+        calls_path = None
+        if calls and self.options.get("calls_file"):
+            calls_path = os.path.join(self.reports_path, "calls")
+            if not os.path.isdir(calls_path):
+                os.makedirs(calls_path)
 
         try:
             path = os.path.join(self.reports_path, "report.json")
 
-            with codecs.open(path, "w", "utf-8") as report:
-                json.dump(results, report, default=default, sort_keys=False,
-                          indent=int(indent), encoding=encoding)
-        except (UnicodeError, TypeError, IOError) as e:
+            with open(path, "wb", 1024*1024) as report:
+                JsonWriter(
+                    report, int(indent or 0), encoding, calls, calls_path,
+                    self.options.get("compress", False)
+                ).write_results(results)
+        except (UnicodeError, TypeError, ValueError, IOError, OSError) as e:
             raise DetectorReportError("Failed to generate JSON report: %s" % e)
-        finally:
-            self.restore_calls(results)
@@ -0,0 +1,340 @@
+# Copyright (C) 2010-2013 Claudio Guarnieri.
+# Copyright (C) 2014-2015 Detector Foundation.
+# This file is part of Detector Sandbox - http://www.detectorsandbox.org
+# See the file 'docs/LICENSE' for copying permission.
+
+import multiprocessing
+import os
+import random
+import shutil
+import tempfile
+import threading
+import unittest
+
+from lib.detector.common.exceptions import DetectorOperationalError
+from lib.detector.common.utils import Singleton
+from lib.detector.core.database import Database, Machine, Task
+from lib.detector.core.database import TASK_COMPLETED, TASK_PENDING
+from lib.detector.core.database import TASK_RUNNING, TASK_FAILED_ANALYSIS
+
+def connect(dsn):
+    """Create a new Database instance, rather than reusing the singleton,
+    e.g., in a child process."""
+    Singleton._instances.pop(Database, None)
+    return Database(dsn=dsn)
+
+def claim_all(dsn, instance, queue):
+    """Claim tasks for processing until there are none left."""
+    db = connect(dsn)
+    claimed, misses = [], 0
+    while misses < 3:
+        task_id = db.processing_get_task(instance)
+        if task_id is None:
+            misses += 1
+        else:
+            claimed.append(task_id)
+    queue.put((instance, claimed))
+
+def assign_all(dsn, queue):
+    """Assign tasks to machines, one at a time, until there are no tasks or
+    machines left."""
+    db = connect(dsn)
+    assignments, misses = [], 0
+    while misses < 3:
+        ret = db.assign_tasks(1)
+        if not ret:
+            misses += 1
+        for task, machine in ret:
+            assignments.append((task.id, machine.name))
+    queue.put(assignments)
+
+def add_samples(dsn, samples, queue):
+    db = connect(dsn)
+    queue.put(db.add_samples(samples))
+
+class DatabaseTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dirpath = tempfile.mkdtemp()
+        self.dsn = "sqlite:///%s" % os.path.join(self.dirpath, "detector.db")
+        self.db = connect(self.dsn)
+
+    def tearDown(self):
+        Singleton._instances.pop(Database, None)
+        self.db.engine.dispose()
+        shutil.rmtree(self.dirpath)
+
+    def add_machine(self, name, platform="windows", tags=""):
+        self.db.add_machine(name=name, label=name, ip="192.168.56.101",
+                            platform=platform, options="", tags=tags,
+                            interface="", snapshot="",
+                            resultserver_ip="192.168.56.1",
+                            resultserver_port=2042)
+
+    def add_task(self, status=TASK_PENDING, **kwargs):
+        task_id = self.db.add_url("http://detector.test/", **kwargs)
+        if status != TASK_PENDING:
+            self.db.set_status(task_id, status)
+        return task_id
+
+    def rows(self, model):
+        session = self.db.Session()
+        try:
+            return session.query(model).order_by(model.id).all()
+        finally:
+            session.close()
+
+    def run_concurrently(self, target, args, count, processes):
+        queue = multiprocessing.Queue()
+        if processes:
+            workers = [multiprocessing.Process(target=target,
+                                               args=args(idx) + (queue,))
+                       for idx in xrange(count)]
+        else:
+            workers = [threading.Thread(target=target,
+                                        args=args(idx) + (queue,))
+                       for idx in xrange(count)]
+
+        for worker in workers:
+            worker.start()
+        ret = [queue.get(timeout=60) for worker in workers]
+        for worker in workers:
+            worker.join()
+        return ret
+
+class TestLocking(DatabaseTestCase):
+    def test_sqlite_lock(self):
+        self.assertTrue(self.db._lock)
+
+    def test_processing_get_task(self):
+        task_id = self.add_task(TASK_COMPLETED)
+        self.add_task(TASK_PENDING)
+
+        self.assertEqual(self.db.processing_get_task("a"), task_id)
+        self.assertEqual(self.db.processing_get_task("b"), None)
+        self.assertEqual(self.db.view_task(task_id).processing, "a")
+
+        self.assertEqual(self.db.processing_release("a"), 1)
+        self.assertEqual(self.db.processing_get_task("b"), task_id)
+
+    def _test_processing_claims(self, processes):
+        task_ids = [self.add_task(TASK_COMPLETED) for _ in xrange(200)]
+
+        ret = self.run_concurrently(
+            claim_all, lambda idx: (self.dsn, "worker%d" % idx), 8, processes
+        )
+
+        # Every task has been claimed by exactly one of the workers.
+        claimed = dict(ret)
+        self.assertEqual(sorted(sum(claimed.values(), [])), task_ids)
+        for task in self.rows(Task):
+            self.assertIn(task.id, claimed[task.processing])
+
+    def test_processing_claims_threads(self):
+        self._test_processing_claims(processes=False)
+
+    def test_processing_claims_processes(self):
+        self._test_processing_claims(processes=True)
+
+    def _test_assign_tasks(self, processes):
+        for idx in xrange(20):
+            self.add_machine("machine%d" % idx)
+        task_ids = [self.add_task() for _ in xrange(50)]
+
+        ret = self.run_concurrently(
+            assign_all, lambda idx: (self.dsn,), 4, processes
+        )
+        assignments = sum(ret, [])
+
+        # Each machine runs one task, and each task runs on one machine.
+        self.assertEqual(len(assignments), 20)
+        self.assertEqual(len(set(task for task, _ in assignments)), 20)
+        self.assertEqual(len(set(name for _, name in assignments)), 20)
+
+        running = [task.id for task in self.rows(Task)
+                   if task.status == TASK_RUNNING]
+        self.assertEqual(sorted(task for task, _ in assignments), running)
+        self.assertEqual(running, task_ids[:20])
+        self.assertTrue(all(machine.locked for machine in self.rows(Machine)))
+
+    def test_assign_tasks_threads(self):
+        self._test_assign_tasks(processes=False)
+
+    def test_assign_tasks_processes(self):
+        self._test_assign_tasks(processes=True)
+
+    def test_add_samples_processes(self):
+        samples = []
+        for idx in xrange(40):
+            path = os.path.join(self.dirpath, "sample%d" % idx)
+            samples.append((path, {
+                "file_size": 1, "file_type": "data", "md5": "%032x" % idx,
+                "crc32": "%08x" % idx, "sha1": "%040x" % idx,
+                "sha256": "%064x" % idx, "sha512": "%0128x" % idx,
+                "ssdeep": None,
+            }))
+
+        # Overlapping batches of samples.
+        ret = self.run_concurrently(
+            add_samples, lambda idx: (self.dsn, samples[idx*10:idx*10+20]),
+            3, True
+        )
+
+        added = sum(ret, [])
+        self.assertEqual(len(added), 60)
+        self.assertEqual(self.db.count_samples(), 40)
+
+        tasks = dict((task.id, task) for task in self.rows(Task))
+        self.assertEqual(len(tasks), 60)
+        for path, task_id in added:
+            self.assertEqual(tasks[task_id].target, path)
+            sample = self.db.view_sample(tasks[task_id].sample_id)
+            self.assertEqual(
+                sample.sha256, "%064x" % int(path.rsplit("sample", 1)[1])
+            )
+
+def legacy_assign(db):
+    """Assign tasks to machines the way the scheduler did before there was
+    assign_tasks(). It fetched a task bound to one of the free machines, or
+    else any task, after which the analysis manager locked a machine for it.
+    Tasks that no machine matched failed. If the task had to wait for a
+    machine, so did all other tasks.
+    @return: list of (task id, machine name) tuples and failed task ids.
+    """
+    assignments, failed = [], []
+    while True:
+        task, available = None, False
+        for machine in db.get_available_machines():
+            task = db.fetch(machine=machine.name)
+            if task:
+                break
+
+            if machine.is_analysis():
+                available = True
+
+        if not task and available:
+            task = db.fetch(service=False)
+
+        if not task:
+            break
+
+        try:
+            if task.machine:
+                machine = db.lock_machine(label=task.machine)
+            elif task.platform:
+                machine = db.lock_machine(platform=task.platform,
+                                          tags=task.tags)
+            else:
+                machine = db.lock_machine(tags=task.tags)
+        except DetectorOperationalError:
+            db.set_status(task.id, TASK_FAILED_ANALYSIS)
+            failed.append(task.id)
+            continue
+
+        if not machine:
+            break
+
+        assignments.append((task.id, machine.name))
+    return assignments, failed
+
+class TestAssignTasks(DatabaseTestCase):
+    def assign(self, machines, tasks):
+        """Assign the tasks to the machines, both through assign_tasks() and
+        the way the scheduler used to, each in a database of its own.
+        @param machines: list of (name, platform, tags) tuples.
+        @param tasks: list of dicts of add_url() arguments.
+        @return: tuples of assignments and failed task ids.
+        """
+        ret = []
+        for idx in xrange(2):
+            self.databases = getattr(self, "databases", 0) + 1
+            self.db = connect("%s.%d" % (self.dsn, self.databases))
+            for name, platform, tags in machines:
+                self.add_machine(name, platform, tags)
+            for task in tasks:
+                self.add_task(**task)
+
+            if idx:
+                assignments = [(task.id, machine.name) for task, machine in
+                               self.db.assign_tasks(len(machines))]
+                failed = [task.id for task in self.rows(Task)
+                          if task.status == TASK_FAILED_ANALYSIS]
+                ret.append((sorted(assignments), failed))
+            else:
+                assignments, failed = legacy_assign(self.db)
+                ret.append((sorted(assignments), sorted(failed)))
+            self.db.engine.dispose()
+        return ret
+
+    def test_assign_tasks(self):
+        machines = [
+            ("win7", "windows", "x64"),
+            ("winxp", "windows", ""),
+            ("ubuntu", "linux", ""),
+        ]
+        tasks = [
+            dict(priority=1),
+            dict(priority=1, machine="winxp"),
+            dict(priority=2, platform="linux"),
+            dict(priority=1),
+            dict(priority=3, tags="x64"),
+        ]
+        legacy, assigned = self.assign(machines, tasks)
+        self.assertEqual(legacy, assigned)
+        self.assertEqual(assigned[0], [(2, "winxp"), (3, "ubuntu"),
+                                       (5, "win7")])
+
+    def test_unknown_machine(self):
+        machines = [("win7", "windows", "")]
+        tasks = [
+            dict(priority=2, machine="winxp"),
+            dict(priority=2, platform="linux"),
+            dict(priority=1),
+        ]
+        legacy, assigned = self.assign(machines, tasks)
+        self.assertEqual(legacy, assigned)
+        self.assertEqual(assigned, ([(3, "win7")], [1, 2]))
+
+    def test_assign_tasks_random(self):
+        """Compare with the legacy assignments for random tasks and
+        machines. Where the legacy scheduler had to wait for a machine, so
+        did all tasks after it, while assign_tasks() continues with the
+        tasks that can run on another machine."""
+        rand = random.Random(1234)
+        platforms = "windows", "linux"
+        tags = "", "x64", "office", "x64,office"
+        identical = 0
+
+        for _ in xrange(50):
+            machines = []
+            for idx in xrange(rand.randint(1, 6)):
+                machines.append((
+                    "machine%d" % idx, rand.choice(platforms),
+                    rand.choice(tags),
+                ))
+
+            tasks = []
+            for _ in xrange(rand.randint(1, 12)):
+                task = dict(priority=rand.randint(1, 3))
+                if rand.random() < 0.2:
+                    task["machine"] = "machine%d" % rand.randint(0, 6)
+                elif rand.random() < 0.5:
+                    task["platform"] = rand.choice(platforms)
+                task["tags"] = rand.choice(tags) or None
+                tasks.append(task)
+
+            legacy, assigned = self.assign(machines, tasks)
+
+            # Each task that the legacy scheduler assigned to a machine is
+            # assigned to the same machine.
+            self.assertTrue(set(legacy[0]).issubset(assigned[0]),
+                            (machines, tasks, legacy, assigned))
+            self.assertTrue(set(legacy[1]).issubset(assigned[1]) or
+                            len(assigned[0]) == len(machines),
+                            (machines, tasks, legacy, assigned))
+            identical += legacy == assigned
+
+        # Most of the time the legacy scheduler didn't have to wait.
+        self.assertTrue(identical > 25, identical)
+
+if __name__ == "__main__":
+    unittest.main()
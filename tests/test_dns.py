@@ -0,0 +1,200 @@
+# Copyright (C) 2010-2013 Claudio Guarnieri.
+# Copyright (C) 2014-2015 Detector Foundation.
+# This file is part of Detector Sandbox - http://www.detectorsandbox.org
+# See the file 'docs/LICENSE' for copying permission.
+
+import socket
+import struct
+import threading
+import time
+import unittest
+
+from lib.detector.common import dns
+
+def encode_name(name):
+    return "".join(chr(len(label)) + label
+                   for label in name.split(".")) + "\x00"
+
+def record(name, rtype, ttl, rdata):
+    return encode_name(name) + \
+        struct.pack(">HHIH", rtype, 1, ttl, len(rdata)) + rdata
+
+class StubResolver(threading.Thread):
+    """Name server answering A queries from a table of names.
+    - CNAME chains: www.cname.test -> alias.cname.test -> cname.test, with
+      TTLs of 300, 30, and 100 seconds respectively.
+    - nx.test doesn't exist, with a negative caching TTL of 60 seconds.
+    - drop.test is never answered.
+    """
+
+    def __init__(self, family=socket.AF_INET, address="127.0.0.1"):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.sock = socket.socket(family, socket.SOCK_DGRAM)
+        self.sock.bind((address, 0))
+        self.address = self.sock.getsockname()[:2]
+        self.queries = []
+
+    def run(self):
+        while True:
+            try:
+                buf, addr = self.sock.recvfrom(4096)
+            except socket.error:
+                break
+
+            response = self.answer(buf)
+            if response:
+                self.sock.sendto(response, addr)
+
+    def answer(self, buf):
+        offset, labels = 12, []
+        while ord(buf[offset]):
+            length = ord(buf[offset])
+            labels.append(buf[offset+1:offset+1+length])
+            offset += length + 1
+
+        name, question = ".".join(labels), buf[12:offset+5]
+        self.queries.append(name)
+
+        answers, authority, rcode = [], [], dns.DNS_RCODE_NOERROR
+        if name == "drop.test":
+            return
+        elif name == "nx.test":
+            rcode = dns.DNS_RCODE_NXDOMAIN
+            soa = encode_name("ns.test") + encode_name("admin.test") + \
+                struct.pack(">IIIII", 1, 3600, 600, 86400, 60)
+            authority.append(record("test", dns.DNS_TYPE_SOA, 600, soa))
+        elif name.endswith("cname.test"):
+            if name == "www.cname.test":
+                answers.append(record(name, 5, 300,
+                                      encode_name("alias.cname.test")))
+            if name != "cname.test":
+                answers.append(record("alias.cname.test", 5, 30,
+                                      encode_name("cname.test")))
+            answers.append(record("cname.test", dns.DNS_TYPE_A, 100,
+                                  socket.inet_aton("10.0.0.1")))
+
+        return buf[:2] + struct.pack(">HHHHH", 0x8180 | rcode, 1,
+                                     len(answers), len(authority), 0) + \
+            question + "".join(answers) + "".join(authority)
+
+    def close(self):
+        self.sock.close()
+
+class TestQuery(unittest.TestCase):
+    def setUp(self):
+        self.timeout, self.cache = dns.DNS_TIMEOUT, dns.cache
+        dns.set_timeout(0.2)
+        dns.cache = dns.DnsCache()
+
+        self.stub = StubResolver()
+        self.stub.start()
+
+    def tearDown(self):
+        dns.set_timeout(self.timeout)
+        dns.cache = self.cache
+        self.stub.close()
+
+    def test_cname_chain(self):
+        self.assertEqual(dns.query("www.cname.test", *self.stub.address),
+                         ("10.0.0.1", 30))
+        self.assertEqual(dns.query("cname.test", *self.stub.address),
+                         ("10.0.0.1", 100))
+
+    def test_nxdomain(self):
+        self.assertEqual(dns.query("nx.test", *self.stub.address),
+                         ("", 60))
+
+    def test_timeout(self):
+        self.assertEqual(dns.query("drop.test", *self.stub.address),
+                         (dns.DNS_TIMEOUT_VALUE, dns.DNS_TIMEOUT_TTL))
+
+    def test_other_sender(self):
+        """Answers that don't come from the name server are ignored."""
+        other = StubResolver()
+        other.start()
+        try:
+            self.assertEqual(dns.query("drop.test", *other.address),
+                             (dns.DNS_TIMEOUT_VALUE, dns.DNS_TIMEOUT_TTL))
+        finally:
+            other.close()
+
+    def test_resolve_many(self):
+        names = ["www.cname.test", "nx.test", "drop.test"]
+        start = time.time()
+        ret = dns.resolve_many(names, server=self.stub.address)
+        self.assertEqual(ret, {
+            "www.cname.test": "10.0.0.1",
+            "nx.test": "",
+            "drop.test": "",
+        })
+
+        # Each name is cached for its own TTL.
+        for name, ttl in (("www.cname.test", 30), ("nx.test", 60),
+                          ("drop.test", dns.DNS_TIMEOUT_TTL)):
+            expires = dns.cache.entries[name][1]
+            self.assertTrue(start + ttl <= expires <= time.time() + ttl)
+
+        queries = len(self.stub.queries)
+        self.assertEqual(dns.resolve_many(names, server=self.stub.address),
+                         ret)
+        self.assertEqual(len(self.stub.queries), queries)
+
+    def test_ipv6(self):
+        try:
+            stub = StubResolver(socket.AF_INET6, "::1")
+        except socket.error:
+            self.skipTest("IPv6 is not available")
+
+        stub.start()
+        try:
+            server = dns.parse_server("[%s]:%d" % stub.address)
+            self.assertEqual(server, stub.address)
+            self.assertEqual(dns.query("cname.test", *server),
+                             ("10.0.0.1", 100))
+        finally:
+            stub.close()
+
+class TestParseServer(unittest.TestCase):
+    def test_parse_server(self):
+        self.assertEqual(dns.parse_server(""), None)
+        self.assertEqual(dns.parse_server("8.8.8.8"), ("8.8.8.8", 53))
+        self.assertEqual(dns.parse_server("127.0.0.1:5353"),
+                         ("127.0.0.1", 5353))
+        self.assertEqual(dns.parse_server("::1"), ("::1", 53))
+        self.assertEqual(dns.parse_server("[::1]:5353"), ("::1", 5353))
+        self.assertEqual(dns.parse_server("2001:db8:0::1"),
+                         ("2001:db8::1", 53))
+
+    def test_invalid_server(self):
+        for server in "ns.test", "ns.test:53", "[::1]:dns":
+            self.assertRaises(ValueError, dns.parse_server, server)
+
+class TestLookup(unittest.TestCase):
+    def setUp(self):
+        if dns.HAVE_CARES or dns.HAVE_GEVENT:
+            self.skipTest("The threaded resolver is not used")
+
+        self.timeout = dns.DNS_TIMEOUT
+        self.gethostbyname = dns.gethostbyname
+        dns.set_timeout(0.2)
+
+    def tearDown(self):
+        dns.set_timeout(self.timeout)
+        dns.gethostbyname = self.gethostbyname
+
+    def test_host_resolver(self):
+        dns.gethostbyname = lambda name: "10.0.0.1"
+        self.assertEqual(dns.lookup("host.test"),
+                         ("10.0.0.1", dns.DNS_DEFAULT_TTL))
+
+        dns.gethostbyname = lambda name: ""
+        self.assertEqual(dns.lookup("nx.test"), ("", dns.DNS_NEGATIVE_TTL))
+
+    def test_host_resolver_timeout(self):
+        dns.gethostbyname = lambda name: time.sleep(1)
+        self.assertEqual(dns.lookup("drop.test"),
+                         (dns.DNS_TIMEOUT_VALUE, dns.DNS_TIMEOUT_TTL))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,113 @@
+# Copyright (C) 2010-2013 Claudio Guarnieri.
+# Copyright (C) 2014-2015 Detector Foundation.
+# This file is part of Detector Sandbox - http://www.detectorsandbox.org
+# See the file 'docs/LICENSE' for copying permission.
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from lib.detector.common.utils import Singleton
+from lib.detector.core import database
+from lib.detector.core.database import Database, notify_scheduler
+
+# Importing the scheduler connects to the database, which shouldn't be the
+# default one.
+TMPDIR = tempfile.mkdtemp()
+Database(dsn="sqlite:///%s" % os.path.join(TMPDIR, "detector.db"))
+
+from lib.detector.core import scheduler
+from lib.detector.core.scheduler import Scheduler, scheduler_wakeup
+
+def tearDownModule():
+    shutil.rmtree(TMPDIR)
+
+class TestWakeup(unittest.TestCase):
+    def setUp(self):
+        self.dirpath = tempfile.mkdtemp()
+        self.path = os.path.join(self.dirpath, "scheduler.sock")
+
+        Singleton._instances.pop(Database, None)
+        self.db = Database(dsn="sqlite:///%s" % os.path.join(self.dirpath,
+                                                              "detector.db"))
+        self.scheduler = Scheduler()
+        scheduler_wakeup.clear()
+
+    def tearDown(self):
+        self.scheduler.running = False
+        Singleton._instances.pop(Database, None)
+        self.db.engine.dispose()
+        shutil.rmtree(self.dirpath)
+
+    def wait(self):
+        start = time.time()
+        return self.scheduler.wait(), time.time() - start
+
+    def test_notify(self):
+        self.assertTrue(self.scheduler.listen(self.path))
+
+        notify_scheduler(self.path)
+        woken, duration = self.wait()
+        self.assertTrue(woken)
+        self.assertTrue(duration < 0.5, duration)
+
+    def test_add_notifies(self):
+        self.scheduler.listen(self.path)
+
+        socket_path = database.SCHEDULER_SOCKET
+        database.SCHEDULER_SOCKET = self.path
+        try:
+            self.db.add_url("http://detector.test/")
+        finally:
+            database.SCHEDULER_SOCKET = socket_path
+
+        woken, duration = self.wait()
+        self.assertTrue(woken)
+        self.assertTrue(duration < 0.5, duration)
+
+    def test_no_listener(self):
+        # Notifying nobody is not an error.
+        notify_scheduler(self.path)
+        self.assertFalse(scheduler_wakeup.is_set())
+
+    def test_lost_notification(self):
+        """Without a notification the scheduler still looks for new tasks
+        within the polling interval."""
+        task_id = self.db.add_url("http://detector.test/")
+        self.db.add_machine(name="machine", label="machine",
+                            ip="192.168.56.101", platform="windows",
+                            options="", tags="", interface="", snapshot="",
+                            resultserver_ip="192.168.56.1",
+                            resultserver_port=2042)
+
+        woken, duration = self.wait()
+        self.assertFalse(woken)
+        self.assertTrue(duration < scheduler.POLL_INTERVAL + 0.5, duration)
+
+        assignments = self.db.assign_tasks(1)
+        self.assertEqual([task.id for task, _ in assignments], [task_id])
+
+    def test_listener_failure(self):
+        """If the listening socket fails, the scheduler falls back to
+        polling."""
+        t = self.scheduler.listen(self.path)
+        os.unlink(self.path)
+
+        notify_scheduler(self.path)
+        woken, duration = self.wait()
+        self.assertFalse(woken)
+        self.assertTrue(duration < scheduler.POLL_INTERVAL + 0.5, duration)
+        self.assertTrue(t.is_alive())
+
+    def test_bind_failure(self):
+        path = os.path.join(self.dirpath, "missing", "scheduler.sock")
+        self.assertEqual(self.scheduler.listen(path), None)
+
+        woken, duration = self.wait()
+        self.assertFalse(woken)
+        self.assertTrue(duration < scheduler.POLL_INTERVAL + 0.5, duration)
+
+if __name__ == "__main__":
+    unittest.main()
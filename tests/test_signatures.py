@@ -0,0 +1,78 @@
+# Copyright (C) 2010-2013 Claudio Guarnieri.
+# Copyright (C) 2014-2015 Detector Foundation.
+# This file is part of Detector Sandbox - http://www.detectorsandbox.org
+# See the file 'docs/LICENSE' for copying permission.
+
+import unittest
+
+from lib.detector.common.abstracts import Signature, SummaryIndex
+from lib.detector.core.plugins import RunSignatures
+
+GENERIC = [
+    {
+        "pid": 1,
+        "summary": {
+            "file_opened": ["C:\\Windows\\system32\\drivers\\etc\\hosts"],
+            "file_moved": [("C:\\a.exe", "C:\\Windows\\a.exe")],
+            "file_copied": [("C:\\b.exe", "C:\\Windows\\b.exe")],
+            "tls_master": [("00", "11", "22")],
+        },
+    },
+    {
+        "pid": 2,
+        "summary": {
+            "file_written": ["C:\\Windows\\a.exe"],
+            "file_moved": [["C:\\c.exe", "C:\\Windows\\c.exe"]],
+        },
+    },
+]
+
+class HostsSignature(Signature):
+    name = "hosts"
+    minimum = maximum = None
+
+    def init(self):
+        self.register_patterns(".*\\\\etc\\\\hosts$", ".*\\\\windows\\\\.*")
+
+    def on_complete(self):
+        return bool(self.check_file(".*\\\\etc\\\\hosts$", regex=True))
+
+class TestSummaryIndex(unittest.TestCase):
+    def test_match_patterns(self):
+        index = SummaryIndex(GENERIC)
+        index.register("sig", ".*\\\\windows\\\\.*")
+
+        hits = index.match_patterns(Signature.patterns)
+        self.assertEqual(sorted(value for _, _, value in hits), [
+            "C:\\Windows\\a.exe",
+            "C:\\Windows\\system32\\drivers\\etc\\hosts",
+        ])
+        self.assertEqual(
+            index.search(None, ["file_moved", "file_written"],
+                         ".*\\\\windows\\\\.*"),
+            set(["C:\\Windows\\a.exe"])
+        )
+
+    def test_tuple_actions(self):
+        index = SummaryIndex(GENERIC)
+        self.assertEqual(index.find(None, ["file_moved", "file_opened"],
+                                    "c:\\windows\\system32\\drivers\\etc\\"
+                                    "hosts"),
+                         set(["C:\\Windows\\system32\\drivers\\etc\\hosts"]))
+        self.assertEqual(index.unique(1, ["file_copied", "tls_master"]), [])
+
+class TestRunSignatures(unittest.TestCase):
+    def test_registered_patterns(self):
+        results = {
+            "info": {},
+            "behavior": {"generic": GENERIC, "processes": []},
+        }
+        rs = RunSignatures(results)
+        rs.signatures = [HostsSignature(rs)]
+        rs.run()
+
+        self.assertEqual([sig["name"] for sig in results["signatures"]],
+                         ["hosts"])
+
+if __name__ == "__main__":
+    unittest.main()
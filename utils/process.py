@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+import argparse
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+
+sys.path.append(os.path.join(os.path.abspath(os.path.dirname(__file__)), ".."))
+
+from lib.detector.common.config import Config
+from lib.detector.common.constants import DETECTOR_ROOT
+from lib.detector.core.database import Database
+from lib.detector.core.database import TASK_REPORTED, TASK_FAILED_PROCESSING
+from lib.detector.core.plugins import RunProcessing, RunSignatures
+from lib.detector.core.plugins import RunReporting
+from lib.detector.core.startup import init_console_logging, init_modules
+from lib.detector.core.startup import drop_privileges
+
+log = logging.getLogger()
+
+# Seconds between two heartbeats of a worker.
+HEARTBEAT_INTERVAL = 10
+
+# Seconds after which the tasks of a worker that has not sent a heartbeat are
+# handed out to other workers again.
+HEARTBEAT_TIMEOUT = 120
+
+def process(task_id):
+    """Process, run signatures on, and report the results of a task.
+    @param task_id: task identifier.
+    @return: whether the task has been processed successfully.
+    """
+    db = Database()
+    task = db.view_task(task_id)
+    if not task:
+        log.warning("Task #%d does not exist anymore, skipping it", task_id)
+        return False
+
+    results = RunProcessing(task=task.to_dict()).run()
+    RunSignatures(results=results).run()
+    RunReporting(task=task.to_dict(), results=results).run()
+
+    # If the target is a file and the user enabled the option, delete the
+    # original copy.
+    if task.category == "file" and Config().detector.delete_original:
+        try:
+            os.remove(task.target)
+        except OSError as e:
+            log.error("Unable to delete original file at path \"%s\": %s",
+                      task.target, e)
+
+    log.info("Task #%d: reports generation completed", task_id)
+    return True
+
+def heartbeat(instance, stop):
+    """Keep marking a worker as alive until it stops."""
+    db = Database()
+    while not stop.is_set():
+        db.processing_heartbeat(instance)
+        stop.wait(HEARTBEAT_INTERVAL)
+
+def worker(instance, maxcount):
+    """Claim and process completed tasks until maxcount is reached.
+    @param instance: name of this worker in the database.
+    @param maxcount: maximum amount of tasks to process, 0 for no limit.
+    """
+    # The supervisor takes care of stopping the workers.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    # Don't share the database connections of the supervisor.
+    db = Database()
+    db.engine.dispose()
+
+    # Tasks claimed by a previous incarnation of this worker.
+    released = db.processing_release(instance)
+    if released:
+        log.info("Worker %s released %d unprocessed task(s)",
+                 instance, released)
+
+    stop = threading.Event()
+    t = threading.Thread(target=heartbeat, args=(instance, stop))
+    t.daemon = True
+    t.start()
+
+    count = 0
+    try:
+        while not maxcount or count < maxcount:
+            task_id = db.processing_get_task(instance)
+            if task_id is None:
+                time.sleep(1)
+                continue
+
+            log.info("Worker %s processing task #%d", instance, task_id)
+            try:
+                success = process(task_id)
+            except:
+                log.exception("Worker %s failed to process task #%d",
+                              instance, task_id)
+                success = False
+
+            db.set_status(task_id,
+                          TASK_REPORTED if success else TASK_FAILED_PROCESSING)
+            count += 1
+    finally:
+        stop.set()
+
+def instance_names(prefix, count):
+    """Name each worker, limited by the size of the processing column."""
+    return ["%s.%d" % (prefix[:16-len(".%d" % idx)], idx)
+            for idx in xrange(count)]
+
+def supervise(prefix, count, maxcount):
+    """Run the workers, restart them when they die, and recover the tasks
+    of workers on any host that stopped sending heartbeats."""
+    db = Database()
+    workers = dict((name, None) for name in instance_names(prefix, count))
+
+    try:
+        while True:
+            for name, proc in workers.items():
+                if proc and proc.is_alive():
+                    continue
+
+                if proc and proc.exitcode:
+                    log.warning("Worker %s exited with code %d, restarting "
+                                "it", name, proc.exitcode)
+
+                proc = multiprocessing.Process(
+                    target=worker, args=(name, maxcount), name=name
+                )
+                proc.daemon = True
+                proc.start()
+                workers[name] = proc
+
+            recovered = db.processing_recover(HEARTBEAT_TIMEOUT)
+            if recovered:
+                log.warning("Recovered %d task(s) from unresponsive "
+                            "processing workers", recovered)
+
+            time.sleep(HEARTBEAT_INTERVAL)
+    except KeyboardInterrupt:
+        log.info("Stopping the processing workers")
+    finally:
+        for proc in workers.values():
+            if proc and proc.is_alive():
+                proc.terminate()
+                proc.join()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("id", type=str, nargs="?", default="auto", help="ID of the task to process, or \"auto\" to keep processing completed tasks")
+    parser.add_argument("-d", "--debug", action="store_true", help="Enable debug logging")
+    parser.add_argument("-i", "--instance", type=str, default=socket.gethostname(), help="Name of this processing host, used to claim tasks")
+    parser.add_argument("-p", "--parallel", type=int, default=1, help="Amount of worker processes")
+    parser.add_argument("-m", "--maxcount", type=int, default=0, help="Amount of tasks a worker process handles before being restarted")
+    parser.add_argument("-u", "--user", type=str, help="Drop user privileges to this user")
+    args = parser.parse_args()
+
+    if args.user:
+        drop_privileges(args.user)
+
+    os.chdir(DETECTOR_ROOT)
+
+    init_console_logging()
+    log.setLevel(logging.DEBUG if args.debug else logging.INFO)
+
+    init_modules(machinery=False)
+
+    if args.id == "auto":
+        supervise(args.instance, max(args.parallel, 1), args.maxcount)
+    else:
+        process(int(args.id))
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,11 @@
 import argparse
 import fnmatch
 import logging
+import multiprocessing
 import os
 import random
 import sys
+import time
 
 try:
     import requests
@@ -15,7 +17,81 @@ sys.path.append(os.path.join(os.path.abspath(os.path.dirname(__file__)), ".."))
 
 from lib.detector.common.objects import File
 from lib.detector.common.utils import to_unicode
-from lib.detector.core.database import Database
+from lib.detector.core.database import Database, sample_info
+
+def hash_sample(file_path):
+    """Compute the sample details of a file, run by the worker processes."""
+    try:
+        return file_path, sample_info(file_path)
+    except (IOError, OSError):
+        return file_path, None
+
+def add_batch(db, batch, args):
+    """Add the tasks of a batch of hashed files.
+    @return: amount of tasks added.
+    """
+    tasks = db.add_samples(batch,
+                           package=args.package,
+                           timeout=args.timeout,
+                           options=args.options,
+                           priority=args.priority,
+                           machine=args.machine,
+                           platform=args.platform,
+                           custom=args.custom,
+                           owner=args.owner,
+                           memory=args.memory,
+                           enforce_timeout=args.enforce_timeout,
+                           clock=args.clock,
+                           tags=args.tags,
+                           unique=args.unique)
+
+    if not args.quiet:
+        added = set(file_path for file_path, task_id in tasks)
+        for file_path, task_id in tasks:
+            print(u"Success : File \"{0}\" added as task with ID {1}".format(file_path, task_id))
+        for file_path, info in batch:
+            if file_path not in added:
+                print("Duplicate: Sample {0} (skipping file)".format(file_path))
+
+    return len(tasks)
+
+def submit_bulk(db, files, args):
+    """Hash the files in worker processes and add them in batches."""
+    start = time.time()
+    count = tasks = 0
+    batch = []
+
+    pool = multiprocessing.Pool(args.workers or None)
+    try:
+        for file_path, info in pool.imap(hash_sample, files, 16):
+            if not info:
+                if not args.quiet:
+                    print("Empty: sample {0} (skipping file)".format(file_path))
+                continue
+
+            if args.max is not None:
+                # Break if the maximum number of samples has been reached.
+                if not args.max:
+                    break
+
+                args.max -= 1
+
+            count += 1
+            batch.append((file_path, info))
+            if len(batch) >= args.batch_size:
+                tasks += add_batch(db, batch, args)
+                batch = []
+
+        if batch:
+            tasks += add_batch(db, batch, args)
+    finally:
+        pool.terminate()
+        pool.join()
+
+    duration = max(time.time() - start, 0.001)
+    print("Submitted {0} file(s) as {1} task(s) in {2:.1f} seconds "
+          "({3:.1f} files/second)".format(count, tasks, duration,
+                                          count / duration))
 
 def main():
     parser = argparse.ArgumentParser()
@@ -41,6 +117,9 @@ def main():
     parser.add_argument("--shuffle", action="store_true", default=False, help="Shuffle samples before submitting them", required=False)
     parser.add_argument("--unique", action="store_true", default=False, help="Only submit new samples, ignore duplicates", required=False)
     parser.add_argument("--quiet", action="store_true", default=False, help="Only print text on failure", required=False)
+    parser.add_argument("--bulk", action="store_true", default=False, help="Hash the files in parallel and add them to the database in batches", required=False)
+    parser.add_argument("--workers", type=int, action="store", default=0, help="Amount of processes hashing files in bulk mode (defaults to the amount of CPUs)", required=False)
+    parser.add_argument("--batch-size", type=int, action="store", default=1000, help="Amount of files added to the database at once in bulk mode", required=False)
 
     try:
         args = parser.parse_args()
@@ -160,6 +239,14 @@ def main():
         else:
             files = sorted(files)
 
+        if args.bulk:
+            if args.remote:
+                print "Remote bulk submission has not yet been implemented."
+                exit(1)
+
+            submit_bulk(db, files, args)
+            return True
+
         for file_path in files:
             if not File(file_path).get_size():
                 if not args.quiet: